@@ -0,0 +1,81 @@
+#################### IMPORTS ####################
+# FROM FILE
+from DataScript.get_patient_data import *
+from DataScript.load_metadata import *
+from DataScript.scan_manifest import *
+
+#################### FUNCTIONS ####################
+
+# This class will look up the CDR of the OASIS subjects and sessions
+class CDRLabelService:
+    """
+    Loads the OASIS-1/2/3/4 CDR tables of a root directory once (one walk, see load_cdr_dataframes) and
+    indexes them by subject (OASISID) and by session (CLINICALDATAID), so labelling a file is a dictionary
+    lookup. The first row of a subject or session is used, like the .values[0] lookups it replaces.
+
+    Usage:
+        labels = CDRLabelService(data_folder)
+        label = labels.get_file_label('Slice_100_OAS1_0001_MR1_axial_img.png')
+    """
+
+    # This function will load and index the CDR tables
+    def __init__(self, root_directory, manifest=None, cdr_dfs=None):
+        """
+        :param root_directory: Root directory holding the CDR files.
+        :param manifest: The scan manifest of root_directory; it is built (one walk) if not given.
+        :param cdr_dfs: CDR tables already loaded with load_cdr_dataframes, if any.
+        """
+        self.cdr_dfs = cdr_dfs if cdr_dfs is not None else load_cdr_dataframes(root_directory, manifest)
+        self.cdr_by_patient = {dataset: self.index_first_cdr(df, 'OASISID') for dataset, df in self.cdr_dfs.items()}
+        self.cdr_by_session = {dataset: self.index_first_cdr(df, 'CLINICALDATAID') for dataset, df in self.cdr_dfs.items()}
+
+    # This function will map the keys of a table to the CDR of their first row
+    @staticmethod
+    def index_first_cdr(df, key):
+        if key not in df.columns or 'CDR' not in df.columns:
+            return {}
+        df = df.dropna(subset=[key]).drop_duplicates(subset=[key])
+        return dict(zip(df[key], df['CDR']))
+
+    # This function will return the CDR of a subject (its first row in the dataset's table)
+    def get_patient_cdr(self, dataset, oasisid):
+        return self.cdr_by_patient.get(dataset, {}).get(oasisid)
+
+    # This function will return the CDR of a session, e.g. OAS1_0001_MR1 or OAS30001_UDSb4_d0000
+    def get_session_cdr(self, dataset, clinical_data_id):
+        return self.cdr_by_session.get(dataset, {}).get(clinical_data_id)
+
+    # This function will return the CDR of a slice image from its file name
+    def get_file_cdr(self, file):
+        """
+        :param file: A slice file name, e.g. Slice_100_OAS1_0001_MR1_axial_img.png (OASIS-1 is looked up by
+                     session, the others by subject).
+        :return: The CDR, or None if the file's subject or session is not in the CDR tables.
+        """
+        parts = file.split('_')
+        if "OAS1" in file:
+            # Slice_100_OAS1_0001_MR1_axial_img_1_anon -> OAS1_0001_MR1
+            return self.get_session_cdr('OAS1', f'OAS1_{parts[3]}_{parts[4]}')
+        elif "OAS2" in file:
+            # Slice_100_OAS2_0001_MR2_axial_img_3.png -> OAS2_0001
+            return self.get_patient_cdr('OAS2', f'OAS2_{parts[3]}')
+        elif "OAS3" in file:
+            # Slice_11_sub-OAS30036_sess-d1199_T2star_Sagittal_img.png -> OAS30036
+            return self.get_patient_cdr('OAS3', parts[2][4:])
+        elif "OAS4" in file:
+            # Slice_x_100_OAS42027_MR_d3034_img9.png -> OAS42027
+            return self.get_patient_cdr('OAS4', parts[3])
+        return None
+
+    # This function will return the CDR label (category folder) of a slice image
+    def get_file_label(self, file, default='unknown'):
+        """
+        :return: The label of the file's CDR in cdr_mapping, or `default` if the file has no CDR, its CDR is
+                 not a number (e.g. '' in the CSV) or the number has no label (e.g. NaN or 3).
+        """
+        cdr = self.get_file_cdr(file)
+        try:
+            cdr = float(cdr)
+        except (TypeError, ValueError):
+            return default
+        return cdr_mapping.get(cdr, default)
@@ -0,0 +1,167 @@
+#################### IMPORTS ####################
+# ALL
+import os
+import re
+import time
+import sqlite3
+
+#################### SETTINGS ####################
+
+# One row per scan. A scan is 'started' while its slices are being saved and 'done' once they all are.
+# Rows guessed from the images of a run without a ledger (seed_from_directory) have seeded = 1.
+completion_ledger_schema = """
+CREATE TABLE IF NOT EXISTS scans (
+    file_name TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    num_slices INTEGER,
+    updated_at REAL,
+    seeded INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS ledger_info (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Slice images saved by save_single_slice and save_uint8_slices_as_images: Slice_<index>_<file name>_<orientation>_img.png
+completion_ledger_slice_pattern = re.compile(r'^Slice_\d+_(.+)_(?:sagittal|coronal|axial)_img\.png$')
+
+#################### FUNCTIONS ####################
+
+# This class will record which scans have all their slices saved
+class CompletionLedger:
+    """
+    SQLite ledger of the converted scans, so reruns look a scan up instead of walking the output folder.
+
+    Scans are marked 'started' before they are converted and 'done' in one commit once all their
+    slices are saved. A scan left 'started' by an interrupted run was only partly written, so it
+    is not done and is converted again.
+
+    Usage:
+        with CompletionLedger(preprocessed_data_path + 'completion_ledger.sqlite') as ledger:
+            ledger.seed_from_directory(preprocessed_data_path, get_expected_slice_count)
+            pending = [file_name for file_name in file_names if not ledger.is_done(file_name)]
+    """
+
+    # This function will open (and create if needed) the ledger file
+    def __init__(self, ledger_path):
+        self.ledger_path = ledger_path
+        os.makedirs(os.path.dirname(os.path.abspath(ledger_path)), exist_ok=True)
+        self.connection = sqlite3.connect(ledger_path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(completion_ledger_schema)
+        # Ledgers written before the seeded column
+        if 'seeded' not in self.get_scan_columns(self.connection):
+            with self.connection:
+                self.connection.execute('ALTER TABLE scans ADD COLUMN seeded INTEGER NOT NULL DEFAULT 0')
+        self.done = {file_name for (file_name,) in self.connection.execute("SELECT file_name FROM scans WHERE status = 'done'")}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # This function will list the columns of the scans table of a ledger
+    @staticmethod
+    def get_scan_columns(connection):
+        return [row[1] for row in connection.execute('PRAGMA table_info(scans)')]
+
+    # This function will close the ledger
+    def close(self):
+        self.connection.close()
+
+    # This function will check if all the slices of a scan are saved
+    def is_done(self, file_name):
+        return file_name in self.done
+
+    # This function will list the scans an earlier run started but did not finish
+    def get_partial(self):
+        return [file_name for (file_name,) in self.connection.execute("SELECT file_name FROM scans WHERE status = 'started' ORDER BY file_name")]
+
+    # This function will mark scans as being converted
+    def mark_started(self, file_names):
+        with self.connection:
+            self.connection.executemany("""
+                INSERT INTO scans (file_name, status, num_slices, updated_at, seeded) VALUES (?, 'started', NULL, ?, 0)
+                ON CONFLICT (file_name) DO UPDATE SET status = 'started', num_slices = NULL, updated_at = excluded.updated_at, seeded = 0
+            """, [(file_name, time.time()) for file_name in file_names])
+        self.done.difference_update(file_names)
+
+    # This function will mark a scan as having all its slices saved
+    def mark_done(self, file_name, num_slices=None):
+        with self.connection:
+            self.connection.execute("""
+                INSERT INTO scans (file_name, status, num_slices, updated_at, seeded) VALUES (?, 'done', ?, ?, 0)
+                ON CONFLICT (file_name) DO UPDATE SET status = 'done', num_slices = excluded.num_slices, updated_at = excluded.updated_at, seeded = 0
+            """, (file_name, num_slices, time.time()))
+        self.done.add(file_name)
+
+    # This function will add the scans of another ledger, e.g. the ledger of a shard
+    def merge_from(self, other_ledger_path, file_names=None):
+        """
+        Copies the scans of another ledger. A row recorded by a conversion beats a seeded one, so a
+        shard's own 'started' row is kept. Between two rows of the same kind, a scan done in either
+        ledger is done.
+
+        :param file_names: Copy only these scans (all of them if None).
+        """
+        other = sqlite3.connect(other_ledger_path)
+        try:
+            seeded_column = 'seeded' if 'seeded' in self.get_scan_columns(other) else '0'
+            rows = other.execute(f'SELECT file_name, status, num_slices, updated_at, {seeded_column} FROM scans').fetchall()
+        finally:
+            other.close()
+        if file_names is not None:
+            rows = [row for row in rows if row[0] in file_names]
+
+        with self.connection:
+            self.connection.executemany("""
+                INSERT INTO scans (file_name, status, num_slices, updated_at, seeded) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (file_name) DO UPDATE SET status = excluded.status, num_slices = excluded.num_slices, updated_at = excluded.updated_at, seeded = excluded.seeded
+                WHERE (scans.seeded = 1 AND excluded.seeded = 0)
+                   OR (scans.seeded = excluded.seeded AND (scans.status != 'done' OR excluded.status = 'done'))
+            """, rows)
+        self.done = {file_name for (file_name,) in self.connection.execute("SELECT file_name FROM scans WHERE status = 'done'")}
+        return len(rows)
+
+    # This function will fill a new ledger from the images saved by runs without a ledger
+    def seed_from_directory(self, output_directory, get_expected_slice_count):
+        """
+        Walks the output folder once, the first time the ledger is used, and adds every scan that
+        has slice images. A scan is done if it has as many images as it should have; otherwise the
+        earlier run stopped in the middle of it, so it is marked started and converted again.
+
+        :param output_directory: Folder of the slice images.
+        :param get_expected_slice_count: Function of a file name giving the number of images of the
+                                         scan, or None if it is not known (the scan is then started).
+        :return: The number of scans marked as done, 0 if the ledger was seeded already.
+        """
+        if self.connection.execute("SELECT value FROM ledger_info WHERE key = 'seeded'").fetchone() is not None:
+            return 0
+
+        slice_counts = {}
+        for _, _, files in os.walk(output_directory):
+            for file in files:
+                match = completion_ledger_slice_pattern.match(file)
+                if match:
+                    slice_counts[match.group(1)] = slice_counts.get(match.group(1), 0) + 1
+
+        rows = []
+        now = time.time()
+        for file_name, num_slices in slice_counts.items():
+            status = 'done' if num_slices == get_expected_slice_count(file_name) else 'started'
+            rows.append((file_name, status, num_slices, now))
+        num_done = sum(1 for row in rows if row[1] == 'done')
+
+        with self.connection:
+            self.connection.executemany("""
+                INSERT INTO scans (file_name, status, num_slices, updated_at, seeded) VALUES (?, ?, ?, ?, 1)
+                ON CONFLICT (file_name) DO NOTHING
+            """, rows)
+            self.connection.execute("INSERT INTO ledger_info (key, value) VALUES ('seeded', ?)", (str(now),))
+        self.done = {file_name for (file_name,) in self.connection.execute("SELECT file_name FROM scans WHERE status = 'done'")}
+
+        print(f"Completion ledger: {len(slice_counts)} scans found in {output_directory}, {len(slice_counts) - num_done} of them incomplete")
+        return num_done
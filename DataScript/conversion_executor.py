@@ -0,0 +1,209 @@
+#################### IMPORTS ####################
+# ALL
+import os
+import sys
+import time
+
+# FROM
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+# OPTIONAL
+try:
+    import psutil  # Current RSS on every platform
+except ImportError:
+    psutil = None
+
+try:
+    import resource  # Unix only
+except ImportError:
+    resource = None
+
+#################### FUNCTIONS ####################
+
+# This function will return the resident memory of this process in bytes
+def get_process_rss():
+    """
+    Uses psutil if it is installed, /proc/self/statm on Linux, and the peak RSS otherwise.
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        if resource is None:
+            return 0
+        # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+# This function will return the size on disk of a (file name, file paths) conversion task
+def get_scan_task_size(task):
+    total_size = 0
+    for file_path in task[1]:
+        try:
+            total_size += os.path.getsize(file_path)
+        except OSError:
+            pass
+    return total_size
+
+# This function will tell whether the worker address space can be capped on this platform
+def can_limit_worker_memory():
+    # macOS accepts RLIMIT_AS but does not enforce it, and Windows has no resource module
+    return resource is not None and hasattr(resource, 'RLIMIT_AS') and sys.platform != 'darwin'
+
+# This function will cap the address space of a worker, then run the pool's initializer
+def init_worker(max_worker_memory_bytes, initializer=None, initargs=()):
+    """
+    Limits the address space of the worker with RLIMIT_AS, so a task that needs more fails with a
+    MemoryError in that worker instead of growing without bound. A warning is printed where the
+    limit can't be set or would not be enforced.
+    """
+    if max_worker_memory_bytes is not None and can_limit_worker_memory():
+        _, hard_limit = resource.getrlimit(resource.RLIMIT_AS)
+        limit = max_worker_memory_bytes if hard_limit == resource.RLIM_INFINITY else min(max_worker_memory_bytes, hard_limit)
+        try:
+            resource.setrlimit(resource.RLIMIT_AS, (limit, hard_limit))
+        except (ValueError, OSError) as e:
+            print(f"Warning: could not limit the worker memory: {e}")
+        else:
+            if resource.getrlimit(resource.RLIMIT_AS)[0] != limit:
+                print("Warning: the worker memory limit was not applied")
+    if initializer is not None:
+        initializer(*initargs)
+
+# This function will run one task in a worker and report the worker's memory with the result
+def run_indexed_task(func, indexed_task):
+    """
+    :return: A tuple (index, worker RSS, result, error). A task over the memory limit gives a
+             result of None and an error message, the worker carries on with the next task.
+    """
+    index, task = indexed_task
+    try:
+        result = func(task)
+    except MemoryError:
+        return index, get_process_rss(), None, f"Task {index} went over the worker memory limit"
+    return index, get_process_rss(), result, None
+
+# This function will run a chunk of tasks in a worker
+def run_indexed_chunk(func, indexed_tasks):
+    return [run_indexed_task(func, indexed_task) for indexed_task in indexed_tasks]
+
+# This class will run the conversion tasks in a process pool
+class ConversionExecutor:
+    """
+    Process pool for the conversion jobs, with the knobs the default multiprocessing.Pool() lacks.
+
+    - Results come back as soon as each chunk of `chunk_size` tasks is done, so one slow volume
+      does not hold back the others.
+    - Tasks are started largest files first, so the longest ones don't end up last.
+    - Workers are replaced after `max_tasks_per_child` tasks, which returns their memory (this
+      needs Python 3.11; the workers are then started with spawn).
+    - With `max_worker_memory_bytes`, every worker's address space is capped (see init_worker).
+      A task that goes over fails on its own and is left out of the results (its scan stays
+      unfinished and is redone by the next run); the other tasks and workers are not affected.
+      The limit is an address space budget, not a resident memory one: memory-mapped files
+      (the volume cache, Analyze images, lazily loaded NIfTI volumes) and the address space the
+      interpreter and its libraries reserve count towards it, so size it above the resident
+      memory a scan needs plus the largest volume mapped. It is not enforced on macOS or Windows.
+    - A worker killed by the OS (or crashing in a C extension) stops the job with
+      BrokenProcessPool instead of leaving it waiting for the lost tasks.
+    - A one-line summary of the progress is printed every `progress_interval` seconds.
+
+    Usage:
+        executor = ConversionExecutor(num_workers=8, chunk_size=2, max_tasks_per_child=50)
+        for result in executor.map_unordered(process_func, tasks, init_label_lookup, (label_lookup,)):
+            ...
+    """
+
+    def __init__(self, num_workers=None, chunk_size=1, max_tasks_per_child=None, max_worker_memory_bytes=None, progress_interval=30.0, largest_first=True):
+        """
+        Parameters:
+        - num_workers: Worker processes (all CPUs by default).
+        - chunk_size: Tasks sent to a worker at a time.
+        - max_tasks_per_child: Tasks a worker runs before it is replaced (None keeps the workers).
+        - max_worker_memory_bytes: Address space budget of each worker in bytes (None for no limit).
+        - progress_interval: Seconds between progress summaries.
+        - largest_first: Start the tasks with the largest files first.
+        """
+        self.num_workers = num_workers or os.cpu_count()
+        self.chunk_size = max(int(chunk_size), 1)
+        self.max_tasks_per_child = max_tasks_per_child
+        self.max_worker_memory_bytes = max_worker_memory_bytes
+        self.progress_interval = progress_interval
+        self.largest_first = largest_first
+
+        if max_worker_memory_bytes is not None and not can_limit_worker_memory():
+            print(f"Warning: the worker memory limit is not enforced on {sys.platform}")
+        if max_tasks_per_child is not None and sys.version_info < (3, 11):
+            print("Warning: replacing workers after max_tasks_per_child tasks needs Python 3.11, the workers are kept")
+            self.max_tasks_per_child = None
+
+    # This function will print a progress summary
+    def print_progress(self, description, completed, total, start_time, failed, peak_rss):
+        elapsed = time.perf_counter() - start_time
+        rate = completed / elapsed if elapsed > 0 else 0.0
+        remaining_text = f", about {(total - completed) / rate:.0f}s left" if rate > 0 else ""
+        failed_text = f", {failed} over the memory limit" if failed else ""
+        print(f"{description}: {completed}/{total} done in {elapsed:.0f}s, {rate:.2f}/s{remaining_text}{failed_text}, peak worker RSS {peak_rss / 2**20:.0f} MB")
+
+    # This function will run func on every task and yield the results as they are done
+    def map_unordered(self, func, tasks, initializer=None, initargs=(), get_task_size=get_scan_task_size, description='Conversion'):
+        """
+        Parameters:
+        - func: Picklable function of one task, e.g. a functools.partial of process_file.
+        - tasks: The tasks.
+        - initializer, initargs: Run once in every worker, like multiprocessing.Pool's.
+        - get_task_size: Function of a task giving its size, for the largest first order.
+        - description: Name of the job in the progress summaries.
+
+        Returns:
+        - A generator of the results, in the order the tasks finish (without the tasks over the memory limit).
+        """
+        tasks = list(tasks)
+        total = len(tasks)
+        order = list(range(total))
+        if self.largest_first and get_task_size is not None:
+            sizes = [get_task_size(task) for task in tasks]
+            order.sort(key=lambda index: sizes[index], reverse=True)
+
+        completed, failed, peak_rss = 0, 0, 0
+        start_time = last_progress = time.perf_counter()
+        run_func = partial(run_indexed_chunk, func)
+        chunks = [[(index, tasks[index]) for index in order[start:start + self.chunk_size]] for start in range(0, total, self.chunk_size)]
+
+        if total:
+            num_workers = max(min(self.num_workers, len(chunks)), 1)
+            pool_options = {'max_tasks_per_child': self.max_tasks_per_child} if self.max_tasks_per_child is not None else {}
+            pool = ProcessPoolExecutor(num_workers, initializer=init_worker, initargs=(self.max_worker_memory_bytes, initializer, initargs), **pool_options)
+            try:
+                # The chunks are queued in order, so the largest tasks are started first
+                pending = {pool.submit(run_func, chunk) for chunk in chunks}
+                while pending:
+                    done, pending = wait(pending, timeout=max(last_progress + self.progress_interval - time.perf_counter(), 0.1), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        for index, rss, result, error in future.result():
+                            completed += 1
+                            peak_rss = max(peak_rss, rss)
+                            if error is not None:
+                                print(error)
+                                failed += 1
+                            else:
+                                yield result
+
+                    if time.perf_counter() - last_progress >= self.progress_interval:
+                        last_progress = time.perf_counter()
+                        self.print_progress(description, completed, total, start_time, failed, peak_rss)
+            except BrokenProcessPool:
+                print(f"{description}: a worker was killed (e.g. by the OS when out of memory) with {total - completed} tasks left; the finished ones are kept, run again to continue")
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+            except BaseException:
+                # An error or a consumer that stops early ends the job
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+            pool.shutdown()
+
+            self.print_progress(description, completed, total, start_time, failed, peak_rss)
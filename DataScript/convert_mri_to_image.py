@@ -3,6 +3,7 @@
 import os
 import sys
 import pathlib
+import argparse
 import matplotlib
 # Append the parent folder to the python path 
 # Get the current notebook's path
@@ -14,6 +15,7 @@ sys.path.append(str(pathlib.Path(notebook_path).parent.resolve()))
 matplotlib.use('Agg')
 
 # FROM .py SCRIPT
+from DataScript.conversion_executor import *
 from DataScript.create_data_folders import *
 from DataScript.display_images import *
 from DataScript.get_data_stats import *
@@ -21,13 +23,31 @@ from DataScript.get_patient_data import *
 from DataScript.load_and_read_data import *
 from DataScript.load_metadata import *
 from DataScript.neuroimaging_slices import *
+from DataScript.scan_catalog import *
+from DataScript.shard_partition import *
 
 #################### FUNCTIONS ####################
 
 if __name__ == "__main__":
-    
+
+    parser = argparse.ArgumentParser(description='Convert the neuroimaging data under <root_directory>/Original into images under <root_directory>/Preprocessed')
+    parser.add_argument('root_directory', type=str, help="Root directory holding the Original folder.")
+    parser.add_argument('--reuse-manifest', action='store_true', help="Reuse the saved scan manifest instead of walking the root directory again.")
+    parser.add_argument('--output-format', choices=['png', 'shards', 'hdf5'], default='png', help="Save one PNG per slice, 128x128 uint8 slices in .npy shards with an index csv, or 128x128 uint8 slices in Preprocessed/slices.h5.")
+    parser.add_argument('--slices-per-shard', type=int, default=4096, help="Number of slices per shard with --output-format shards.")
+    parser.add_argument('--store-modality', type=str, default='MRI', help="Modality group of the scans with --output-format hdf5 (MRI or CT).")
+    parser.add_argument('--png-side-output', action='store_true', help="With --output-format shards or hdf5, also save the slices as PNG images.")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (all CPUs by default).")
+    parser.add_argument('--chunk-size', type=int, default=1, help="Number of scans sent to a worker at a time.")
+    parser.add_argument('--max-tasks-per-child', type=int, default=None, help="Replace a worker after this many scans to return its memory.")
+    parser.add_argument('--max-worker-memory-mb', type=int, default=None, help="Address space budget of each worker in MB (RLIMIT_AS, so memory-mapped volumes count too; not enforced on macOS or Windows). A scan that needs more fails on its own and is redone by the next run.")
+    parser.add_argument('--progress-interval', type=float, default=30.0, help="Seconds between progress summaries.")
+    parser.add_argument('--shard', type=parse_shard, default=None, help="Convert only shard i of n (e.g. 0/4), the subjects whose OASISID hashes to i. Each machine runs one shard.")
+    parser.add_argument('--merge-shards', action='store_true', help="Merge the outputs of the finished shards and build the scan catalog, without converting.")
+    args = parser.parse_args()
+
     # Get root directory from cmdline
-    root_directory = sys.argv[1]
+    root_directory = args.root_directory
 
     # Path for the original data
     original_data_path = root_directory + '/Original/'
@@ -39,18 +59,44 @@ if __name__ == "__main__":
     if not os.path.exists(preprocessed_data_path):
         os.makedirs(preprocessed_data_path)
 
-    # Create the folders for the preprocessed data
+    # Create the folders for the preprocessed data (the shards are all in one folder)
     # create_categories_folders(preprocessed_data_path)
-    create_full_folders_folders(preprocessed_data_path)
+    if args.output_format == 'png' or args.png_side_output:
+        create_full_folders_folders(preprocessed_data_path)
 
     # Check the folder structure of the original data
     # get_folder_structure(original_data_path)
 
+    # Walk the root directory once, every step below reads the manifest
+    manifest = load_or_build_scan_manifest(root_directory, get_shard_path(preprocessed_data_path + 'scan_manifest.csv', args.shard), refresh=not args.reuse_manifest)
+
+    # Load the CDR tables once for the reference dataframe and the catalog
+    cdr_dfs = load_cdr_dataframes(root_directory, manifest)
+
+    if args.merge_shards:
+        # Combine the reference dataframes and outputs of the shards, then catalog every scan once
+        ref_df = merge_shard_outputs(preprocessed_data_path)
+        with build_scan_catalog(root_directory, preprocessed_data_path + 'scan_catalog.sqlite', manifest, ref_df, cdr_dfs) as catalog:
+            print(f"Scan catalog: {len(catalog.get_sessions())} sessions")
+        sys.exit(0)
+
+    # Only the subjects of the shard are converted (the clinical data is kept)
+    manifest = filter_manifest_to_shard(manifest, args.shard)
+
     # Create a reference dataframe for the original data
-    ref_df = create_ref_df(root_directory)
+    ref_df = create_ref_df(root_directory, manifest, cdr_dfs)
 
     # Save the reference dataframe as a csv file
-    ref_df.to_csv(preprocessed_data_path + 'nii_ref_df.csv', index=False)
+    ref_df.to_csv(get_shard_path(preprocessed_data_path + 'nii_ref_df.csv', args.shard), index=False)
+
+    # Update the queryable scan catalog with the new scans and their labels (once for all shards, by --merge-shards)
+    # and label the scans from it; the shards label their scans from their reference dataframe
+    label_lookup = None
+    if args.shard is None:
+        with build_scan_catalog(root_directory, preprocessed_data_path + 'scan_catalog.sqlite', manifest, ref_df, cdr_dfs) as catalog:
+            print(f"Scan catalog: {len(catalog.get_sessions())} sessions")
+            label_lookup = catalog.label_lookup()
 
     # Convert the neuroimaging data to images
-    convert_nueoimaging_to_images(original_data_path, preprocessed_data_path, ref_df)
+    executor = ConversionExecutor(args.workers, args.chunk_size, args.max_tasks_per_child, args.max_worker_memory_mb * 2**20 if args.max_worker_memory_mb else None, args.progress_interval)
+    convert_nueoimaging_to_images(original_data_path, preprocessed_data_path, ref_df, manifest, args.output_format, args.slices_per_shard, args.store_modality, args.png_side_output, executor, args.shard, label_lookup)
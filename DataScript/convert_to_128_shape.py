@@ -1,64 +1,147 @@
-import numpy as np
-from PIL import Image, UnidentifiedImageError
+#################### IMPORTS ####################
+# ALL
 import os
-import sys
-import shutil
-# Define the main directory where the original images are located and the results directory
+import time
+import argparse
+import multiprocessing
+
+# FROM
+from functools import partial
+from PIL import Image, UnidentifiedImageError
 
-root_dir = sys.argv[1]
-main_dir = root_dir + "/Original/"
-results_dir = root_dir + "/RESULTS/"
+#################### SETTINGS ####################
+
+# Category folders to resize and their labels
 categories = {
-    "non-demented" : 0,
-        "very-mild-dementia" : 1,
-        "mild-dementia" : 2,
-        "moderate-dementia" : 3,
-        "unknown" : 4,
+    "non-demented": 0,
+    "very-mild-dementia": 1,
+    "mild-dementia": 2,
+    "moderate-dementia": 3,
+    "unknown": 4,
 }
-data = []
-result = []
 
+#################### FUNCTIONS ####################
+
+# This function will list the images to resize, leaving out the ones already resized
+def get_resize_jobs(main_dir, results_dir, category_names=categories, force=False):
+    """
+    Lists the images of each category folder of main_dir with the path of their resized copy in
+    results_dir. An image is skipped if its resized copy is newer than it, unless `force` is set.
+
+    :return: A tuple (jobs, skipped) where jobs is a list of (image path, results path).
+    """
+    jobs = []
+    skipped = 0
+    for category in category_names:
+        category_main_dir = os.path.join(main_dir, category)
+        if not os.path.isdir(category_main_dir):
+            print(f"Folder '{category_main_dir}' not found, skipping...")
+            continue
+
+        # Create the category directory in the results folder if it doesn't exist
+        category_results_dir = os.path.join(results_dir, category)
+        os.makedirs(category_results_dir, exist_ok=True)
+
+        with os.scandir(category_main_dir) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                results_path = os.path.join(category_results_dir, entry.name)
+                if not force:
+                    try:
+                        if os.stat(results_path).st_mtime_ns >= entry.stat().st_mtime_ns:
+                            skipped += 1
+                            continue
+                    except FileNotFoundError:
+                        pass
+                jobs.append((entry.path, results_path))
+
+    # Larger files first, so a slow image doesn't hold up the end of the run
+    jobs.sort(key=lambda job: os.path.getsize(job[0]), reverse=True)
+    return jobs, skipped
+
+# This function will resize one image
+def resize_image(job, image_size=(128, 128), reducing_gap=3.0, exact=False):
+    """
+    Resizes an image and saves it. JPEGs are decoded at a reduced scale with `draft`, and large
+    downscales first reduce the image by an integer factor (`reducing_gap`) before the resampling
+    filter. `exact` turns both fast paths off and resamples from the full image. The image is written to a temporary file and renamed, so an
+    interrupted run never leaves a half-written image that looks up to date.
+
+    :param job: A tuple (image path, results path).
+    :return: A tuple (image path, bytes read, error message or None).
+    """
+    path, results_path = job
+    try:
+        with Image.open(path) as img:
+            if not exact:
+                img.draft(img.mode, image_size)
+            img = img.resize(image_size, reducing_gap=None if exact else reducing_gap)
+
+        root, extension = os.path.splitext(results_path)
+        tmp_path = f"{root}.tmp{extension}"
+        img.save(tmp_path)
+        os.replace(tmp_path, results_path)
+        return path, os.path.getsize(path), None
 
-# Assuming 'categories' is a dictionary that holds categories as keys and labels as values
-for category, label in categories.items():
-    print(f"Processing category: {category}")
+    except UnidentifiedImageError:
+        return path, 0, f"Unable to identify image file: {path}"
+    except Exception as e:
+        return path, 0, f"An error occurred while processing {path}: {e}"
 
-    # Construct paths for the current category in both main and results directories
-    category_main_dir = os.path.join(main_dir, category)
-    category_results_dir = os.path.join(results_dir, category)
+# This function will resize the images of every category folder in parallel
+def convert_to_128_shape(root_dir, image_size=(128, 128), num_workers=None, chunk_size=32, force=False, reducing_gap=3.0, exact=False):
+    """
+    Resizes the images in <root_dir>/Original/<category> into <root_dir>/RESULTS/<category>.
+    Images resized by an earlier run are skipped, so only new or changed images are done again.
 
-    # Create the category directory in the results folder if it doesn't exist
-    os.makedirs(category_results_dir, exist_ok=True)
+    Parameters:
+    - root_dir: Folder holding the Original folder.
+    - image_size: (width, height) of the resized images.
+    - num_workers: Worker processes (all CPUs by default).
+    - chunk_size: Images per worker task.
+    - force: Resize every image even if its resized copy is up to date.
+    - reducing_gap, exact: See resize_image.
 
-    # Get a list of all image files in the category's main directory
-    image_paths = [os.path.join(category_main_dir, f) for f in os.listdir(category_main_dir) if os.path.isfile(os.path.join(category_main_dir, f))]
-    total_paths = len(image_paths)
-    processed_paths = 0
+    Returns:
+    - A dictionary with the number of resized, skipped and failed images and the time taken.
+    """
+    main_dir = os.path.join(root_dir, "Original")
+    results_dir = os.path.join(root_dir, "RESULTS")
 
-    for path in image_paths:
-        try:
-            # Open and resize the image
-            img = Image.open(path)
-            img = img.resize((128, 128))
+    start_time = time.perf_counter()
+    jobs, skipped = get_resize_jobs(main_dir, results_dir, categories, force)
+    print(f"{len(jobs)} images to resize, {skipped} already up to date")
 
-            # Construct the corresponding results path for the resized image
-            relative_path = os.path.relpath(path, main_dir)  # Get the relative path from the main directory
-            results_path = os.path.join(results_dir, relative_path)  # Construct the results path
+    resized, failed, bytes_read = 0, 0, 0
+    if jobs:
+        num_workers = min(num_workers or os.cpu_count(), len(jobs))
+        resize = partial(resize_image, image_size=tuple(image_size), reducing_gap=reducing_gap, exact=exact)
+        with multiprocessing.Pool(num_workers) as pool:
+            for path, size, error in pool.imap_unordered(resize, jobs, chunksize=chunk_size):
+                if error is not None:
+                    print(error)
+                    failed += 1
+                    continue
+                resized += 1
+                bytes_read += size
 
-            # Save the resized image in the results directory
-            img.save(results_path)
+    elapsed = time.perf_counter() - start_time
+    rate = resized / elapsed if elapsed > 0 else 0.0
+    print(f"Resized {resized} images ({failed} failed, {skipped} skipped) in {elapsed:.1f}s: "
+          f"{rate:.1f} images/s, {bytes_read / max(elapsed, 1e-9) / 2**20:.1f} MB/s read")
 
-            # Update your data and result lists, assuming you need to keep the resized images in memory
-            img_array = np.array(img)[:,:,:3]
-            # data.append(img_array)
-            # result.append(label)
+    return {'resized': resized, 'skipped': skipped, 'failed': failed, 'seconds': elapsed}
 
-            processed_paths += 1
-            print(f"Processed {processed_paths}/{total_paths} images in category '{category}'")
+if __name__ == "__main__":
 
-        except UnidentifiedImageError:
-            print(f"Unable to identify image file: {path}")
-        except Exception as e:
-            print(f"An error occurred while processing {path}: {e}")
+    parser = argparse.ArgumentParser(description='Resize the images under <root_directory>/Original/<category> into <root_directory>/RESULTS/<category>')
+    parser.add_argument('root_directory', type=str, help="Root directory holding the Original folder.")
+    parser.add_argument('--size', type=int, nargs=2, default=[128, 128], metavar=('WIDTH', 'HEIGHT'), help="Size of the resized images.")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (all CPUs by default).")
+    parser.add_argument('--chunk-size', type=int, default=32, help="Number of images per worker task.")
+    parser.add_argument('--force', action='store_true', help="Resize every image, even the ones whose resized copy is newer.")
+    parser.add_argument('--exact', action='store_true', help="Resample from the full image without the draft and reduce fast paths.")
+    args = parser.parse_args()
 
-    print(f"Completed processing category: {category}")
+    convert_to_128_shape(args.root_directory, args.size, args.workers, args.chunk_size, args.force, exact=args.exact)
@@ -16,6 +16,7 @@ from tqdm import tqdm
 
 # FROM .py SCRIPT
 from DataScript.extract_slices import *
+from DataScript.volume_cache import *
 
 #################### FUNCTIONS ####################
 
@@ -88,9 +89,9 @@ def display_sample_slice_images(ref_df, cmap='gray', title='MRI Slices'):
         # Title should be the "file_name_wout_format" column from sample
         title = samples[samples["path"] == sample_path]["file_name_wout_format"].values[0]
 
-        # Load the NIfTI file
-        nii_data = nib.load(sample_path)
-        img_data = nii_data.get_fdata()
+        # Load the NIfTI file through the volume cache, only the three middle slices are read
+        nii_data = load_cached_nii(sample_path)
+        img_data = nii_data.dataobj
 
         # Calculate the middle slice index for each orientation
         sagittal_middle = img_data.shape[0] // 2
@@ -98,9 +99,9 @@ def display_sample_slice_images(ref_df, cmap='gray', title='MRI Slices'):
         axial_middle = img_data.shape[2] // 2
 
         # Extract the middle slice for each orientation
-        sagittal_slice = img_data[sagittal_middle, :, :]
-        coronal_slice = img_data[:, coronal_middle, :]
-        axial_slice = img_data[:, :, axial_middle]
+        sagittal_slice = np.asarray(img_data[sagittal_middle, :, :], dtype=np.float64)
+        coronal_slice = np.asarray(img_data[:, coronal_middle, :], dtype=np.float64)
+        axial_slice = np.asarray(img_data[:, :, axial_middle], dtype=np.float64)
 
         # Plotting the slices
         fig, axes = plt.subplots(1, 3, figsize=(15, 5))
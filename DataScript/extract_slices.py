@@ -3,6 +3,9 @@
 import numpy as np
 import nibabel as nib
 
+# FROM .py SCRIPT
+from DataScript.volume_cache import *
+
 #################### FUNCTIONS ####################
 
 def get_orientation(affine):
@@ -60,7 +63,7 @@ def guess_orientation_and_extract_all_slices(img_data):
 
 
 def guess_orientation_and_extract_slices(nii_path):
-    nii_data = nib.load(nii_path)
+    nii_data = load_cached_nii(nii_path)
     img_data = nii_data.get_fdata()
 
     # Guess orientations based on dimensions
@@ -48,6 +48,8 @@ def get_nii_data_stats(images, labels, paths):
     means, stds, skewnesses = [], [], []
     
     for image in tqdm(images):
+        # Lazy volumes are only read here, one at a time
+        image = np.asarray(image)
         means.append(np.mean(image))
         stds.append(np.std(image))
         image_hist = np.histogram(image.flatten())[0]
@@ -0,0 +1,79 @@
+#################### IMPORTS ####################
+# AS
+import numpy as np
+import pandas as pd
+
+#################### FUNCTIONS ####################
+
+# This function will match every scan to the closest clinical assessment of its subject within a window of days
+def window_join(scans, assessments, lower_bound, upper_bound, by='OASISID', day_column='days_to_visit', suffix='_clinical_assesment_day'):
+    """
+    Adds to `scans` the columns of the closest assessment of the same subject with
+    scan day - upper_bound < assessment day < scan day + lower_bound, like merge_asof with a
+    window on both sides. The assessments are sorted once and every scan is looked up with one
+    searchsorted, instead of a mask over all the scans for every assessment.
+
+    Parameters:
+    - scans: DataFrame with the `by` and `day_column` columns. The columns are added to it in place.
+    - assessments: DataFrame with the `by` and `day_column` columns, e.g. a CDR table.
+    - lower_bound: Days after the scan an assessment may be.
+    - upper_bound: Days before the scan an assessment may be.
+    - by: Column of the subject both dataframes are matched on.
+    - day_column: Column of the day in both dataframes.
+    - suffix: Added to the names of the assessment columns.
+
+    Returns:
+    - scans, with a <column><suffix> column for every assessment column (NaN where no assessment is in
+      the window). When two assessments are equally close, the later one is used.
+    """
+    assessment_days = pd.to_numeric(assessments[day_column], errors='coerce').to_numpy(dtype=np.float64)
+    usable = assessments[by].notna().to_numpy() & ~np.isnan(assessment_days)
+    assessments = assessments[usable]
+    assessment_days = assessment_days[usable]
+
+    scan_days = pd.to_numeric(scans[day_column], errors='coerce').to_numpy(dtype=np.float64)
+    best = np.full(len(scans), -1, dtype=np.int64)
+
+    if len(assessments) and len(scans):
+        # One code per subject; scans of a subject without assessments get -1
+        assessment_codes, subjects = pd.factorize(assessments[by])
+        scan_codes = pd.Index(subjects).get_indexer(scans[by])
+        scan_codes[np.isnan(scan_days)] = -1
+
+        # Sort by subject then day (stable, so equal days keep the order of the table)
+        order = np.lexsort((assessment_days, assessment_codes))
+        sorted_codes = assessment_codes[order]
+        sorted_days = assessment_days[order]
+        group_starts = np.searchsorted(sorted_codes, np.arange(len(subjects)), side='left')
+        group_ends = np.searchsorted(sorted_codes, np.arange(len(subjects)), side='right')
+
+        # Search a (subject, day) key in one array: each subject gets its own range of days
+        matched = scan_codes >= 0
+        codes = scan_codes[matched]
+        days = scan_days[matched]
+        all_days = np.concatenate([sorted_days, days])
+        day_offset = all_days.min()
+        day_span = all_days.max() - day_offset + 1
+        positions = np.searchsorted(sorted_codes * day_span + (sorted_days - day_offset), codes * day_span + (days - day_offset), side='left')
+
+        # The closest assessments are the last one before the scan day and the first one from it on
+        starts, ends = group_starts[codes], group_ends[codes]
+        before = positions - 1
+        after = positions
+        before_ok = before >= starts
+        after_ok = after < ends
+        before_days = sorted_days[np.clip(before, 0, len(sorted_days) - 1)]
+        after_days = sorted_days[np.clip(after, 0, len(sorted_days) - 1)]
+        before_ok &= (before_days > days - upper_bound) & (before_days < days + lower_bound)
+        after_ok &= (after_days > days - upper_bound) & (after_days < days + lower_bound)
+
+        use_after = after_ok & (~before_ok | (after_days - days <= days - before_days))
+        chosen = np.where(use_after, after, np.where(before_ok, before, -1))
+        best[matched] = np.where(chosen >= 0, order[np.clip(chosen, 0, len(order) - 1)], -1)
+
+    # Row -1 is not in the index, so the scans without a match get NaN
+    matches = assessments.reset_index(drop=True).reindex(best)
+    for name in assessments.columns:
+        scans[name + suffix] = matches[name].to_numpy()
+
+    return scans
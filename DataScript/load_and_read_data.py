@@ -16,6 +16,8 @@ from tqdm import tqdm
 
 # FROM FILE
 from DataScript.load_metadata import *
+from DataScript.volume_cache import *
+from DataScript.parallel_decode import *
 
 #################### FUNCTIONS ####################
 
@@ -35,22 +37,29 @@ def load_images_from_folders(root_dir, folder_names):
     return images_dict
 
 # Load the files based on their extension
-def load_files_with_extension(folder_path, extension):
-    """Load NIfTI files and their corresponding metadata from the given folder."""
+def load_files_with_extension(folder_path, extension, manifest=None):
+    """
+    Load NIfTI files and their corresponding metadata from the given folder.
+    `manifest` is a scan manifest (see scan_manifest.py) to use instead of walking the folder.
+    """
     nifti_files = []
     nifti_files_with_path = []
 
-    for root, dirs, files in os.walk(folder_path):
-        for file in files:
+    if manifest is None:
+        manifest = build_scan_manifest(folder_path)
+    else:
+        manifest = manifest_files_under(manifest, folder_path)
+
+    for file, file_path in zip(manifest['name'], manifest['path']):
 
-            if file.endswith(extension):
-                # If os.path.join(root, file) containns 'PROCESSED' or 'FSL_SEG', skip
-                if 'PROCESSED' in os.path.join(root, file) or 'FSL_SEG' in os.path.join(root, file):
-                    continue
+        if file.endswith(extension):
+            # If os.path.join(root, file) containns 'PROCESSED' or 'FSL_SEG', skip
+            if 'PROCESSED' in file_path or 'FSL_SEG' in file_path:
+                continue
 
-                # Special handling for '.nii.gz' extension
-                nifti_files.append(remove_file_extension(file))
-                nifti_files_with_path.append(os.path.join(root, file))
+            # Special handling for '.nii.gz' extension
+            nifti_files.append(remove_file_extension(file))
+            nifti_files_with_path.append(file_path)
 
 
     return nifti_files, nifti_files_with_path
@@ -71,51 +80,149 @@ def load_image(file_path):
     return np.array(Image.open(file_path).convert('L'))
 
 # This function will load multiple images
-def load_multiple_images(ref_df):
-    labels = []
-    images = []
-    paths = []
+def load_multiple_images(ref_df, image_size=None, num_workers=None, chunk_size=512):
+    """
+    Loads grayscale images with the parallel decode pool (see parallel_decode.py).
+
+    :param image_size: (height, width) to resize to. None keeps the size of the first image; images
+                       of another size are then read here one at a time, at their own size.
+    :param num_workers: Decode processes (all CPUs by default, 0 decodes in this process).
+    :return: A tuple (images, labels, paths).
+    """
+    paths = ref_df['path'].tolist()
+    labels = ref_df['label'].tolist()
+    if len(paths) == 0:
+        return [], labels, paths
 
     # to only load a subset of images
     # ref_df = ref_df.sample(n=100)
-    for idx, row in tqdm(ref_df.iterrows(), total=ref_df.shape[0]):
-        images.append(np.array(Image.open(row['path']).convert('L')))
-        labels.append(row['label'])
-        paths.append(row['path'])
+    decoded, ok = decode_images(paths, image_size=image_size, mode='L', channels=None, num_workers=num_workers, chunk_size=chunk_size)
+    images = list(decoded)
+    for idx in np.flatnonzero(~ok):
+        images[idx] = load_image(paths[idx])
     
     return images, labels, paths
 
+# Mapping of the dtype choices for neuroimaging data to numpy dtypes
+# 'native' keeps the on-disk dtype of the volume (after scaling)
+nii_dtypes = {
+    'native': None,
+    'float32': np.float32,
+    'float64': np.float64,
+    }
+
+# This class will wrap the image proxy so the volume is only read when it is touched
+class LazyNiiVolume:
+    """
+    Array-like view over a nibabel image proxy (`nib.load(...).dataobj`).
+
+    Indexing reads only the requested part of the volume from disk and casts it
+    to the chosen dtype. Converting with `np.asarray` reads the full volume.
+    """
+    def __init__(self, dataobj, dtype=None):
+        self.dataobj = dataobj
+        self._dtype = None if dtype is None else np.dtype(dtype)
+
+    @property
+    def shape(self):
+        return self.dataobj.shape
+
+    @property
+    def ndim(self):
+        return len(self.dataobj.shape)
+
+    @property
+    def dtype(self):
+        return self._dtype if self._dtype is not None else self.dataobj.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, slicer):
+        return np.asarray(self.dataobj[slicer], dtype=self._dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.dataobj, dtype=dtype if dtype is not None else self._dtype)
+
+    def take(self, index, axis=0):
+        slicer = [slice(None)] * self.ndim
+        slicer[axis] = index
+        return self[tuple(slicer)]
+
+# This function will return the image data without reading it into memory
+def get_lazy_nii_data(nii_img, dtype='native'):
+    """
+    Returns the data of a loaded NIfTI/Analyze image without reading it into memory.
+
+    Uncompressed, unscaled volumes in their native dtype come back as a read-only
+    np.memmap. Everything else comes back as a LazyNiiVolume over the image proxy.
+
+    :param nii_img: An image returned by nib.load.
+    :param dtype: One of 'native', 'float32' or 'float64'.
+    :return: A memmap or LazyNiiVolume with the same shape as the volume.
+    """
+    if dtype not in nii_dtypes:
+        raise ValueError(f"Unknown dtype '{dtype}'. Please use one of {list(nii_dtypes)}.")
+
+    dataobj = nii_img.dataobj
+    if not nib.is_proxy(dataobj):
+        # The image was built from an array (or memmap) already
+        return dataobj if dtype == 'native' else LazyNiiVolume(dataobj, nii_dtypes[dtype])
+
+    if dtype == 'native' and getattr(dataobj, 'is_proxy', False):
+        # Only the uncompressed and unscaled files can be mapped directly
+        file_like = getattr(dataobj, 'file_like', None)
+        unscaled = getattr(dataobj, 'slope', 1.0) == 1.0 and getattr(dataobj, 'inter', 0.0) == 0.0
+        if isinstance(file_like, str) and not file_like.endswith('.gz') and unscaled:
+            data = np.asanyarray(dataobj)
+            if isinstance(data, np.memmap):
+                return data
+
+    return LazyNiiVolume(dataobj, nii_dtypes[dtype])
+
 # This function will load a neuroimaging data
-def load_nii_data(file_path):
-    mri = nib.load(file_path)
+def load_nii_data(file_path, lazy=False, dtype='float64'):
+    """
+    Loads the data of a neuroimaging file.
+
+    :param file_path: Path to the .nii/.nii.gz/.img file.
+    :param lazy: If True, return a memmap or LazyNiiVolume instead of reading the full volume.
+    :param dtype: One of 'native', 'float32' or 'float64'.
+    :return: The volume data.
+    """
+    # .nii.gz files are inflated once and memory-mapped from the volume cache afterwards
+    mri = load_cached_nii(file_path)
+
+    if lazy:
+        return get_lazy_nii_data(mri, dtype)
 
     # Extracting data from an MRI scan: .get_fdata()
-    extracted_data = mri.get_fdata()
+    if dtype == 'native':
+        return np.asanyarray(mri.dataobj)
+    if dtype not in nii_dtypes:
+        raise ValueError(f"Unknown dtype '{dtype}'. Please use one of {list(nii_dtypes)}.")
+    extracted_data = mri.get_fdata(dtype=nii_dtypes[dtype])
     return extracted_data
 
 # This function will load multiple neuroimaging data
-def load_multiple_nii_data(ref_df):
+def load_multiple_nii_data(ref_df, lazy=False, dtype='float64'):
     images = []
     labels = []
     paths = []
-    mri_images_data = []
-    for idx, row in tqdm(ref_df.iterrows(), total=ref_df.shape[0]):
+    for path, label in tqdm(zip(ref_df['path'], ref_df['label']), total=ref_df.shape[0]):
         # For neuroimaging data (e.g., MRI scans in NIFTI format), use nibabel
-        mri = nib.load(row['path'])
-        img = mri.get_fdata() 
-        images.append(img)
-        labels.append(row['label'])
-        paths.append(row['path'])
-        mri_images_data.append(img)
+        images.append(load_nii_data(path, lazy=lazy, dtype=dtype))
+        labels.append(label)
+        paths.append(path)
     return images, labels, paths
 
 # This function will load the data
-def load_data(ref_df, numbers='single'):
+def load_data(ref_df, numbers='single', lazy=False, dtype='float64'):
 
     if numbers == 'multi':
         file_format = ref_df['file_format']
         if (file_format == 'img').all():
-            images, labels, paths = load_multiple_nii_data(ref_df)
+            images, labels, paths = load_multiple_nii_data(ref_df, lazy=lazy, dtype=dtype)
             return images, labels, paths
         elif (file_format == 'jpg').all() or (file_format == 'png').all() or (file_format == 'jpeg').all():
             images, labels, paths = load_multiple_images(ref_df)
@@ -130,7 +237,7 @@ def load_data(ref_df, numbers='single'):
         # extract the file format from str as last 3 characters
         file_format = extract_file_format(ref_df)
         if (file_format == 'img'):
-            return load_nii_data(ref_df)
+            return load_nii_data(ref_df, lazy=lazy, dtype=dtype)
         elif (file_format == 'jpg') or (file_format == 'png') or (file_format == 'jpeg'):
             return load_image(ref_df)
         elif (file_format == 'csv'):
@@ -20,6 +20,8 @@ from tqdm import tqdm
 
 # FROM FILE
 from DataScript.get_patient_data import *
+from DataScript.interval_join import *
+from DataScript.scan_manifest import *
 
 #################### FUNCTIONS ####################
 
@@ -244,14 +246,18 @@ def get_info_from_filename(filename):
     return None, None, None, None, None, None, None, None, None, None, None, None, None
 
 # This function will return the file path
-def find_file_paths(root_folder, filename):
+def find_file_paths(root_folder, filename, manifest=None):
     """
     Finds paths to a file within the root folder.
 
     :param root_folder: The root directory to search in.
     :param filename: The name of the file to search for.
+    :param manifest: Scan manifest (see scan_manifest.py) to search instead of walking the folder.
     :return: A list of full paths to files matching the filename within the root folder.
     """
+    if manifest is not None:
+        return manifest_find_file_paths(manifest, root_folder, filename)
+
     matching_paths = []
     # Walk through all directories and files in root_folder
     for root, dirs, files in os.walk(root_folder):
@@ -306,13 +312,8 @@ def matching_up_the_data_upper_lower(scan_session_day, clinical_assesment_day, l
     # Update scan_session_day to only consider subjects that are in both lists
     # scan_session_day = scan_session_day.loc[scan_session_day['OASISID'].isin(clinical_assesment_day['OASISID'])]
 
-    # Create and populate the dataframe
-    for index, row in clinical_assesment_day.iterrows():
-        mask = (scan_session_day['OASISID'] == row['OASISID']) & ((scan_session_day['days_to_visit'] < row['days_to_visit'] + upper_bound) & (scan_session_day['days_to_visit'] > row['days_to_visit'] - lower_bound))   
-        for name in row.index:
-            scan_session_day.loc[mask, name +'_clinical_assesment_day'] = row[name]
-            
-    return scan_session_day
+    # Give every scan the closest assessment of its subject in the window (see interval_join.py)
+    return window_join(scan_session_day, clinical_assesment_day, lower_bound, upper_bound)
 
 def create_match_up_df(new_data_df, files_dictionary):
     # Create a mapping of file to label_id to avoid repeated .loc calls
@@ -329,10 +330,52 @@ def create_match_up_df(new_data_df, files_dictionary):
 
     return save_df
 
+# This function will find and load the CDR tables of every OASIS dataset under the root directory
+def load_cdr_dataframes(root_directory, manifest=None):
+    """
+    Load the CDR tables found under the root directory, with the columns renamed to
+    OASISID, CLINICALDATAID, days_to_visit and CDR where the table has them.
+
+    :param root_directory: The root directory holding the CDR files.
+    :param manifest: The scan manifest of root_directory; it is built (one walk) if not given.
+    :return: A dictionary of DataFrames keyed by 'OAS1', 'OAS2', 'OAS3', 'OAS3Unchanged' and 'OAS4'.
+    """
+    if manifest is None:
+        manifest = build_scan_manifest(root_directory)
+
+    # Find the CDR file paths
+    cdr_file_paths = {
+        'OAS1': find_file_paths(root_directory, 'oasis1_cross-sectional.csv', manifest),
+        'OAS2': find_file_paths(root_directory, 'oasis2_longitudinal_demographics.xlsx', manifest),
+        'OAS3': find_file_paths(root_directory, 'OASIS3_UDSb4_cdr.csv', manifest),
+        'OAS3Unchanged': find_file_paths(root_directory, 'OASIS3_unchanged_CDR_cognitively_healthy.csv', manifest), # OASIS3_id	Min of CDRTOT	Max of CDRTOT
+        'OAS4': find_file_paths(root_directory, 'OASIS4_data_CDR.csv', manifest)
+    }
+
+    # Pre-load CDR data frames if files exist
+    cdr_dfs = {}
+    if cdr_file_paths['OAS1']:
+        # copy ID column before changing the name 
+        cdr_dfs['OAS1'] = pd.read_csv(cdr_file_paths['OAS1'][0])
+        cdr_dfs['OAS1']['CLINICALDATAID'] = cdr_dfs['OAS1']['ID']
+        cdr_dfs['OAS1'] = cdr_dfs['OAS1'].rename(columns={'ID': 'OASISID'})
+    if cdr_file_paths['OAS2']:
+        cdr_dfs['OAS2'] = pd.read_excel(cdr_file_paths['OAS2'][0]).rename(columns={'Subject ID': 'OASISID', "MRI ID": "CLINICALDATAID"})
+    if cdr_file_paths['OAS3']:
+        cdr_dfs['OAS3'] = pd.read_csv(cdr_file_paths['OAS3'][0]).rename(columns={'OASISID': 'OASISID', 'CDRTOT': 'CDR', 'OASIS_session_label': 'CLINICALDATAID'})
+    if cdr_file_paths['OAS3Unchanged']:
+        cdr_dfs['OAS3Unchanged'] = pd.read_csv(cdr_file_paths['OAS3Unchanged'][0]).rename(columns={'OASIS3_id': 'OASISID', 'Max of CDRTOT': 'CDR'})
+    if cdr_file_paths['OAS4']:
+        cdr_dfs['OAS4'] = pd.read_csv(cdr_file_paths['OAS4'][0]).rename(columns={'oasis_id': 'OASISID', 'cdr_id': 'CLINICALDATAID', 'visit_days': 'days_to_visit', 'cdr': 'CDR'}) # convert dictionary to dataframe
+
+    return cdr_dfs
+
 # This function will create a reference dataframe
-def create_ref_df(root_directory):
+def create_ref_df(root_directory, manifest=None, cdr_dfs=None):
     """
     Create a reference dataframe with columns based on the file and folder structure.
+    `manifest` is the scan manifest of root_directory; it is built (one walk) if not given.
+    `cdr_dfs` are the CDR tables from load_cdr_dataframes; they are loaded if not given.
     """
 
     dataset_path = root_directory + '/Original/'
@@ -352,38 +395,23 @@ def create_ref_df(root_directory):
     #     cdr_csv = find_file_paths(dataset_path, 'oasis_longitudinal_demographics.xlsx')
     #     dcr_df = pd.read_excel(cdr_csv[0])
     
-    # Pre-fetch CDR file paths outside the loop
-    cdr_file_paths = {
-        'OAS1': find_file_paths(root_directory, 'oasis1_cross-sectional.csv'),
-        'OAS2': find_file_paths(root_directory, 'oasis2_longitudinal_demographics.xlsx'),
-        'OAS3': find_file_paths(root_directory, 'OASIS3_UDSb4_cdr.csv'),
-        'OAS3Unchanged': find_file_paths(root_directory, 'OASIS3_unchanged_CDR_cognitively_healthy.csv'), # OASIS3_id	Min of CDRTOT	Max of CDRTOT
-        'OAS4': find_file_paths(root_directory, 'OASIS4_data_CDR.csv')
-    }
+    # Walk the root directory once, every lookup below uses the manifest
+    if manifest is None:
+        manifest = build_scan_manifest(root_directory)
 
     # Collect all PNG files into a list
-    nii_gz_files = [(root, file) for root, dirs, files in os.walk(dataset_path) 
-                for file in files if ".nii.gz" in file or "img" in file or "hdr" in file  and file != ".DS_Store"]
+    # Skip the gzip index files saved next to the scans by open_indexed_nii_gz
+    dataset_manifest = manifest_files_under(manifest, dataset_path)
+    nii_gz_files = [(root, file) for root, file in zip(dataset_manifest['directory'], dataset_manifest['name'])
+                if (".nii.gz" in file or "img" in file or "hdr" in file  and file != ".DS_Store") and not file.endswith(".gzidx")]
 
     print(f"Total nii.gz files: {len(nii_gz_files)}")
 
     files_dictionary = {file: os.path.join(root, file) for root, file in nii_gz_files}
     
-    # Pre-load CDR data frames if files exist
-    cdr_dfs = {}
-    if cdr_file_paths['OAS1']:
-        # copy ID column before changing the name 
-        cdr_dfs['OAS1'] = pd.read_csv(cdr_file_paths['OAS1'][0])
-        cdr_dfs['OAS1']['CLINICALDATAID'] = cdr_dfs['OAS1']['ID']
-        cdr_dfs['OAS1'] = cdr_dfs['OAS1'].rename(columns={'ID': 'OASISID'})
-    if cdr_file_paths['OAS2']:
-        cdr_dfs['OAS2'] = pd.read_excel(cdr_file_paths['OAS2'][0]).rename(columns={'Subject ID': 'OASISID', "MRI ID": "CLINICALDATAID"})
-    if cdr_file_paths['OAS3']:
-        cdr_dfs['OAS3'] = pd.read_csv(cdr_file_paths['OAS3'][0]).rename(columns={'OASISID': 'OASISID', 'CDRTOT': 'CDR', 'OASIS_session_label': 'CLINICALDATAID'})
-    if cdr_file_paths['OAS3Unchanged']:
-        cdr_dfs['OAS3Unchanged'] = pd.read_csv(cdr_file_paths['OAS3Unchanged'][0]).rename(columns={'OASIS3_id': 'OASISID', 'Max of CDRTOT': 'CDR'})
-    if cdr_file_paths['OAS4']:
-        cdr_dfs['OAS4'] = pd.read_csv(cdr_file_paths['OAS4'][0]).rename(columns={'oasis_id': 'OASISID', 'cdr_id': 'CLINICALDATAID', 'visit_days': 'days_to_visit', 'cdr': 'CDR'}) # convert dictionary to dataframe
+    # Pre-load CDR data frames if they were not given
+    if cdr_dfs is None:
+        cdr_dfs = load_cdr_dataframes(root_directory, manifest)
     
     
     files_directory_df = pd.DataFrame(list(files_dictionary.items()),columns = ['file','file_full_path'])
@@ -5,6 +5,7 @@
 #
 # Usage: python oasis_data_matchup.py --list1 <list1.csv> --list2 <list2.csv> --output_name <output_filename.csv>
 #                                     --lower_bound <num_days_before> --upper_bound <num_days_after> 
+#                                     [--chunk_size <rows> --partitions <count> --workers <count>]
 # 
 #
 # This script will select the closest element in list2 for each element in list1, based on the OASIS days from entry. 
@@ -46,6 +47,11 @@
 #       in order to be considered "matched."
 # <output_filename.csv> - A filename to use for the output spreadsheet file.
 #
+# Optional inputs (for lists too large for memory, e.g. slice-level file lists):
+# <rows> - Read the lists <rows> rows at a time and split them by Subject into <count> partition files next to
+#       the output, then match the partitions in parallel and append them to the output as they are done.
+#       Memory is bounded by the largest partition instead of the lists. The output rows are grouped by partition.
+#
 #
 # Last Updated: 1/11/2023
 # Author: Khaled Elmalawany
@@ -58,27 +64,40 @@ import argparse
 import pandas as pd
 import numpy as np
 import os
+import sys
+import shutil
+import pathlib
+import tempfile
+import multiprocessing
 
-def main(list1, list2, output_name, lower_bound, upper_bound):
-    # Create dataframes with provided CSV files
-    list1 = pd.read_csv(list1)
-    list2 = pd.read_csv(list2)
-    
+from functools import partial
+
+# Append the parent folder to the python path
+sys.path.append(str(pathlib.Path(os.path.abspath(__file__)).parent.parent.resolve()))
+
+from DataScript.interval_join import *
+
+def add_day_column(list_df):
     # Create a Day column from ID
     # Use the "dXXXX" value from the ID/label in the first column
     # pandas extract will pull that based on a regular expression no matter where it is.
-    list1['Day'] = list1.iloc[:, 0].str.extract(r'(d\d{4})', expand=False).str.strip().apply(lambda x: int(x.split('d')[1]))
-    list2['Day'] = list2.iloc[:,0].str.extract(r'(d\d{4})', expand=False).str.strip().apply(lambda x: int(x.split('d')[1]))
-    
+    list_df['Day'] = list_df.iloc[:, 0].str.extract(r'(d\d{4})', expand=False).str.strip().apply(lambda x: int(x.split('d')[1]))
+    return list_df
+
+def match_lists(list1, list2, lower_bound, upper_bound):
     # Update list1 to only consider subjects that are in both lists
-    list1 =list1.loc[list1['Subject'].isin(list2['Subject'])]
+    list1 = list1.loc[list1['Subject'].isin(list2['Subject'])].copy()
+
+    # Give every list1 row the closest list2 row of its subject in the window (see interval_join.py)
+    return window_join(list1, list2, lower_bound, upper_bound, by='Subject', day_column='Day', suffix='_list2')
+
+def main(list1, list2, output_name, lower_bound, upper_bound):
+    # Create dataframes with provided CSV files
+    list1 = add_day_column(pd.read_csv(list1))
+    list2 = add_day_column(pd.read_csv(list2))
     
     # Create and populate the dataframe
-    out_df = pd.DataFrame()
-    for index, row in list2.iterrows():
-        mask = (list1['Subject'] == row['Subject']) & ((list1['Day'] < row['Day'] + upper_bound) & (list1['Day'] > row['Day'] - lower_bound))   
-        for name in row.index:
-            list1.loc[mask, name +'_list2'] = row[name]
+    list1 = match_lists(list1, list2, lower_bound, upper_bound)
     
     # Drop rows of which a match was not found
     #list1.dropna(inplace=True)
@@ -88,6 +107,63 @@ def main(list1, list2, output_name, lower_bound, upper_bound):
 
     list1.to_csv(output_name, index=False)
 
+def get_partition_path(partition_directory, name, partition):
+    return os.path.join(partition_directory, f"{name}-{partition:05d}.csv")
+
+def partition_list(list_file, partition_directory, name, num_partitions, chunk_size):
+    # Read the list chunk by chunk and append every row to the partition file of its Subject.
+    # hash_pandas_object is stable across runs and processes, so both lists split the same way.
+    for chunk in pd.read_csv(list_file, chunksize=chunk_size):
+        add_day_column(chunk)
+        partitions = pd.util.hash_pandas_object(chunk['Subject'].astype(str), index=False).to_numpy() % num_partitions
+        for partition, rows in chunk.groupby(partitions):
+            partition_path = get_partition_path(partition_directory, name, partition)
+            rows.to_csv(partition_path, mode='a', header=not os.path.exists(partition_path), index=False)
+
+def match_partition(partition, partition_directory, lower_bound, upper_bound):
+    # Match one partition of list1 against the same partition of list2 and save it.
+    # Returns (path, number of rows), or None if it has no rows
+    list1_path = get_partition_path(partition_directory, 'list1', partition)
+    list2_path = get_partition_path(partition_directory, 'list2', partition)
+    if not os.path.exists(list1_path) or not os.path.exists(list2_path):
+        return None
+
+    matched = match_lists(pd.read_csv(list1_path), pd.read_csv(list2_path), lower_bound, upper_bound)
+    if matched.empty:
+        return None
+    output_path = get_partition_path(partition_directory, 'matched', partition)
+    matched.to_csv(output_path, index=False)
+    return output_path, len(matched)
+
+def main_chunked(list1, list2, output_name, lower_bound, upper_bound, chunk_size=100000, num_partitions=64, num_workers=None):
+    output_directory = os.path.dirname(os.path.abspath(output_name))
+    with tempfile.TemporaryDirectory(prefix='match_up_', dir=output_directory) as partition_directory:
+        # Split both lists by Subject, so every subject is matched from its partition files alone
+        partition_list(list1, partition_directory, 'list1', num_partitions, chunk_size)
+        partition_list(list2, partition_directory, 'list2', num_partitions, chunk_size)
+
+        # Match the partitions in parallel and append each one to the output as soon as it is done (in partition order)
+        num_rows = 0
+        with open(output_name, 'w', newline='') as output_file, multiprocessing.Pool(num_workers) as pool:
+            match_func = partial(match_partition, partition_directory=partition_directory, lower_bound=lower_bound, upper_bound=upper_bound)
+            header = None
+            for result in pool.imap(match_func, range(num_partitions)):
+                if result is None:
+                    continue
+                matched_path, matched_rows = result
+                with open(matched_path, 'r', newline='') as matched_file:
+                    matched_header = matched_file.readline()
+                    if header is None:
+                        header = matched_header
+                        output_file.write(header)
+                    elif matched_header != header:
+                        raise ValueError(f"The columns of {matched_path} do not match the output's")
+                    shutil.copyfileobj(matched_file, output_file)
+                num_rows += matched_rows
+                os.remove(matched_path)
+
+    print(f"Matched {num_rows} rows into {output_name}")
+
 
 def is_valid_file(parser, arg):
     if not os.path.exists(arg):
@@ -103,7 +179,13 @@ if __name__ == '__main__':
     parser.add_argument('--output_name', required=True, type=str, help="File name of the output CSV <output.csv>")
     parser.add_argument('--lower_bound', type=int, default=180,  help="Number of days prior to list1 session that list2 session is included.")
     parser.add_argument('--upper_bound', type=int, default=180,  help="Number of days post list1 session that list2 session is included.")
+    parser.add_argument('--chunk_size', type=int, default=None, help="Read the lists this many rows at a time and match them by Subject partition (for lists too large for memory).")
+    parser.add_argument('--partitions', type=int, default=64, help="Number of Subject partitions with --chunk_size.")
+    parser.add_argument('--workers', type=int, default=None, help="Number of processes matching partitions with --chunk_size (all CPUs by default).")
 
     args = parser.parse_args()
 
-    main(args.list1, args.list2, args.output_name, args.lower_bound, args.upper_bound)
\ No newline at end of file
+    if args.chunk_size:
+        main_chunked(args.list1, args.list2, args.output_name, args.lower_bound, args.upper_bound, args.chunk_size, args.partitions, args.workers)
+    else:
+        main(args.list1, args.list2, args.output_name, args.lower_bound, args.upper_bound)
\ No newline at end of file
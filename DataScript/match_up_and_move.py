@@ -4,6 +4,12 @@ import numpy as np
 import os
 import sys
 import shutil
+import pathlib
+
+# Append the parent folder to the python path
+sys.path.append(str(pathlib.Path(os.path.abspath(__file__)).parent.parent.resolve()))
+
+from DataScript.interval_join import *
 
 # Mapping of CDR numerical values to labels
 cdr_mapping = {
@@ -45,11 +51,8 @@ def matching_up_the_data_upper_lower(scan_session_day, clinical_assesment_day, l
     # Update scan_session_day to only consider subjects that are in both lists
     # scan_session_day = scan_session_day.loc[scan_session_day['OASISID'].isin(clinical_assesment_day['OASISID'])]
 
-    # Create and populate the dataframe
-    for index, row in clinical_assesment_day.iterrows():
-        mask = (scan_session_day['OASISID'] == row['OASISID']) & ((scan_session_day['days_to_visit'] < row['days_to_visit'] + upper_bound) & (scan_session_day['days_to_visit'] > row['days_to_visit'] - lower_bound))   
-        for name in row.index:
-            scan_session_day.loc[mask, name +'_clinical_assesment_day'] = row[name]
+    # Give every scan the closest assessment of its subject in the window (see interval_join.py)
+    scan_session_day = window_join(scan_session_day, clinical_assesment_day, lower_bound, upper_bound)
     
     # Drop rows of which a match was not found
     #scan_session_day.dropna(inplace=True)
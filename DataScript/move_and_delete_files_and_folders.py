@@ -13,6 +13,7 @@ notebook_path = os.path.join(os.path.dirname(os.path.abspath('move_and_delete_fi
 sys.path.append(str(pathlib.Path(notebook_path).parent.resolve()))
 
 # FROM .py SCRIPT
+from cdr_label_service import *
 from create_data_folders import *
 from display_images import *
 from get_data_stats import *
@@ -69,69 +70,22 @@ def move_images_into_categories(data_folder):
                 # Add the file to the dictionary
                 files_dictonary[file] = file_full_path
 
+    # Load and index the CDR tables once for all the files
+    cdr_labels = CDRLabelService(data_folder)
+
     # for file, file_full_path in files_dictonary.items():
     #    print(f"{file} : {file_full_path}")
     count = 0
+    missing_count = 0
     for file, file_full_path in files_dictonary.items():
 
-        # Check file name if it conatins OAS1
-    
-        oasis1_cdr_csv = []
-        oasis2_cdr_csv = []
-        oasis3_cdr_csv = []
-        oasis4_cdr_csv = []
-
-        # Find the path to the CDR files
-        if find_file_paths(data_folder, 'oasis1_cross-sectional.csv') != []:
-            oasis1_cdr_csv = find_file_paths(data_folder, 'oasis1_cross-sectional.csv')
-            oasis1_dcr_df = pd.read_csv(oasis1_cdr_csv[0])
-        if find_file_paths(data_folder, 'oasis2_longitudinal_demographics.xlsx') != []:
-            oasis2_cdr_csv = find_file_paths(data_folder, 'oasis2_longitudinal_demographics.xlsx')
-            oasis2_dcr_df = pd.read_excel(oasis2_cdr_csv[0])
-        if find_file_paths(data_folder, 'OASIS3_UDSb4_cdr.csv') != []:
-            oasis3_cdr_csv = find_file_paths(data_folder, 'OASIS3_UDSb4_cdr.csv')
-            oasis3_dcr_df = pd.read_csv(oasis3_cdr_csv[0])
-        if find_file_paths(data_folder, 'OASIS4_data_CDR.csv') != []:
-            oasis4_cdr_csv = find_file_paths(data_folder, 'OASIS4_data_CDR.csv')
-            oasis4_dcr_df = pd.read_csv(oasis4_cdr_csv[0])
-
-    
-        # Get label from information file
-        if "OAS1" in file:
-            # Using this file name Slice_100_OAS1_0001_MR1_axial_img_1_anon extract the patient_id = 100 and mr_id = 1
-            patient_id = file.split('_')[3]
-            mr_id = file.split('_')[4]
-
-            # Read the information file
-            # OAS1_0001_MR1
-            label_id = oasis1_dcr_df[oasis1_dcr_df['ID'] == f'OAS1_{patient_id}_{mr_id}']['CDR'].values[0]
-            
-
-        elif "OAS2" in file:
-            # Slice_100_OAS2_0001_MR2_axial_img_3.png
-            patient_id = file.split('_')[3]
-            mr_id = file.split('_')[4]
-
-            # check to see if oasis_dataset_number + patient_id is in OASISID column then return CDRTOT column
-            label_id = oasis2_dcr_df[oasis2_dcr_df['Subject ID'] == f'OAS2_{patient_id}']['CDR'].values[0]
-
-
-        elif "OAS3" in file:
-            # Extract from "sub-OAS30036_sess-d1199_T2star_slice_11_Sagittal_img.png"  the "OAS30036"
-            patient_id = file.split('_')[2]
-            patient_id = patient_id[4:]
-
-            # check to see if oasis_dataset_number + patient_id is in OASISID column then return CDRTOT column
-            label_id = oasis3_dcr_df[oasis3_dcr_df['OASISID'] == patient_id]['CDRTOT'].values[0]
-            
-        elif "OAS4" in file:
-            patient_id = file.split('_')[3]
-
-            # check to see if oasis_dataset_number + patient_id is in OASISID column then return CDRTOT column
-            label_id = oasis4_dcr_df[oasis4_dcr_df['oasis_id'] == patient_id]['cdr'].values[0]
+        # Get label from information file (OAS1 by session, OAS2/3/4 by subject)
+        label = cdr_labels.get_file_label(file)
+        if label == 'unknown':
+            missing_count += 1
 
         # Move each item to the destination directory
-        dest_item = os.path.join(categorised_preprocessed_image_dir, get_cdr_label(float(label_id)), file)
+        dest_item = os.path.join(categorised_preprocessed_image_dir, label, file)
         
         # Check if the destination item already exists
         if os.path.exists(dest_item):
@@ -149,6 +103,9 @@ def move_images_into_categories(data_folder):
         count += 1
         print(f"Completed file: {count}/{len(files_dictonary.items())}")
 
+    if missing_count:
+        print(f"No CDR label found for {missing_count} files, copied to 'unknown'")
+
 
 # Move the folder if a file exists
 def move_folder_if_file_exists(source_folder, destination_folder, file_to_check):
@@ -22,6 +22,10 @@ def get_cdr_label(cdr_value):
     # Use the get method to handle cases where cdr_value is not in cdr_mapping
     return cdr_mapping.get(cdr_value, 'unknown')
 
+# This function will convert a Series of CDR values to labels in one pass (like get_cdr_label(float(value)) for each one)
+def get_cdr_labels(cdr_values):
+    return pd.to_numeric(cdr_values, errors='coerce').map(cdr_mapping).fillna('unknown')
+
 # This function will return the file path
 def find_file_paths(root_folder, filename):
     """
@@ -221,6 +225,89 @@ def extract_ids(file, file_full_path, cdr_dfs):
     return patient_id, mr_id, slice_id, slice_type, OASISID, mr_type, img_id, day, run_id, dataset_marker, clinical_data_id
 
 
+# This function will index the CDR tables by the keys the files are labelled with
+def build_label_indexes(cdr_dfs):
+    """
+    Builds the lookups used by resolve_file_labels once, instead of masking a CDR table for every file.
+
+    :param cdr_dfs: The CDR tables loaded in create_df (upper case column names).
+    :return: A tuple (unchanged_cdr, cdr_by_clinical_id): a Series of the 'OAS3Unchanged' CDR indexed by OASISID,
+             and a dictionary of Series of the CDR indexed by CLINICALDATAID for every dataset.
+             The first row of a repeated key is kept, as the .values[0] lookups did.
+    """
+    def first_cdr_by(df, key):
+        df = df.dropna(subset=[key]).drop_duplicates(subset=[key])
+        return pd.Series(df['CDR'].to_numpy(), index=df[key].to_numpy())
+
+    unchanged_cdr = first_cdr_by(cdr_dfs['OAS3Unchanged'], 'OASISID') if 'OAS3Unchanged' in cdr_dfs else pd.Series(dtype=float)
+    cdr_by_clinical_id = {dataset: first_cdr_by(df, 'CLINICALDATAID') for dataset, df in cdr_dfs.items() if 'CLINICALDATAID' in df.columns and 'CDR' in df.columns}
+    return unchanged_cdr, cdr_by_clinical_id
+
+# This function will find the CDR label and destination of every file
+def resolve_file_labels(ids_df, files_directory_df, cdr_dfs, categorised_preprocessed_image_dir):
+    """
+    Labels every file with dictionary lookups over whole columns:
+    - OASIS 3 files use the clinical id matched by matching_up_the_data_upper_lower_full (files without one are
+      dropped), and the 'OAS3Unchanged' CDR of the subject when there is one.
+    - The other datasets use the clinical id parsed by extract_ids.
+
+    :param ids_df: One row per file with the columns returned by extract_ids, plus file and file_full_path.
+    :param files_directory_df: The files matched up with their clinical assessment.
+    :param cdr_dfs: The CDR tables loaded in create_df.
+    :param categorised_preprocessed_image_dir: Folder of the category folders.
+    :return: ids_df with the label_id, label and dest_item columns.
+    """
+    unchanged_cdr, cdr_by_clinical_id = build_label_indexes(cdr_dfs)
+    ids_df = ids_df.copy()
+
+    markers = ids_df['dataset_marker']
+    has_cdr = markers.isin(list(cdr_dfs.keys()))
+    is_oas3 = has_cdr & markers.fillna('').str.contains('OAS3')
+
+    # OASIS 3 files take the clinical id of their matched assessment; files without one are skipped
+    if is_oas3.any():
+        matched = files_directory_df.drop_duplicates(subset=['file']).set_index('file')
+        matched_ids = matched['CLINICALDATAID_clinical_assessment'] if 'CLINICALDATAID_clinical_assessment' in matched.columns else pd.Series(dtype=object)
+        files = ids_df.loc[is_oas3, 'file']
+        in_matched = files.isin(matched_ids.index)
+        matched_ids = files.map(matched_ids)
+        keep = in_matched & (matched_ids != '')
+        ids_df.loc[is_oas3, 'clinical_data_id'] = matched_ids
+        drop_index = matched_ids.index[~keep]
+        ids_df = ids_df.drop(index=drop_index)
+        markers, has_cdr, is_oas3 = markers.drop(index=drop_index), has_cdr.drop(index=drop_index), is_oas3.drop(index=drop_index)
+
+    label_id = pd.Series(None, index=ids_df.index, dtype=object)
+    found = pd.Series(False, index=ids_df.index)
+
+    # Look the clinical ids up in the CDR table of their dataset
+    for dataset, cdr_by_id in cdr_by_clinical_id.items():
+        rows = has_cdr & (markers == dataset)
+        if rows.any():
+            clinical_ids = ids_df.loc[rows, 'clinical_data_id']
+            in_table = clinical_ids.isin(cdr_by_id.index)
+            label_id[rows] = clinical_ids.map(cdr_by_id).where(in_table, None)
+            found[rows] = in_table.to_numpy(dtype=bool)
+
+    # The 'OAS3Unchanged' CDR of a subject comes before its clinical assessment
+    unchanged = is_oas3 & ids_df['OASISID'].isin(unchanged_cdr.index)
+    label_id[unchanged] = ids_df.loc[unchanged, 'OASISID'].map(unchanged_cdr)
+    found |= unchanged
+
+    not_found = has_cdr & ~found
+    if not_found.any():
+        print(f"Label ID not found for {not_found.sum()} files, e.g. {ids_df.loc[not_found, 'clinical_data_id'].iloc[0]} - {ids_df.loc[not_found, 'OASISID'].iloc[0]}")
+
+    # CDR -> label in one vectorised mapping; files without a CDR go to 'unknown'
+    labels = get_cdr_labels(label_id)
+    has_label = found & label_id.notna() & (label_id != '')
+    ids_df['label_id'] = label_id.where(found, None)
+    ids_df['label'] = labels.where(found, None)
+    category = labels.where(has_label, 'unknown')
+    ids_df['dest_item'] = [os.path.join(categorised_preprocessed_image_dir, folder, file) for folder, file in zip(category, ids_df['file'])]
+
+    return ids_df[['patient_id', 'mr_id', 'slice_id', 'slice_type', 'OASISID', 'mr_type', 'img_id', 'day', 'run_id', 'dataset_marker', 'clinical_data_id', 'label_id', 'label', 'file', 'file_full_path', 'dest_item']].reset_index(drop=True)
+
 # This function is used to move the files from one folder to another.
 def create_df(files_dictionary, data_folder, root_folder, categorised_preprocessed_image_dir):
 
@@ -285,8 +372,6 @@ def create_df(files_dictionary, data_folder, root_folder, categorised_preprocess
        
     print(f"Successfully concatenated the CDR files and Starting extraction...")
     
-    save_rows = []
-
     print(f"Starting match up...")
 
     if "OAS3" in files_directory_df['file'].values.any():
@@ -298,61 +383,15 @@ def create_df(files_dictionary, data_folder, root_folder, categorised_preprocess
         
     print(f"Successfully matched up the data and Starting extraction...")
     
-    for file, file_full_path in files_dictionary.items():
-
-        patient_id, mr_id, slice_id, slice_type, OASISID, mr_type, img_id, day, run_id, dataset_marker, clinical_data_id = extract_ids(file, file_full_path, cdr_dfs)
-
-        # Get label_id based on the dataset
-        label_id = None
-
-        if dataset_marker in cdr_dfs:
-            if "OAS3" in dataset_marker:
-                # print(files_directory_df[files_directory_df['file'] == file])
-                clinical_data_id = files_directory_df[files_directory_df['file'] == file]['CLINICALDATAID_clinical_assessment'].values[0] if files_directory_df[files_directory_df['file'] == file]['CLINICALDATAID_clinical_assessment'].values.any() else None
-
-                # print(f"Patient ID: {patient_id} | MR ID: {mr_id} | Slice ID: {slice_id} | Slice Type: {slice_type} | OASISID: {OASISID} | MR Type: {mr_type} | Img ID: {img_id} | Day: {day} | Run ID: {run_id} | Dataset Marker: {dataset_marker} | Clinical Data ID: {clinical_data_id}")
-
-                if clinical_data_id is None:
-                    continue
-                
-                # Check the cdr_dfs['OAS3Unchanged'] df first and if not found there check cdr_dfs['OAS3']
-                if OASISID in cdr_dfs['OAS3Unchanged']['OASISID'].values:
-                    label_id = cdr_dfs['OAS3Unchanged'][cdr_dfs['OAS3Unchanged']['OASISID'] == OASISID]['CDR'].values[0]
-                    # print(f"Label ID: {label_id}")
-                elif clinical_data_id in cdr_dfs[dataset_marker]['CLINICALDATAID'].values:
-                    # Check to see the file in files_directory_df and get the corresponding CLINICALDATAID
-                    label_id = cdr_dfs[dataset_marker][cdr_dfs[dataset_marker]['CLINICALDATAID'] == clinical_data_id]['CDR'].values[0]
-                    # print(f"{clinical_data_id} - Label ID: {label_id}")
-                else:
-                    print(f"Label ID not found for {clinical_data_id} -  {OASISID}")
-                    label_id = None
-            else:
-                if clinical_data_id in cdr_dfs[dataset_marker]['CLINICALDATAID'].values:
-                    label_id = cdr_dfs[dataset_marker][cdr_dfs[dataset_marker]['CLINICALDATAID'] == clinical_data_id]['CDR'].values[0]
-                    print(f"Label ID: {label_id}")
-                else:
-                    print(f"Label ID not found for {clinical_data_id}")
-                    label_id = None
-
-        if label_id is not None or label_id != "":
-            # Determine the destination based on the CDR label
-            if label_id is not None and label_id != "":
-                # Determine the destination based on the CDR label
-                dest_item = os.path.join(categorised_preprocessed_image_dir, get_cdr_label(float(label_id)), file)
-            else:
-                # Determine the destination based on the CDR label
-                dest_item = os.path.join(categorised_preprocessed_image_dir, "unknown", file)
-            # print(f"file_full_path {file_full_path} - dest_item {dest_item}")
-        else:
-            # Determine the destination based on the CDR label
-            dest_item = os.path.join(categorised_preprocessed_image_dir, "unknown", file)
-            # print(f"file_full_path {file_full_path} - dest_item {dest_item}")
+    # Parse the ids of every file; the labels are then resolved for all the files at once
+    save_rows = [extract_ids(file, file_full_path, cdr_dfs) for file, file_full_path in files_dictionary.items()]
+    ids_df = pd.DataFrame(save_rows, columns=['patient_id', 'mr_id', 'slice_id', 'slice_type', 'OASISID', 'mr_type', 'img_id', 'day', 'run_id', 'dataset_marker', 'clinical_data_id'])
+    ids_df['file'] = list(files_dictionary.keys())
+    ids_df['file_full_path'] = list(files_dictionary.values())
 
-        label = get_cdr_label(float(label_id)) if label_id is not None else None
-        save_rows.append({'patient_id': patient_id, 'mr_id': mr_id, 'slice_id': slice_id, 'slice_type': slice_type, 'OASISID': OASISID, 'mr_type': mr_type, 'img_id': img_id, 'day': day, 'run_id': run_id, 'dataset_marker': dataset_marker, 'clinical_data_id': clinical_data_id, 'label_id': label_id, 'label': label, 'file': file, 'file_full_path': file_full_path, 'dest_item': dest_item})
+    save_df = resolve_file_labels(ids_df, files_directory_df, cdr_dfs, categorised_preprocessed_image_dir)
 
     # save save_rows to a csv file
-    save_df = pd.DataFrame(save_rows, columns=['patient_id', 'mr_id', 'slice_id', 'slice_type', 'OASISID', 'mr_type', 'img_id', 'day', 'run_id', 'dataset_marker', 'clinical_data_id', 'label_id', 'label', 'file', 'file_full_path', 'dest_item'])
     save_df.to_csv('save_df.csv', index=False)
 
     return save_df
@@ -394,7 +433,9 @@ def move_images_into_categories(data_folder):
         print(f"Moved: {row['file_full_path']} to {row['dest_item']}")
 
     print(f"Completed moving {len(file_moves_df)} files.")
-# Define the root destination directory (you might need to adjust this)
-destination_root = sys.argv[1]
+if __name__ == "__main__":
+
+    # Define the root destination directory (you might need to adjust this)
+    destination_root = sys.argv[1]
 
-move_images_into_categories(destination_root)
\ No newline at end of file
+    move_images_into_categories(destination_root)
@@ -15,29 +15,80 @@ sys.path.append(str(pathlib.Path(notebook_path).parent.resolve()))
 
 # AS
 import nibabel as nib
-import matplotlib.pyplot as plt
+import numpy as np
 
 # FROM
 from functools import partial
 from pathlib import Path
+from PIL import Image
+
+# OPTIONAL
+try:
+    import indexed_gzip  # Seekable .nii.gz reads
+except ImportError:
+    indexed_gzip = None
 
 # FROM .py SCRIPT
+from DataScript.completion_ledger import *
+from DataScript.conversion_executor import *
 from DataScript.display_images import *
 from DataScript.extract_slices import *
 from DataScript.get_data_stats import *
 from DataScript.get_patient_data import *
 from DataScript.load_and_read_data import *
 from DataScript.load_metadata import *
+from DataScript.shard_partition import *
+from DataScript.slice_shards import *
+from DataScript.slice_store import *
+from DataScript.volume_cache import *
 
 #################### FUNCTIONS ####################
 
+# Labels of the scans in each pool worker, set once by init_label_lookup
+worker_label_lookup = {}
+
+# This function will build a dictionary of file name without the format to label
+def get_label_lookup(ref_df):
+    """
+    Returns {file_name_wout_format: label} with the first label of every file name, like the
+    boolean-mask lookup on ref_df it replaces.
+    """
+    first_rows = ref_df.drop_duplicates('file_name_wout_format', keep='first')
+    return dict(zip(first_rows['file_name_wout_format'], first_rows['label']))
+
+# This function will give a pool worker the label lookup, once per worker instead of once per task
+def init_label_lookup(label_lookup):
+    global worker_label_lookup
+    worker_label_lookup = label_lookup
+
+# This function will return the label of a scan
+def get_scan_label(filename, label_lookup=None):
+    label_lookup = worker_label_lookup if label_lookup is None else label_lookup
+    return label_lookup.get(filename, "unknown")
+
 # This function is used to load the data from the given path.
 def extract_slice_index(file):
     """Extract the slice index from the given file."""
     # remove the extension
     return file.split("_")[3].split("-")[1]
 
-def convert_nueoimaging_to_images(original_data_path, preprocessed_data_path, ref_df):
+def convert_nueoimaging_to_images(original_data_path, preprocessed_data_path, ref_df, manifest=None, output_format='png', shard_size=4096, store_modality='MRI', png_side_output=False, executor=None, shard=None, label_lookup=None):
+    """
+    Saves the slices of every scan under original_data_path.
+
+    output_format 'png' saves one PNG per slice into <preprocessed_data_path>/<label>/<orientation>/.
+    output_format 'shards' saves 128x128 uint8 slices into .npy shards of about `shard_size` slices
+    under <preprocessed_data_path>/shards/, with an index csv (see slice_shards.py).
+    output_format 'hdf5' saves 128x128 uint8 slices into <preprocessed_data_path>/slices.h5 under
+    the `store_modality` group (see slice_store.py).
+    Every format reads each scan once and goes straight from the volume to 128x128 uint8 slices.
+    With `png_side_output` the 'shards' and 'hdf5' formats also save the PNG images.
+    The scans are converted by `executor`, a ConversionExecutor (see conversion_executor.py).
+    With a `shard` (index, count), the manifest should hold the files of that shard only (see
+    shard_partition.py); the shards folder, slices.h5 and the completion ledger then get the
+    shard in their names so the shards can run at the same time on shared storage.
+    The labels come from `label_lookup`, e.g. ScanCatalog.label_lookup(), or from ref_df without it.
+    """
     print('start')
     extensions = ['.img', '.hdr', '.nii.gz']
     filename_list = []
@@ -45,8 +96,12 @@ def convert_nueoimaging_to_images(original_data_path, preprocessed_data_path, re
     combined_dict = {}
     completed = 0
 
+    # Walk the original data once and look up every extension in the manifest
+    if manifest is None:
+        manifest = build_scan_manifest(original_data_path)
+
     for ext in extensions:
-        filenames, files = load_files_with_extension(original_data_path, ext)  
+        filenames, files = load_files_with_extension(original_data_path, ext, manifest)  
 
         for filename, file_path in zip(filenames, files):
             file_path_list.append(file_path)
@@ -58,44 +113,197 @@ def convert_nueoimaging_to_images(original_data_path, preprocessed_data_path, re
     compare_missing_files_in_ref_df(ref_df, file_path_list)
 
     # Covert into batch download
-
-    with multiprocessing.Pool() as pool:
-        process_func = partial(process_file, ref_df=ref_df, preprocessed_data_path=preprocessed_data_path)
-        completed_files = pool.imap(process_func, combined_dict.items())
-        for i, filename in enumerate(completed_files, 1):
-            print(f"Complete: {i}/{len(combined_dict)} - {filename}")
+    png_directory = preprocessed_data_path if png_side_output else None
+    executor = executor or ConversionExecutor()
+    if label_lookup is None:
+        label_lookup = get_label_lookup(ref_df)
+
+    if output_format == 'shards':
+        with SliceShardWriter(get_shard_path(os.path.join(preprocessed_data_path, 'shards'), shard), shard_size) as writer:
+            convert_nueoimaging_with_writer(combined_dict, ref_df, writer, png_directory=png_directory, executor=executor, label_lookup=label_lookup)
+        print('end')
+        return
+    if output_format == 'hdf5':
+        with SliceStoreWriter(get_shard_path(os.path.join(preprocessed_data_path, 'slices.h5'), shard), store_modality) as writer:
+            convert_nueoimaging_with_writer(combined_dict, ref_df, writer, png_directory=png_directory, executor=executor, label_lookup=label_lookup)
+        print('end')
+        return
+
+    # The ledger says which scans have all their slices saved, instead of walking the output folder for every scan
+    ledger_path = os.path.join(preprocessed_data_path, 'completion_ledger.sqlite')
+    with CompletionLedger(get_shard_path(ledger_path, shard)) as ledger:
+        if shard is None:
+            ledger.seed_from_directory(preprocessed_data_path, lambda filename: get_expected_slice_count(combined_dict[filename]) if filename in combined_dict else None)
+        elif os.path.exists(ledger_path):
+            # A shard does not walk the shared output folder, where other shards may be writing; it starts
+            # from what the unsharded ledger knows about its own scans (the shard's own rows win)
+            ledger.merge_from(ledger_path, set(combined_dict))
+        partial_files = ledger.get_partial()
+        if partial_files:
+            print(f"Redoing {len(partial_files)} scans left partly written by an earlier run")
+
+        pending_files = [(filename, file_paths) for filename, file_paths in combined_dict.items() if not ledger.is_done(filename)]
+        print(f"Skipping {len(combined_dict) - len(pending_files)} scans already converted")
+        ledger.mark_started([filename for filename, _ in pending_files])
+
+        # The labels are sent once to each worker, the tasks only hold the file names and paths
+        process_func = partial(process_file, preprocessed_data_path=preprocessed_data_path)
+        for filename, num_slices in executor.map_unordered(process_func, pending_files, init_label_lookup, (label_lookup,)):
+            # A scan that failed stays 'started' and is tried again on the next run
+            if num_slices is not None:
+                ledger.mark_done(filename, num_slices)
 
     print('end')
 
+# This function will load an Analyze/NIfTI .img/.hdr pair without copying the image data
+def load_analyze_pair(file_paths):
+    """
+    Loads an .img/.hdr pair by reading the header once and mapping the raw .img payload.
+
+    The returned image is backed by a read-only np.memmap with the header's dtype and
+    shape, so slices are only read from disk when they are used.
+
+    :param file_paths: The .img and .hdr paths, in any order.
+    :return: A nibabel image backed by the memmap.
+    """
+    img_path = next(path for path in file_paths if path.endswith('.img'))
+    hdr_path = next(path for path in file_paths if path.endswith('.hdr'))
+
+    # NIfTI pairs have the 'ni1' magic, everything else is read as Analyze (SPM2 flavour like nib.load does)
+    with open(hdr_path, 'rb') as hdr_file:
+        hdr_file.seek(344)
+        is_nifti_pair = hdr_file.read(4) == b'ni1\x00'
+        hdr_file.seek(0)
+        image_class = nib.Nifti1Pair if is_nifti_pair else nib.Spm2AnalyzeImage
+        header = image_class.header_class.from_fileobj(hdr_file)
+
+    # Scaled data has to go through the image proxy so the scaling is applied
+    slope, inter = header.get_slope_inter()
+    if slope not in (None, 1.0) or inter not in (None, 0.0):
+        return nib.load(img_path, mmap='r')
+
+    img_data = np.memmap(img_path, dtype=header.get_data_dtype(), mode='r', offset=int(header.get_data_offset()), shape=header.get_data_shape(), order='F')
+    return image_class(img_data, header.get_best_affine(), header=header)
+
+# This function will open a .nii.gz file with a seekable gzip index stored next to it
+def open_indexed_nii_gz(file_path, index_suffix='.gzidx'):
+    """
+    Opens a .nii.gz file so that slabs can be read by seeking instead of inflating the whole file.
+
+    The gzip seek points are built once and saved as `<file_path><index_suffix>`. Later runs
+    import that index. Without the optional indexed_gzip package this is a plain nib.load.
+
+    :param file_path: Path to the .nii.gz file.
+    :param index_suffix: Suffix of the index file saved next to the .nii.gz file.
+    :return: A nibabel image whose proxy reads through the indexed gzip file.
+    """
+    if indexed_gzip is None:
+        return nib.load(file_path)
+
+    index_path = file_path + index_suffix
+    gz_file = indexed_gzip.IndexedGzipFile(file_path)
+    try:
+        # Rebuild the index when the scan is newer than it
+        if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(file_path):
+            gz_file.import_index(index_path)
+        else:
+            gz_file.build_full_index()
+            try:
+                gz_file.export_index(index_path)
+            except OSError as e:
+                print(f"Unable to save gzip index for {file_path}: {e}")
+
+        file_holder = nib.FileHolder(filename=file_path, fileobj=gz_file)
+        return nib.Nifti1Image.from_file_map({'header': file_holder, 'image': file_holder})
+    except Exception:
+        gz_file.close()
+        return nib.load(file_path)
+
 def load_nii_file(file_paths):
     if len(file_paths) == 2:  # .img and .hdr scenario
-        return nib.Nifti1Image(nib.load(file_paths[0]).get_fdata(), None, header=nib.load(file_paths[1]).header)
+        return load_analyze_pair(file_paths)
     elif len(file_paths) == 1:  # .nii.gz scenario
+        if file_paths[0].endswith('.nii.gz'):
+            # The decoded-volume cache beats seeking in the gzip stream, use the index only without it
+            if volume_cache_enabled():
+                return load_cached_nii(file_paths[0])
+            return open_indexed_nii_gz(file_paths[0])
         return nib.load(file_paths[0])
     else:
         raise ValueError("Unexpected number of files for a single dataset.")
 
-def process_file(file_data, ref_df, preprocessed_data_path):
+# This function will write the slices of every scan with a slice writer, the workers only read and convert the slices
+def convert_nueoimaging_with_writer(combined_dict, ref_df, writer, slice_shape=(128, 128), png_directory=None, executor=None, label_lookup=None):
+    """
+    Parameters:
+    - combined_dict: Dictionary of {file name without the format: file paths}.
+    - ref_df: The reference dataframe holding the labels.
+    - writer: A SliceShardWriter or SliceStoreWriter (anything with written_files and write_scan).
+    - slice_shape: Shape of the saved slices.
+    - png_directory: Also save the slices as PNG images under this folder (see save_uint8_slices_as_images).
+    - executor: ConversionExecutor running the workers (the default one if None).
+    - label_lookup: Dictionary of {file name without the format: label} (built from ref_df if None).
+    """
+    # Scans already written by an earlier run are skipped
+    pending_files = [(filename, file_paths) for filename, file_paths in combined_dict.items() if filename not in writer.written_files]
+    print(f"Skipping {len(combined_dict) - len(pending_files)} scans already written")
+
+    executor = executor or ConversionExecutor()
+    process_func = partial(process_file_to_slices, slice_shape=slice_shape, png_directory=png_directory)
+    # Only the main process writes, so the output is filled sequentially in the order the scans finish
+    if label_lookup is None:
+        label_lookup = get_label_lookup(ref_df)
+    for filename, label, slices in executor.map_unordered(process_func, pending_files, init_label_lookup, (label_lookup,)):
+        if slices is not None:
+            writer.write_scan(filename, label, slices)
+
+# This function will read the slices of a scan as fixed-shape uint8 images
+def process_file_to_slices(file_data, slice_shape=(128, 128), png_directory=None, label_lookup=None):
+    """
+    Reads a scan into uint8 slices. With `png_directory` the slices are also saved as PNG images
+    there, as a side output of the same pass. The label comes from `label_lookup` (see
+    get_label_lookup), or the lookup given to the pool worker by init_label_lookup.
+    """
     filename, file_paths = file_data
-    label = ref_df[ref_df['file_name_wout_format'] == filename]['label'].iloc[0] if not ref_df[ref_df['file_name_wout_format'] == filename].empty else "unknown"
+    label = get_scan_label(filename, label_lookup)
 
-    # Check if there are files inside the preprocessed_data_path, If it is, skip it
-    if os.path.exists(preprocessed_data_path):
-        for root, dirs, files in os.walk(preprocessed_data_path):
-            for file in files:
-                if filename in file:
-                    # print(f"File {filename} already processed, skipping...")
-                    return filename
+    try:
+        nii_data = load_nii_file(file_paths)
+        images = read_uint8_slices(nii_data, slice_shape)
+        if png_directory is not None:
+            save_uint8_slices_as_images(filename, images, png_directory, label)
+        return filename, label, images
+    except MemoryError:
+        # Left to the executor, which counts the scans over the worker memory limit
+        raise
+    except Exception as e:
+        print(f"Error processing {filename}: {e}")
+        return filename, label, None
+
+def process_file(file_data, preprocessed_data_path, label_lookup=None):
+    """
+    Saves the slices of a scan as PNG images. Scans that are already done are skipped by the
+    caller with the completion ledger (see completion_ledger.py). The label is looked up like
+    in process_file_to_slices.
+
+    :return: A tuple (filename, number of slices saved), with None slices if the scan failed.
+    """
+    filename, file_paths = file_data
+    label = get_scan_label(filename, label_lookup)
 
     try:
         nii_data = load_nii_file(file_paths)
-        img_data = nii_data.get_fdata()
         # print(f"Processing {filename}...")
-        slices = guess_orientation_and_extract_all_slices(img_data)
-        save_single_slice(filename, slices, preprocessed_data_path, label)
+        # Only read the slabs that will be saved and convert them in one pass
+        images = read_uint8_slices(nii_data)
+        save_uint8_slices_as_images(filename, images, preprocessed_data_path, label)
+        return filename, sum(len(slice_list) for slice_list in images.values())
+    except MemoryError:
+        # Left to the executor, which counts the scans over the worker memory limit
+        raise
     except Exception as e:
         print(f"Error processing {filename}: {e}")
-    return filename
+    return filename, None
 
 # def save_slice_image(file_name, img_data, start_slice, end_slice, output_directory, label):
 #     """
@@ -120,7 +328,7 @@ def process_file(file_data, ref_df, preprocessed_data_path):
 #         fig.savefig(file_path, bbox_inches='tight', pad_inches=0)
 #         plt.close(fig)  # Close the figure to free memory
 
-def save_single_slice(file_name, slices, output_directory, label):
+def save_single_slice(file_name, slices, output_directory, label, slice_counts=None):
     """
     Saves slices of MRI data as PNG images in specific orientation folders.
 
@@ -129,6 +337,7 @@ def save_single_slice(file_name, slices, output_directory, label):
     - slices: Dictionary of slices for each orientation.
     - output_directory: The base directory to save the images.
     - label: Label for the subdirectory structure.
+    - slice_counts: Number of slices of the full volume per orientation, when `slices` only holds slabs.
     """
 
     # Define the output base Path object for clarity and ease of use
@@ -137,7 +346,8 @@ def save_single_slice(file_name, slices, output_directory, label):
     # Iterate over each orientation to save the slices
     for orientation, slice_list in slices.items():
         # Calculate start and end slices based on orientation
-        start_slice, end_slice = determine_slice_range(orientation, slice_list)
+        num_slices = slice_counts[orientation] if slice_counts else len(slice_list)
+        start_slice, end_slice = determine_slice_range(orientation, num_slices)
 
         # Define the full path for the current orientation and ensure it exists
         orientation_path = output_base_path / label / orientation
@@ -154,26 +364,136 @@ def save_single_slice(file_name, slices, output_directory, label):
 def determine_slice_range(orientation, slice_list):
     """
     Determines the start and end slice indices based on the orientation and available slices.
+    `slice_list` can be the slices themselves or the number of slices.
     """
+    num_slices = slice_list if isinstance(slice_list, (int, np.integer)) else len(slice_list)
     if orientation == 'Sagittal':
-        start_slice = len(slice_list) // 4
-        end_slice = len(slice_list) - start_slice
+        start_slice = num_slices // 4
+        end_slice = num_slices - start_slice
     else:
         start_slice = 100
-        end_slice = min(161, len(slice_list))
+        end_slice = min(161, num_slices)
     return start_slice, end_slice
 
-def save_slice_as_image(orientation_path, file_name, slice_index, orientation, slice_img):
+# This function will guess the axis of each orientation from the dimensions of the volume
+def guess_orientation_axes(dimensions):
+    """
+    Same guess as guess_orientation_and_extract_all_slices: the smallest dimension is
+    Sagittal, the next is Coronal and the largest is Axial. Trailing axes of size 1 (OASIS-1
+    volumes are (176, 208, 176, 1)) are not spatial and are left out.
+    """
+    sorted_dims = np.argsort(get_spatial_dimensions(dimensions))  # Ascending order of dimensions
+    return {'Sagittal': int(sorted_dims[0]), 'Coronal': int(sorted_dims[1]), 'Axial': int(sorted_dims[2])}
+
+# This function will drop the trailing axes of size 1 of a volume shape
+def get_spatial_dimensions(dimensions):
+    dimensions = tuple(dimensions)
+    while len(dimensions) > 3 and dimensions[-1] == 1:
+        dimensions = dimensions[:-1]
+    return dimensions
+
+# This function will return the number of slice images saved for a scan, from its header only
+def get_expected_slice_count(file_paths):
+    """
+    :param file_paths: The file paths of the scan (.nii.gz, or .img and .hdr).
+    :return: The number of slices save_uint8_slices_as_images saves for it, or None if the header can't be read.
+    """
+    try:
+        dimensions = nib.load(file_paths[0]).shape
+    except Exception:
+        return None
+    slice_ranges = [determine_slice_range(orientation, dimensions[axis]) for orientation, axis in guess_orientation_axes(dimensions).items()]
+    return sum(max(end_slice - start_slice, 0) for start_slice, end_slice in slice_ranges)
+
+# This function will read only the slabs of the volume that will be saved
+def read_slice_slab_arrays(nii_data):
+    """
+    Reads the slice range of each orientation (see determine_slice_range) from the image proxy.
+
+    Parameters:
+    - nii_data: A nibabel image. Its data is not read in full.
+
+    Returns:
+    - slabs: Dictionary of {orientation: (start_slice, slab)}, with the slab's slices along its first axis.
+    - slice_counts: Number of slices of the full volume for each orientation.
+    """
+    dataobj = nii_data.dataobj
+    dimensions = dataobj.shape
+
+    slabs = {}
+    slice_counts = {}
+    for orientation, axis in guess_orientation_axes(dimensions).items():
+        slice_counts[orientation] = dimensions[axis]
+        start_slice, end_slice = determine_slice_range(orientation, dimensions[axis])
+        if start_slice >= end_slice:
+            continue
+
+        # Read the slab [start_slice, end_slice) along the orientation axis, dropping the trailing axes of size 1
+        spatial_ndim = len(get_spatial_dimensions(dimensions))
+        slab_slicer = [slice(None)] * spatial_ndim + [0] * (len(dimensions) - spatial_ndim)
+        slab_slicer[axis] = slice(start_slice, end_slice)
+        slabs[orientation] = (start_slice, np.moveaxis(np.asanyarray(dataobj[tuple(slab_slicer)]), axis, 0))
+
+    return slabs, slice_counts
+
+# This function will read only the slices of the volume that will be saved
+def read_slice_slabs(nii_data):
+    """
+    Same as read_slice_slab_arrays, with the slabs split into slices.
+
+    Returns:
+    - slices: Dictionary of {slice_index: slice} for each orientation, holding only the needed slices.
+    - slice_counts: Number of slices of the full volume for each orientation.
+    """
+    slabs, slice_counts = read_slice_slab_arrays(nii_data)
+    slices = {orientation: {} for orientation in slice_counts}
+    for orientation, (start_slice, slab) in slabs.items():
+        # Slices are views into the slab, not copies
+        for offset, slice_img in enumerate(slab):
+            slices[orientation][start_slice + offset] = slice_img
+    return slices, slice_counts
+
+# This function will go from a volume straight to fixed-shape uint8 slices
+def read_uint8_slices(nii_data, slice_shape=(128, 128)):
+    """
+    Reads the saved slab of each orientation and scales, orients and resizes it in one pass
+    (see slab_to_uint8_images), without drawing or encoding any image.
+
+    :return: Dictionary of {slice_index: uint8 image} for each orientation.
+    """
+    slabs, slice_counts = read_slice_slab_arrays(nii_data)
+    images = {orientation: {} for orientation in slice_counts}
+    for orientation, (start_slice, slab) in slabs.items():
+        for offset, image in enumerate(slab_to_uint8_images(slab, slice_shape)):
+            images[orientation][start_slice + offset] = image
+    return images
+
+# This function will save uint8 slices as PNG images in the orientation folders
+def save_uint8_slices_as_images(file_name, images, output_directory, label, compress_level=1):
+    """
+    Saves the slices returned by read_uint8_slices with the names and folders of save_single_slice.
+    """
+    for orientation, slice_list in images.items():
+        orientation_path = Path(output_directory) / label / orientation
+        orientation_path.mkdir(parents=True, exist_ok=True)
+        for slice_index, image in slice_list.items():
+            file_path = orientation_path / f"Slice_{slice_index}_{file_name}_{orientation.lower()}_img.png"
+            # RGB so the notebooks can keep reading the images with [:, :, :3]
+            Image.fromarray(image).convert('RGB').save(file_path, compress_level=compress_level)
+
+def save_slice_as_image(orientation_path, file_name, slice_index, orientation, slice_img, image_size=(128, 128), compress_level=1):
     """
     Saves a single slice image to the specified orientation folder.
+
+    The slice is min-max scaled to uint8, transposed with the origin at the bottom (like
+    imshow(slice_img.T, cmap='gray', origin='lower')) and written with PIL as an RGB PNG
+    of `image_size`, without drawing a matplotlib figure.
     """
     filename = f"Slice_{slice_index}_{file_name}_{orientation.lower()}_img.png"
     file_path = orientation_path / filename
-    fig, ax = plt.subplots()
-    ax.imshow(slice_img.T, cmap='gray', origin='lower')
-    ax.axis('off')
-    fig.savefig(file_path, bbox_inches='tight', pad_inches=0)
-    plt.close(fig)
+    # RGB so the notebooks can keep reading the images with [:, :, :3]
+    image = Image.fromarray(slice_to_uint8_image(slice_img, image_size)).convert('RGB')
+    image.save(file_path, compress_level=compress_level)
 
 
 
@@ -0,0 +1,134 @@
+#################### IMPORTS ####################
+# ALL
+import os
+import sys
+import multiprocessing
+
+# AS
+import numpy as np
+
+# FROM
+from multiprocessing import shared_memory
+from PIL import Image
+
+#################### FUNCTIONS ####################
+
+# This function will attach to the shared memory block of the main process
+def attach_shared_memory(name):
+    """
+    The workers share the resource tracker of the main process, which unlinks the block, so
+    from Python 3.13 they attach without tracking it.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
+# This function will decode one image like the notebooks' process_image
+def decode_image(path, image_size=(128, 128), mode=None, channels=3):
+    """
+    Opens and resizes an image. With mode=None the image keeps its own mode and the first
+    `channels` channels are kept (np.array(img)[:, :, :3] in the notebooks); otherwise it is
+    converted to `mode` ('L', 'RGB', ...).
+
+    :return: The uint8 array, or None if the image can't be read or has the wrong shape.
+    """
+    try:
+        with Image.open(path) as img:
+            if mode is not None:
+                img = img.convert(mode)
+            if image_size is not None and img.size != (image_size[1], image_size[0]):
+                img = img.resize((image_size[1], image_size[0]))
+            img_array = np.asarray(img)
+    except (IOError, ValueError) as e:
+        print(f"Unable to process image file: {path} due to {e}")
+        return None
+
+    if channels is not None:
+        if img_array.ndim != 3 or img_array.shape[2] < channels:
+            return None
+        img_array = img_array[:, :, :channels]
+    return img_array
+
+# This function will decode a chunk of images straight into the shared output array
+def decode_chunk_into_shared_memory(chunk, shm_name, shape, image_size, mode, channels):
+    """
+    Worker side of decode_images. Only the indices of the images that failed are sent back.
+    """
+    start, paths = chunk
+    shm = attach_shared_memory(shm_name)
+    try:
+        output = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        failed = []
+        for offset, path in enumerate(paths):
+            index = start + offset
+            # 0 stands for a missing modality in the notebooks' samples
+            if path is None or (isinstance(path, (int, np.integer)) and path == 0):
+                output[index] = 0
+                continue
+            img_array = decode_image(path, image_size, mode, channels)
+            if img_array is None or img_array.shape != shape[1:]:
+                output[index] = 0
+                failed.append(index)
+            else:
+                output[index] = img_array
+        del output
+        return failed
+    finally:
+        shm.close()
+
+# This function will decode many images in worker processes into one array
+def decode_images(paths, image_size=(128, 128), mode=None, channels=3, num_workers=None, chunk_size=512):
+    """
+    Decodes and resizes images in worker processes, in chunks of `chunk_size` paths. Workers
+    write into one preallocated shared-memory array, so no image is pickled back.
+
+    Parameters:
+    - paths: Image paths. 0 or None gives an all-zero image (a missing modality).
+    - image_size: (height, width) of the output. None takes the size of the first image;
+      images of another size are then marked as failed.
+    - mode: PIL mode to convert to ('L', 'RGB', ...), or None to keep the image's mode.
+    - channels: Channels to keep (like [:, :, :3]), or None for single-channel modes like 'L'.
+    - num_workers: Worker processes (all CPUs by default). 0 decodes in this process.
+    - chunk_size: Paths per worker task.
+
+    Returns:
+    - images: uint8 array of shape (len(paths), height, width[, channels]).
+    - ok: Boolean array, False where the image could not be decoded (that image is all zeros).
+    """
+    paths = list(paths)
+    resize_size = image_size
+    if image_size is None:
+        first_path = next((path for path in paths if isinstance(path, str)), None)
+        if first_path is None:
+            raise ValueError("image_size is needed when there is no image path")
+        with Image.open(first_path) as img:
+            image_size = (img.size[1], img.size[0])
+
+    shape = (len(paths),) + tuple(image_size) + ((channels,) if channels is not None else ())
+    ok = np.ones(len(paths), dtype=bool)
+    if len(paths) == 0:
+        return np.zeros(shape, dtype=np.uint8), ok
+
+    nbytes = int(np.prod(shape))
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    try:
+        chunks = [(start, paths[start:start + chunk_size]) for start in range(0, len(paths), chunk_size)]
+        decode_args = (shm.name, shape, resize_size, mode, channels)
+
+        if num_workers == 0:
+            results = [decode_chunk_into_shared_memory(chunk, *decode_args) for chunk in chunks]
+        else:
+            num_workers = num_workers or os.cpu_count()
+            with multiprocessing.Pool(min(num_workers, len(chunks))) as pool:
+                results = pool.starmap(decode_chunk_into_shared_memory, [(chunk,) + decode_args for chunk in chunks])
+
+        for failed in results:
+            ok[failed] = False
+
+        # One copy out of the shared block so it can be released
+        images = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return images, ok
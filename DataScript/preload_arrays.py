@@ -0,0 +1,194 @@
+#################### IMPORTS ####################
+# ALL
+import os
+import json
+import argparse
+
+# AS
+import numpy as np
+
+#################### SETTINGS ####################
+
+# Labels of the training notebooks
+preload_label_mapping = {
+    'non_demented': 0,
+    'very_mild_demented': 1,
+    'mild_demented': 2,
+    'moderate_demented': 3,
+}
+
+# Shape of one (MRI, CT, PET) sample of the training notebooks
+preload_sample_shape = (3, 128, 128, 3)
+
+preload_format_name = 'oasis-preload'
+preload_format_version = 1
+
+#################### FUNCTIONS ####################
+
+# This function will return the paths of the header, data and labels files of a preload
+def get_preload_paths(path_prefix):
+    return {
+        'header': path_prefix + '.json',
+        'data': path_prefix + '.data.u8',
+        'labels': path_prefix + '.labels.i64',
+    }
+
+# This class will write (MRI, CT, PET) samples into a raw uint8 file with a JSON header
+class PreloadArrayWriter:
+    """
+    Writes samples one at a time into `<path_prefix>.data.u8` (C-ordered uint8) and their labels
+    into `<path_prefix>.labels.i64`. The `<path_prefix>.json` header, holding the shape, label
+    mapping and sampling parameters, is written on close, so a preload without a header is
+    unfinished.
+
+    Nothing is pickled, and the whole dataset never has to be in memory.
+
+    Usage:
+        with PreloadArrayWriter(results_folder + '/train_5000', len(samples)) as writer:
+            for sample, label in zip(samples, labels):
+                writer.append(sample, label)
+    """
+
+    def __init__(self, path_prefix, num_samples, sample_shape=preload_sample_shape, label_mapping=None, sampling=None):
+        self.paths = get_preload_paths(path_prefix)
+        self.num_samples = int(num_samples)
+        self.sample_shape = tuple(sample_shape)
+        self.label_mapping = preload_label_mapping if label_mapping is None else label_mapping
+        self.sampling = sampling or {}
+        self.count = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path_prefix)), exist_ok=True)
+        if os.path.exists(self.paths['header']):
+            os.remove(self.paths['header'])
+        self.data = np.memmap(self.paths['data'], dtype=np.uint8, mode='w+', shape=(max(self.num_samples, 1),) + self.sample_shape)
+        self.labels = np.memmap(self.paths['labels'], dtype=np.int64, mode='w+', shape=(max(self.num_samples, 1),))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # A failed run leaves no header, so it can't be opened as a complete preload
+        self.close(write_header=exc_type is None)
+
+    # This function will add one sample
+    def append(self, sample, label):
+        """
+        Adds a sample. Float samples holding 0-255 pixel values (like the notebooks' np.zeros padding) are rounded to uint8.
+        """
+        if self.count >= self.num_samples:
+            raise ValueError(f"The preload was created for {self.num_samples} samples")
+
+        sample = np.asarray(sample)
+        if sample.dtype == object:
+            # The pickled notebook arrays hold lists of per-modality arrays
+            sample = np.asarray(sample.tolist(), dtype=np.float64)
+        if sample.shape != self.sample_shape:
+            raise ValueError(f"Sample shape {sample.shape} is not {self.sample_shape}")
+        if sample.dtype != np.uint8:
+            sample = np.clip(np.rint(sample), 0, 255).astype(np.uint8)
+
+        self.data[self.count] = sample
+        self.labels[self.count] = int(label)
+        self.count += 1
+
+    # This function will flush the arrays, drop the unused rows and write the header
+    def close(self, write_header=True):
+        if self.data is None:
+            return
+
+        self.data.flush()
+        self.labels.flush()
+        self.data, self.labels = None, None
+
+        # Samples can be skipped (unreadable images), so the files are cut to the samples written
+        sample_bytes = int(np.prod(self.sample_shape))
+        os.truncate(self.paths['data'], self.count * sample_bytes)
+        os.truncate(self.paths['labels'], self.count * np.dtype(np.int64).itemsize)
+        if not write_header:
+            return
+
+        header = {
+            'format': preload_format_name,
+            'version': preload_format_version,
+            'data_file': os.path.basename(self.paths['data']),
+            'labels_file': os.path.basename(self.paths['labels']),
+            'dtype': 'uint8',
+            'shape': [self.count] + list(self.sample_shape),
+            'labels_dtype': 'int64',
+            'label_mapping': self.label_mapping,
+            'sampling': self.sampling,
+        }
+        tmp_path = self.paths['header'] + '.tmp'
+        with open(tmp_path, 'w') as header_file:
+            json.dump(header, header_file, indent=2)
+        os.replace(tmp_path, self.paths['header'])
+
+# This function will save a whole array of samples
+def save_preload_arrays(path_prefix, data, labels, label_mapping=None, sampling=None):
+    """
+    Saves samples and their labels in the preload format.
+
+    :param path_prefix: Path of the preload without an extension, e.g. results_folder + '/train_5000'.
+    :param data: Samples, an array or any sequence of (MRI, CT, PET) samples.
+    :param labels: Label of each sample.
+    :param label_mapping: Dictionary of category name to label.
+    :param sampling: Sampling parameters to keep with the data (target samples, seed, ...).
+    """
+    sample_shape = np.shape(np.asarray(data[0]).tolist()) if len(data) else preload_sample_shape
+    with PreloadArrayWriter(path_prefix, len(data), sample_shape, label_mapping, sampling) as writer:
+        for sample, label in zip(data, labels):
+            writer.append(sample, label)
+
+# This function will open a preload without reading it
+def load_preload_arrays(path_prefix, mode='r'):
+    """
+    Opens a preload as memory maps. Nothing is read until it is used, and processes that open
+    the same preload share its pages.
+
+    :param path_prefix: Path of the preload without an extension.
+    :param mode: np.memmap mode ('r' read-only, 'c' copy-on-write).
+    :return: A tuple (data, labels, header). data has the header's shape, labels has one entry per sample.
+    """
+    paths = get_preload_paths(path_prefix)
+    if not os.path.exists(paths['header']):
+        raise FileNotFoundError(f"No preload header at {paths['header']} (the preload is missing or was not closed)")
+
+    with open(paths['header']) as header_file:
+        header = json.load(header_file)
+    if header.get('format') != preload_format_name or header.get('version') != preload_format_version:
+        raise ValueError(f"{paths['header']} is not a version {preload_format_version} {preload_format_name} header")
+
+    shape = tuple(header['shape'])
+    directory = os.path.dirname(os.path.abspath(paths['header']))
+    if shape[0] == 0:
+        return np.empty(shape, dtype=header['dtype']), np.empty((0,), dtype=header['labels_dtype']), header
+
+    data = np.memmap(os.path.join(directory, header['data_file']), dtype=header['dtype'], mode=mode, shape=shape)
+    labels = np.memmap(os.path.join(directory, header['labels_file']), dtype=header['labels_dtype'], mode=mode, shape=(shape[0],))
+    return data, labels, header
+
+# This function will convert the pickled data_{n}.h5.npy / results_{n}.h5.npy files once
+def convert_legacy_preload(data_path, results_path, path_prefix, label_mapping=None, sampling=None):
+    """
+    Converts a preload saved with np.save(..., allow_pickle=True) by the notebooks.
+
+    :param data_path: Path of the data_{n}.h5.npy file.
+    :param results_path: Path of the results_{n}.h5.npy file.
+    :param path_prefix: Path of the new preload without an extension.
+    """
+    data = np.load(data_path, allow_pickle=True)
+    results = np.load(results_path, allow_pickle=True)
+    print(f"Converting {len(data)} samples from {data_path}")
+    save_preload_arrays(path_prefix, data, results, label_mapping, sampling)
+    print(f"Saved {get_preload_paths(path_prefix)['header']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a pickled data/results .npy preload of the notebooks into the memory-mappable preload format.')
+    parser.add_argument('data_path', type=str, help="Path of the data_{n}.h5.npy file.")
+    parser.add_argument('results_path', type=str, help="Path of the results_{n}.h5.npy file.")
+    parser.add_argument('path_prefix', type=str, help="Path of the new preload without an extension, e.g. preload/train_5000.")
+    parser.add_argument('--target-samples', type=int, default=None, help="Target samples per class used to build the preload, saved in the header.")
+    parser.add_argument('--seed', type=int, default=42, help="Random seed used to build the preload, saved in the header.")
+    args = parser.parse_args()
+
+    convert_legacy_preload(args.data_path, args.results_path, args.path_prefix, sampling={'target_samples': args.target_samples, 'seed': args.seed})
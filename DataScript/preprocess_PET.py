@@ -1,27 +1,53 @@
 import matplotlib
 import os
 import sys
+import pathlib
+import argparse
+# Append the parent folder to the python path 
+# Get the current script's path
+notebook_path = os.path.join(os.path.dirname(os.path.abspath('preprocess_PET.py')))
+
+# Append the parent directory of the current script's directory to the path
+sys.path.append(str(pathlib.Path(notebook_path).parent.resolve()))
 
 import matplotlib.pyplot as plt
 import nibabel as nib
 import numpy as np
 
-def find_highest_variance_time_points(img_data, num_points=5):
+from PIL import Image
+
+from DataScript.scan_manifest import *
+from DataScript.shard_partition import *
+from DataScript.slice_store import *
+from DataScript.volume_cache import *
+
+# Largest float64 copy of a dynamic PET scan computed in one reduction; larger scans are read frame by frame
+frame_variance_max_bytes = 1 << 30
+
+def find_highest_variance_time_points(img_data, num_points=5, max_bytes=frame_variance_max_bytes):
     """
     Identify time points with the highest variance in 4D PET scan data.
 
     Parameters:
     - img_data: 4D numpy array of the PET scan data.
     - num_points: Number of time points to select based on highest variance.
+    - max_bytes: Largest float64 copy of the scan reduced in one step; larger scans are reduced frame by frame.
 
     Returns:
     - top_variance_time_points: Indices of time points with the highest variance.
     """
-    variance_list = []
-    for time_point in range(img_data.shape[-1]):
-        time_point_data = img_data[..., time_point]
-        variance_list.append(np.var(time_point_data))
+    if img_data.size * 8 <= max_bytes:
+        # One reduction over the spatial axes gives the variance of every frame
+        variance_list = np.var(img_data, axis=tuple(range(img_data.ndim - 1)), dtype=np.float64)
+    else:
+        # Only one frame is copied at a time
+        variance_list = np.array([np.var(img_data[..., time_point], dtype=np.float64) for time_point in range(img_data.shape[-1])])
 
+    return select_highest_variance_time_points(variance_list, num_points)
+def select_highest_variance_time_points(variance_list, num_points=5):
+    """
+    Return the indices of the `num_points` largest variances in temporal order.
+    """
     # Get indices of the top `num_points` variances
     top_variance_indices = np.argsort(variance_list)[-num_points:]
 
@@ -33,6 +59,65 @@ def find_highest_variance_time_points(img_data, num_points=5):
     #     print(f"Time point {idx} has variance: {variance_list[idx]}")
 
     return top_variance_time_points
+def iter_pet_frames(nii_img):
+    """
+    Yield the frames of a 4D PET image one at a time, without loading the whole scan.
+
+    NIfTI data is stored frame after frame, so a .nii/.nii.gz file is read in a single
+    sequential pass (a compressed file is inflated once). Other images are read through
+    their proxy one frame at a time.
+
+    Parameters:
+    - nii_img: A 4D image returned by nib.load or load_cached_nii.
+
+    Returns:
+    - A generator of (time point, frame as a 3D float64 array, scaled like get_fdata).
+    """
+    dataobj = nii_img.dataobj
+    shape = dataobj.shape
+    file_like = getattr(dataobj, 'file_like', None)
+
+    if nib.is_proxy(dataobj) and isinstance(file_like, str) and getattr(dataobj, 'order', 'F') == 'F':
+        frame_shape = shape[:3]
+        frame_bytes = int(np.prod(frame_shape)) * dataobj.dtype.itemsize
+        slope, inter = dataobj.slope, dataobj.inter
+        with nib.openers.ImageOpener(file_like) as image_file:
+            image_file.seek(dataobj.offset)
+            for time_point in range(shape[3]):
+                raw_frame = np.frombuffer(image_file.read(frame_bytes), dtype=dataobj.dtype).reshape(frame_shape, order='F')
+                yield time_point, raw_frame * np.float64(slope) + np.float64(inter)
+        return
+
+    for time_point in range(shape[3]):
+        yield time_point, np.asarray(dataobj[..., time_point], dtype=np.float64)
+def compute_frame_variances(nii_img, max_bytes=frame_variance_max_bytes):
+    """
+    Compute the variance of every frame of a 4D PET image.
+
+    Scans whose float64 copy fits in `max_bytes` are read once and reduced in one step;
+    larger scans are streamed frame by frame (see iter_pet_frames), holding one frame at a time.
+
+    Returns:
+    - A 1D float64 array with the variance of each time point.
+    """
+    shape = nii_img.dataobj.shape
+    if int(np.prod(shape)) * 8 <= max_bytes:
+        return np.var(np.asanyarray(nii_img.dataobj), axis=(0, 1, 2), dtype=np.float64)
+
+    variance_list = np.empty(shape[3], dtype=np.float64)
+    for time_point, frame in iter_pet_frames(nii_img):
+        variance_list[time_point] = np.var(frame)
+    return variance_list
+def load_highest_variance_frames(nii_img, num_points=1, max_bytes=frame_variance_max_bytes):
+    """
+    Select the frames of a 4D PET image with the highest variance and load only those.
+
+    Returns:
+    - A dictionary of {time point: 3D float64 frame}, the input of extract_all_slices_optimized.
+    """
+    variance_list = compute_frame_variances(nii_img, max_bytes)
+    time_points = select_highest_variance_time_points(variance_list, num_points)
+    return {int(time_point): np.asarray(nii_img.dataobj[..., int(time_point)], dtype=np.float64) for time_point in time_points}
 def guess_orientation_and_extract_all_slices(img_data):
 
     # Guess orientations based on dimensions
@@ -64,14 +149,20 @@ def extract_all_slices_optimized(img_data):
     Optimized function to extract all slices from a 3D or 4D PET scan data in Sagittal, Coronal, and Axial orientations.
 
     Parameters:
-    - img_data: 3D or 4D numpy array of the PET scan data.
+    - img_data: 3D or 4D numpy array of the PET scan data, or a dictionary of {time point: 3D frame}
+      of the selected frames (see load_highest_variance_frames).
 
     Returns:
     A dictionary containing all slices for Sagittal, Coronal, and Axial orientations.
     """
+    # The frames of a 4D scan, with the highest variance one only
+    frames = img_data
+    if not isinstance(img_data, dict) and img_data.ndim == 4:
+        frames = {time_point: img_data[:,:,:,time_point] for time_point in find_highest_variance_time_points(img_data, 1)}
+
     # print(img_data.shape)
     # Guess orientations based on dimensions (excluding time if 4D)
-    spatial_dimensions = img_data.shape[:-1] if img_data.ndim == 4 else img_data.shape
+    spatial_dimensions = next(iter(frames.values())).shape if isinstance(frames, dict) else img_data.shape
     # print(spatial_dimensions)
     sorted_dims = np.argsort(spatial_dimensions)  # Ascending order of dimensions
     
@@ -81,22 +172,19 @@ def extract_all_slices_optimized(img_data):
 
     orientations = {}
 
-    useful_time_points = find_highest_variance_time_points(img_data, 1) 
-    # print(f"Useful time points: {useful_time_points}")
-    
-    for time_point in useful_time_points:
-
-    # time_point = img_data.shape[-1] - 1
+    # Extract slices for each orientation
+    if not isinstance(frames, dict):  # For 3D data
+        orientations['Sagittal'] = img_data.swapaxes(0, sagittal_index)
+        orientations['Coronal'] = img_data.swapaxes(0, coronal_index)
+        orientations['Axial'] = img_data.swapaxes(0, axial_index)
+        return orientations
 
-        # Extract slices for each orientation
-        if img_data.ndim == 3:  # For 3D data
-            orientations['Sagittal'] = img_data.swapaxes(0, sagittal_index)
-            orientations['Coronal'] = img_data.swapaxes(0, coronal_index)
-            orientations['Axial'] = img_data.swapaxes(0, axial_index)
-        elif img_data.ndim == 4:  # For 4D data, selecting the first time point for simplicity
-            orientations[f'Sagittal_time_point_{time_point}'] = img_data[:,:,:,time_point].swapaxes(0, sagittal_index)
-            orientations[f'Coronal_time_point_{time_point}'] = img_data[:,:,:,time_point].swapaxes(0, coronal_index)
-            orientations[f'Axial_time_point{time_point}'] = img_data[:,:,:,time_point].swapaxes(0, axial_index)
+    # print(f"Useful time points: {list(frames)}")
+    for time_point, frame in frames.items():
+        # For 4D data, the selected time points only
+        orientations[f'Sagittal_time_point_{time_point}'] = frame.swapaxes(0, sagittal_index)
+        orientations[f'Coronal_time_point_{time_point}'] = frame.swapaxes(0, coronal_index)
+        orientations[f'Axial_time_point{time_point}'] = frame.swapaxes(0, axial_index)
 
     return orientations
 def get_slice_range(scan, tracer):
@@ -135,7 +223,7 @@ def extract_and_select_slices(img_data, tracer):
         if 'Axial' in key:
             axial_slices = orientations[key]
             # print(axial_slices.shape)
-            num_axial_slices = axial_slices.shape[-1] if img_data.ndim == 4 else axial_slices.shape[2]
+            num_axial_slices = axial_slices.shape[2]
             
             # Get start and end slice based on tracer
             start_slice, end_slice = get_slice_range(num_axial_slices, tracer)
@@ -168,6 +256,53 @@ def display_selected_slices(selected_axial_slices, filename, key, output_base_di
         # plt.show()
         plt.savefig(f"{output_base_directory}/Slice_{i}_{filename}_{key}.png")
         plt.close()
+def scale_slab_to_uint8(selected_axial_slices):
+    """
+    Scale each slice of a slab to 0-255 (like imshow's default vmin and vmax) in one pass.
+
+    Parameters:
+    - selected_axial_slices: 3D array of slices, the slice index is the last axis.
+
+    Returns:
+    - A (slice, y, x) uint8 array, each slice transposed with the origin at the bottom like imshow(slice.T, origin='lower').
+    """
+    slab = np.nan_to_num(np.asarray(selected_axial_slices, dtype=np.float32))
+
+    min_values = slab.min(axis=(0, 1), keepdims=True)
+    ranges = slab.max(axis=(0, 1), keepdims=True) - min_values
+    ranges[ranges == 0] = 1
+    indices = ((slab - min_values) * (255.0 / ranges)).astype(np.uint8)
+
+    # (x, y, slice) -> (slice, y, x) with y flipped
+    return np.ascontiguousarray(indices.transpose(2, 1, 0)[:, ::-1, :])
+def get_colormap_lut(cmap_name='hot'):
+    """
+    Return the 256 RGB colours of a matplotlib colormap as a (256, 3) uint8 lookup table.
+    """
+    return (plt.get_cmap(cmap_name)(np.arange(256))[:, :3] * 255).round().astype(np.uint8)
+def export_selected_slices(selected_axial_slices, filename, key, output_base_directory, image_size=None, cmap_name='hot'):
+    """
+    Save the selected axial slices as colormapped PNGs without drawing a figure per slice.
+
+    The whole slab is scaled per slice to 0-255 (like imshow's default vmin and vmax) and
+    coloured with one lookup table indexing step. The images are transposed with the origin
+    at the bottom, like display_selected_slices shows them, but without the title and margins.
+
+    Parameters:
+    - selected_axial_slices: 3D array of the selected slices, the slice index is the last axis.
+    - filename: Name of the PET file.
+    - key: Orientation and time point of the slices.
+    - output_base_directory: Folder the images are saved in.
+    - image_size: (width, height) to resize the images to. None keeps the native resolution.
+    - cmap_name: Matplotlib colormap to apply.
+    """
+    rgb_slices = get_colormap_lut(cmap_name)[scale_slab_to_uint8(selected_axial_slices)]
+
+    for i, rgb_slice in enumerate(rgb_slices):
+        image = Image.fromarray(rgb_slice)
+        if image_size is not None:
+            image = image.resize(image_size, Image.BILINEAR)
+        image.save(f"{output_base_directory}/Slice_{i}_{filename}_{key}.png", compress_level=1)
 def return_tracer(file_path):
     """
     Return the tracer used in the PET scan based on the file name.
@@ -184,7 +319,19 @@ def return_tracer(file_path):
         raise ValueError("Unknown tracer. Please use 'AV45', 'PIB', or 'FDG'.")
                 
     
-def main(root_directory_path):
+def main(root_directory_path, manifest=None, export_mode='figure', image_size=None, shard=None):
+    """
+    Export the selected PET slices of every .nii.gz file under <root_directory_path>/Original.
+
+    Parameters:
+    - root_directory_path: Root directory holding the Original folder.
+    - manifest: Scan manifest of the root directory. It is built if not given.
+    - export_mode: 'figure' draws each slice with display_selected_slices, 'native' writes them with export_selected_slices,
+      'hdf5' writes the scaled slices into <root_directory_path>/Processed/slices.h5 (see slice_store.py).
+    - image_size: (width, height) of the 'native' and 'hdf5' images. None keeps the native resolution.
+    - shard: (index, count) to export only the subjects of one shard (see shard_partition.py). The 'hdf5' store of a
+      shard is Processed/slices.shard-<index>-of-<count>.h5, combined by merge_shard_outputs.
+    """
 
     # Example usage
     original_directory_path = root_directory_path + "/Original"
@@ -197,29 +344,76 @@ def main(root_directory_path):
 
     completed_files_count = 0  # Initialize the counter
 
+    # Walk the original data once; the manifest gives both the count and the files
+    if manifest is None:
+        manifest = build_scan_manifest(original_directory_path)
+    else:
+        manifest = manifest_files_under(manifest, original_directory_path)
+    pet_files = filter_manifest_to_shard(manifest[manifest['name'].str.endswith(".nii.gz")], shard)
+
     # get length of files that end with .nii.gz
-    scan_length = 0
-    for root, dirs, files in os.walk(original_directory_path):
-        for file in files:
-            if file.endswith(".nii.gz"):
-                scan_length += 1
-
-    for root, dirs, files in os.walk(original_directory_path):
-        for file in files:
-            if file.endswith(".nii.gz"):
-                nii_gz_file_path = os.path.join(root, file)
-                img_data = nib.load(nii_gz_file_path).get_fdata()
-                result = extract_and_select_slices(img_data, return_tracer(nii_gz_file_path))
-                for key, value in result.items():
-                    # print(key, value.shape)
-                    display_selected_slices(value, file, key, processed_directory_path)
-                
-                completed_files_count += 1  # Increment the counter after processing each file
-                print(f"Completed: {completed_files_count}/{scan_length} - {file}")
+    scan_length = len(pet_files)
+
+    store_writer = SliceStoreWriter(get_shard_path(os.path.join(processed_directory_path, 'slices.h5'), shard), 'PET') if export_mode == 'hdf5' else None
+    if store_writer is not None:
+        # Scans already in the store (from an earlier run) are not exported again
+        written = pet_files['name'].str.replace('.nii.gz', '', regex=False).isin(store_writer.written_files)
+        pet_files = pet_files[~written]
+        print(f"Skipping {written.sum()} scans already written")
+        scan_length = len(pet_files)
+
+    for file, nii_gz_file_path in zip(pet_files['name'], pet_files['path']):
+        nii_img = load_cached_nii(nii_gz_file_path)
+        if len(nii_img.shape) == 4:
+            # Dynamic scans: only the highest variance frame is loaded
+            img_data = load_highest_variance_frames(nii_img, 1)
+        else:
+            img_data = nii_img.get_fdata()
+        result = extract_and_select_slices(img_data, return_tracer(nii_gz_file_path))
+
+        if store_writer is not None:
+            # Grey slices are stored; the 'hot' colormap is applied when reading (see get_colormap_lut)
+            slices = {}
+            for key, value in result.items():
+                scaled_slices = scale_slab_to_uint8(value)
+                if image_size is not None:
+                    scaled_slices = [np.asarray(Image.fromarray(scaled_slice).resize(image_size, Image.BILINEAR)) for scaled_slice in scaled_slices]
+                slices[key] = dict(enumerate(scaled_slices))
+            store_writer.write_scan(file.replace('.nii.gz', ''), None, slices, {'tracer': return_tracer(nii_gz_file_path), 'colormap': 'hot'})
+            completed_files_count += 1
+            print(f"Completed: {completed_files_count}/{scan_length} - {file}")
+            continue
+
+        for key, value in result.items():
+            # print(key, value.shape)
+            if export_mode == 'native':
+                export_selected_slices(value, file, key, processed_directory_path, image_size)
+            else:
+                display_selected_slices(value, file, key, processed_directory_path)
+        
+        completed_files_count += 1  # Increment the counter after processing each file
+        print(f"Completed: {completed_files_count}/{scan_length} - {file}")
+
+    if store_writer is not None:
+        store_writer.close()
 
     print(f"Total files processed: {completed_files_count}")
 
 
 if __name__ == "__main__":
-    root_directory_path = sys.argv[1]
-    main(root_directory_path)           
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Export the selected PET slices under <root_directory>/Original into <root_directory>/Processed')
+    parser.add_argument('root_directory_path', type=str, help="Root directory holding the Original folder.")
+    parser.add_argument('--reuse-manifest', action='store_true', help="Reuse the saved scan manifest instead of walking the root directory again.")
+    parser.add_argument('--export-mode', choices=['figure', 'native', 'hdf5'], default='figure', help="'figure' draws a 20x15-inch figure per slice, 'native' writes the 'hot' colormapped slices directly, 'hdf5' stores them in Processed/slices.h5.")
+    parser.add_argument('--image-size', type=int, default=None, help="Side of the square 'native' and 'hdf5' images, e.g. 128. The native resolution is kept if not given.")
+    parser.add_argument('--shard', type=parse_shard, default=None, help="Export only shard i of n (e.g. 0/4), the subjects whose OASISID hashes to i. Each machine runs one shard.")
+    parser.add_argument('--merge-shards', action='store_true', help="Merge the slice stores of the finished shards into Processed/slices.h5, without exporting.")
+    args = parser.parse_args()
+
+    root_directory_path = args.root_directory_path
+    if args.merge_shards:
+        merge_shard_outputs(os.path.join(root_directory_path, "Processed"))
+        sys.exit(0)
+
+    manifest = load_or_build_scan_manifest(root_directory_path, get_shard_path(os.path.join(root_directory_path, "Processed", "scan_manifest.csv"), args.shard), refresh=not args.reuse_manifest)
+    main(root_directory_path, manifest, args.export_mode, (args.image_size, args.image_size) if args.image_size else None, args.shard)           
\ No newline at end of file
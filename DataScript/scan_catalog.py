@@ -0,0 +1,332 @@
+#################### IMPORTS ####################
+# ALL
+import os
+import re
+import sqlite3
+
+# AS
+import pandas as pd
+
+# FROM FILE
+from DataScript.load_metadata import *
+from DataScript.scan_manifest import *
+
+#################### SETTINGS ####################
+
+# Tables of the catalog. Scans are keyed by path and indexed by OASISID, session day,
+# modality and filename; sessions and clinical labels are keyed by OASISID.
+scan_catalog_schema = """
+CREATE TABLE IF NOT EXISTS scans (
+    path TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    file_name_wout_format TEXT NOT NULL,
+    file_format TEXT,
+    oasis_dataset_number INTEGER,
+    oasisid TEXT,
+    session_label TEXT,
+    session_day INTEGER,
+    modality TEXT,
+    acq TEXT,
+    run_id TEXT,
+    subdirectory TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    label_id REAL,
+    label TEXT
+);
+CREATE INDEX IF NOT EXISTS scans_by_filename ON scans (file_name_wout_format);
+CREATE INDEX IF NOT EXISTS scans_by_session ON scans (oasisid, session_day);
+CREATE INDEX IF NOT EXISTS scans_by_modality ON scans (modality);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    oasisid TEXT NOT NULL,
+    session_label TEXT NOT NULL,
+    session_day INTEGER,
+    oasis_dataset_number INTEGER,
+    PRIMARY KEY (oasisid, session_label)
+);
+
+CREATE TABLE IF NOT EXISTS clinical_labels (
+    dataset TEXT NOT NULL,
+    oasisid TEXT NOT NULL,
+    clinical_data_id TEXT NOT NULL,
+    days_to_visit INTEGER,
+    cdr REAL,
+    PRIMARY KEY (dataset, clinical_data_id)
+);
+CREATE INDEX IF NOT EXISTS clinical_labels_by_visit ON clinical_labels (oasisid, days_to_visit);
+"""
+
+# File formats that are scans (the rest of the tree is csv, json, ifh, ...)
+scan_catalog_formats = ['nii.gz', 'img', 'hdr']
+
+#################### FUNCTIONS ####################
+
+# This function will parse the catalog columns of a scan from its path
+def get_scan_catalog_row(path, name, size, mtime_ns):
+    """
+    Parses a scan file with get_info_from_filename.
+
+    :param path: Full path of the file.
+    :param name: File name.
+    :param size: File size in bytes.
+    :param mtime_ns: Modification time of the file.
+    :return: A dictionary with the scans table columns, or None if the file is not a scan.
+    """
+    file_format = extract_file_format(name)
+    if file_format not in scan_catalog_formats or 'PROCESSED' in path or 'FSL_SEG' in path:
+        return None
+
+    # OASIS 2 raw files (mpr-1.nifti.img) only get their subject and session from the folder
+    info_name = name
+    patient_folder = re.search(r'OAS2_\d{4}_MR\d+', path)
+    if patient_folder and not name.startswith('OAS2'):
+        info_name = f"{patient_folder.group(0)}_{name}"
+
+    oasis_dataset_number, patient_id, mri_type, mr_id, run_id, acq, echo, scan_id, average_image_id, subdirectory, subsubdirectory, masked, _ = get_info_from_filename(info_name)
+    if oasis_dataset_number is None:
+        return None
+
+    oasis_dataset_number = int(oasis_dataset_number)
+    session_day = None
+    if oasis_dataset_number in [1, 2]:
+        oasisid = f"OAS{oasis_dataset_number}_{patient_id}"
+        session_label = f"{oasisid}_MR{mr_id}"
+    else:
+        oasisid = f"OAS{oasis_dataset_number}{patient_id}"
+        # PET file names carry the session day and tracer outside the fields get_info_from_filename returns
+        session = re.search(r'ses-d(\d+)', name)
+        tracer = re.search(r'acq-(PIB|FDG|AV45)_pet', name)
+        if session:
+            session_day = int(session.group(1))
+        if tracer:
+            mri_type, acq = 'pet', tracer.group(1)
+        session_label = f"{oasisid}_d{session.group(1) if session else mr_id}"
+
+    return {
+        'path': path,
+        'name': name,
+        'file_name_wout_format': remove_file_extension(name),
+        'file_format': file_format,
+        'oasis_dataset_number': oasis_dataset_number,
+        'oasisid': oasisid,
+        'session_label': session_label,
+        'session_day': session_day,
+        'modality': mri_type,
+        'acq': acq.strip('_').replace('acq-', '') if acq else None,
+        'run_id': run_id.strip('_') if run_id else None,
+        'subdirectory': subdirectory,
+        'size': int(size),
+        'mtime_ns': int(mtime_ns),
+    }
+
+# This class will keep the scan, session and clinical label tables in an SQLite file
+class ScanCatalog:
+    """
+    Persistent, indexed catalog of the scans of a data folder.
+
+    The catalog is updated incrementally from the scan manifest: only files that are new or
+    whose size or mtime changed are parsed again. Lookups use the table indexes instead of
+    scanning the reference dataframe.
+
+    Usage:
+        with ScanCatalog(preprocessed_data_path + 'scan_catalog.sqlite') as catalog:
+            catalog.update_from_manifest(manifest)
+            label = catalog.label_for('sub-OAS30001_ses-d0129_run-01_T1w')
+    """
+
+    # This function will open (and create if needed) the catalog file
+    def __init__(self, catalog_path):
+        self.catalog_path = catalog_path
+        os.makedirs(os.path.dirname(os.path.abspath(catalog_path)), exist_ok=True)
+        self.connection = sqlite3.connect(catalog_path)
+        # WAL lets pool workers read the catalog while the main process writes it
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(scan_catalog_schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # This function will close the catalog
+    def close(self):
+        self.connection.close()
+
+    # This function will add new or changed scans of the manifest and drop the removed ones
+    def update_from_manifest(self, manifest, prune=True):
+        """
+        Updates the scans and sessions tables from a scan manifest.
+
+        :param manifest: The scan manifest (see scan_manifest.py) of the data folder.
+        :param prune: If True, scans that are no longer in the manifest are removed.
+        :return: A tuple with the number of scans added or updated and the number removed.
+        """
+        known = dict(((path, (size, mtime_ns)) for path, size, mtime_ns in self.connection.execute('SELECT path, size, mtime_ns FROM scans')))
+
+        rows = []
+        manifest_paths = set()
+        for path, name, size, mtime_ns in zip(manifest['path'], manifest['name'], manifest['size'], manifest['mtime_ns']):
+            manifest_paths.add(path)
+            if known.get(path) == (int(size), int(mtime_ns)):
+                continue
+            row = get_scan_catalog_row(path, name, size, mtime_ns)
+            if row is not None:
+                rows.append(row)
+
+        removed_paths = [(path,) for path in known if path not in manifest_paths] if prune else []
+
+        with self.connection:
+            # A changed file is parsed again and loses its label until update_labels_from_ref_df runs again
+            self.connection.executemany("""
+                INSERT INTO scans (path, name, file_name_wout_format, file_format, oasis_dataset_number, oasisid, session_label, session_day, modality, acq, run_id, subdirectory, size, mtime_ns)
+                VALUES (:path, :name, :file_name_wout_format, :file_format, :oasis_dataset_number, :oasisid, :session_label, :session_day, :modality, :acq, :run_id, :subdirectory, :size, :mtime_ns)
+                ON CONFLICT (path) DO UPDATE SET
+                    name = excluded.name, file_name_wout_format = excluded.file_name_wout_format, file_format = excluded.file_format,
+                    oasis_dataset_number = excluded.oasis_dataset_number, oasisid = excluded.oasisid, session_label = excluded.session_label,
+                    session_day = excluded.session_day, modality = excluded.modality, acq = excluded.acq, run_id = excluded.run_id,
+                    subdirectory = excluded.subdirectory, size = excluded.size, mtime_ns = excluded.mtime_ns, label_id = NULL, label = NULL
+            """, rows)
+            self.connection.executemany('DELETE FROM scans WHERE path = ?', removed_paths)
+
+            self.connection.execute("""
+                INSERT OR REPLACE INTO sessions (oasisid, session_label, session_day, oasis_dataset_number)
+                SELECT DISTINCT oasisid, session_label, session_day, oasis_dataset_number FROM scans
+            """)
+            self.connection.execute('DELETE FROM sessions WHERE (oasisid, session_label) NOT IN (SELECT oasisid, session_label FROM scans)')
+
+        print(f"Scan catalog: {len(rows)} scans added or updated, {len(removed_paths)} removed")
+        return len(rows), len(removed_paths)
+
+    # This function will save the labels of the reference dataframe in the scans table
+    def update_labels_from_ref_df(self, ref_df):
+        """
+        Saves the label_id and label columns of a reference dataframe (see create_ref_df).
+
+        :param ref_df: The reference dataframe, matched to the catalog on its path column.
+        """
+        rows = []
+        for path, label_id, label in zip(ref_df['path'], ref_df['label_id'], ref_df['label']):
+            if isinstance(label, pd.Series):
+                label = label.iloc[0] if len(label) else None
+            label_id = pd.to_numeric(label_id, errors='coerce')
+            rows.append((None if pd.isna(label_id) else float(label_id), None if pd.isna(label) else str(label), path))
+
+        with self.connection:
+            self.connection.executemany('UPDATE scans SET label_id = ?, label = ? WHERE path = ?', rows)
+
+    # This function will replace the clinical labels with the given CDR tables
+    def update_clinical_labels(self, cdr_dfs):
+        """
+        Saves the CDR tables (see load_cdr_dataframes) in the clinical_labels table.
+
+        :param cdr_dfs: A dictionary of CDR DataFrames keyed by dataset.
+        """
+        with self.connection:
+            for dataset, cdr_df in cdr_dfs.items():
+                if 'OASISID' not in cdr_df.columns or 'CDR' not in cdr_df.columns:
+                    continue
+
+                clinical_data_ids = cdr_df['CLINICALDATAID'] if 'CLINICALDATAID' in cdr_df.columns else cdr_df['OASISID']
+                days_to_visit = cdr_df['days_to_visit'] if 'days_to_visit' in cdr_df.columns else pd.Series([None] * len(cdr_df), index=cdr_df.index)
+                cdr = pd.to_numeric(cdr_df['CDR'], errors='coerce')
+
+                rows = []
+                for oasisid, clinical_data_id, day, label_id in zip(cdr_df['OASISID'], clinical_data_ids, days_to_visit, cdr):
+                    if pd.isna(oasisid) or pd.isna(clinical_data_id):
+                        continue
+                    # OASIS 1 keeps the session (OAS1_0001_MR1) in its OASISID column
+                    oasisid = re.sub(r'_MR\d+$', '', str(oasisid))
+                    rows.append((dataset, oasisid, str(clinical_data_id), None if pd.isna(day) else int(day), None if pd.isna(label_id) else float(label_id)))
+
+                self.connection.execute('DELETE FROM clinical_labels WHERE dataset = ?', (dataset,))
+                self.connection.executemany('INSERT OR REPLACE INTO clinical_labels VALUES (?, ?, ?, ?, ?)', rows)
+
+    # This function will return the label of a scan from its file name without the format
+    def label_for(self, file_name_wout_format, default='unknown'):
+        row = self.connection.execute('SELECT label FROM scans WHERE file_name_wout_format = ? AND label IS NOT NULL ORDER BY path LIMIT 1', (file_name_wout_format,)).fetchone()
+        return row[0] if row else default
+
+    # This function will return a dictionary of file name without the format to label
+    def label_lookup(self):
+        """
+        Returns every labelled scan as {file_name_wout_format: label}, for code that does many lookups.
+        """
+        lookup = {}
+        for file_name_wout_format, label in self.connection.execute('SELECT file_name_wout_format, label FROM scans WHERE label IS NOT NULL ORDER BY path'):
+            lookup.setdefault(file_name_wout_format, label)
+        return lookup
+
+    # This function will return the scans matching the given OASISID, session day and modality
+    def get_scans(self, oasisid=None, session_day=None, modality=None):
+        """
+        Returns the scans matching every given argument.
+
+        :param oasisid: Subject id, e.g. 'OAS30001' or 'OAS1_0001'.
+        :param session_day: Session day (OASIS 3 and 4).
+        :param modality: 'T1w', 'T2w', 'pet', ...
+        :return: A DataFrame of scans table rows.
+        """
+        conditions, values = [], []
+        for column, value in [('oasisid', oasisid), ('session_day', session_day), ('modality', modality)]:
+            if value is not None:
+                conditions.append(f'{column} = ?')
+                values.append(value)
+
+        query = 'SELECT * FROM scans'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return pd.read_sql_query(query + ' ORDER BY path', self.connection, params=values)
+
+    # This function will return the sessions of a subject (or of every subject)
+    def get_sessions(self, oasisid=None):
+        if oasisid is None:
+            return pd.read_sql_query('SELECT * FROM sessions ORDER BY oasisid, session_day', self.connection)
+        return pd.read_sql_query('SELECT * FROM sessions WHERE oasisid = ? ORDER BY session_day', self.connection, params=[oasisid])
+
+    # This function will return the clinical labels of a subject
+    def get_clinical_labels(self, oasisid):
+        return pd.read_sql_query('SELECT * FROM clinical_labels WHERE oasisid = ? ORDER BY days_to_visit', self.connection, params=[oasisid])
+
+    # This function will return the clinical label closest to a session day
+    def closest_clinical_label(self, oasisid, session_day, lower_bound=180, upper_bound=180):
+        """
+        Returns the clinical label of a subject that is closest to a session day, like
+        matching_up_the_data_upper_lower does for one scan.
+
+        :param oasisid: Subject id.
+        :param session_day: Day of the scan session.
+        :param lower_bound: Days after the session an assessment may be.
+        :param upper_bound: Days before the session an assessment may be.
+        :return: A tuple (clinical_data_id, days_to_visit, cdr), or None if there is no assessment in the window.
+        """
+        return self.connection.execute("""
+            SELECT clinical_data_id, days_to_visit, cdr FROM clinical_labels
+            WHERE oasisid = ? AND days_to_visit > ? AND days_to_visit < ?
+            ORDER BY ABS(days_to_visit - ?) LIMIT 1
+        """, (oasisid, session_day - upper_bound, session_day + lower_bound, session_day)).fetchone()
+
+# This function will create or update the catalog of a root directory
+def build_scan_catalog(root_directory, catalog_path, manifest=None, ref_df=None, cdr_dfs=None):
+    """
+    Creates or updates the scan catalog of a root directory.
+
+    :param root_directory: Root directory holding the Original folder.
+    :param catalog_path: Path of the SQLite catalog file.
+    :param manifest: The scan manifest of root_directory; it is built (one walk) if not given.
+    :param ref_df: Reference dataframe (see create_ref_df) whose labels are saved in the catalog.
+    :param cdr_dfs: CDR tables (see load_cdr_dataframes); they are loaded if not given.
+    :return: The open ScanCatalog.
+    """
+    if manifest is None:
+        manifest = build_scan_manifest(root_directory)
+    if cdr_dfs is None:
+        cdr_dfs = load_cdr_dataframes(root_directory, manifest)
+
+    catalog = ScanCatalog(catalog_path)
+    catalog.update_from_manifest(manifest_files_under(manifest, root_directory + '/Original/'))
+    catalog.update_clinical_labels(cdr_dfs)
+    if ref_df is not None:
+        catalog.update_labels_from_ref_df(ref_df)
+    return catalog
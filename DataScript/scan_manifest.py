@@ -0,0 +1,94 @@
+#################### IMPORTS ####################
+# ALL
+import os
+
+# AS
+import pandas as pd
+
+#################### FUNCTIONS ####################
+
+# Columns of the scan manifest
+manifest_columns = ['path', 'directory', 'name', 'extension', 'size', 'mtime_ns']
+
+# This function will return the extension of a file, keeping '.nii.gz' together
+def get_manifest_extension(file_name):
+    if file_name.endswith('.nii.gz'):
+        return '.nii.gz'
+    return os.path.splitext(file_name)[1]
+
+# This function will walk the tree once with os.scandir and record every file
+def build_scan_manifest(root_folder):
+    """
+    Walks `root_folder` once and records every file in it.
+
+    Like os.walk, symlinked directories are not followed.
+
+    :param root_folder: The root directory to walk.
+    :return: A DataFrame with the path, directory, name, extension, size and mtime_ns of each file.
+    """
+    rows = []
+    pending_dirs = [root_folder]
+
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        try:
+            with os.scandir(current_dir) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending_dirs.append(entry.path)
+                        elif entry.is_file():
+                            # DirEntry caches the stat on most platforms, so no extra syscall per file
+                            stat = entry.stat()
+                            rows.append((entry.path, current_dir, entry.name, get_manifest_extension(entry.name), stat.st_size, stat.st_mtime_ns))
+                    except OSError as e:
+                        print(f"Unable to read {entry.path}: {e}")
+        except OSError as e:
+            print(f"Unable to read directory {current_dir}: {e}")
+
+    manifest = pd.DataFrame(rows, columns=manifest_columns)
+    return manifest.sort_values('path', ignore_index=True)
+
+# This function will save the manifest as a csv file
+def save_scan_manifest(manifest, manifest_path):
+    os.makedirs(os.path.dirname(os.path.abspath(manifest_path)), exist_ok=True)
+    tmp_path = manifest_path + '.tmp'
+    manifest.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, manifest_path)
+
+# This function will read a saved manifest
+def read_scan_manifest(manifest_path):
+    manifest = pd.read_csv(manifest_path, dtype={'path': str, 'directory': str, 'name': str, 'extension': str}, keep_default_na=False)
+    return manifest[manifest_columns]
+
+# This function will reuse the saved manifest or build (and save) a new one
+def load_or_build_scan_manifest(root_folder, manifest_path=None, refresh=True):
+    """
+    Returns the scan manifest of `root_folder`.
+
+    :param root_folder: The root directory to walk.
+    :param manifest_path: Where the manifest is saved. If None, it is not saved.
+    :param refresh: If False and `manifest_path` exists, it is read instead of walking the tree.
+    :return: The manifest DataFrame.
+    """
+    if manifest_path is not None and not refresh and os.path.exists(manifest_path):
+        print(f"Reusing scan manifest: {manifest_path}")
+        return read_scan_manifest(manifest_path)
+
+    manifest = build_scan_manifest(root_folder)
+    print(f"Scan manifest: {len(manifest)} files under {root_folder}")
+
+    if manifest_path is not None:
+        save_scan_manifest(manifest, manifest_path)
+    return manifest
+
+# This function will return the manifest rows under a folder
+def manifest_files_under(manifest, folder_path):
+    folder_path = os.path.normpath(folder_path)
+    normalised_paths = manifest['path'].map(os.path.normpath)
+    return manifest[normalised_paths.str.startswith(folder_path + os.sep)]
+
+# This function will return the paths of the manifest files with the given name
+def manifest_find_file_paths(manifest, root_folder, filename):
+    matches = manifest[manifest['name'] == filename]
+    return manifest_files_under(matches, root_folder)['path'].tolist()
@@ -0,0 +1,193 @@
+#################### IMPORTS ####################
+# ALL
+import os
+import re
+import glob
+import hashlib
+
+# AS
+import pandas as pd
+
+# FROM FILE
+from DataScript.completion_ledger import *
+from DataScript.slice_shards import *
+from DataScript.slice_store import *
+
+#################### SETTINGS ####################
+
+# Suffix of the outputs of one shard, e.g. nii_ref_df.shard-0-of-4.csv
+shard_name_pattern = re.compile(r'shard-(\d+)-of-(\d+)')
+
+#################### FUNCTIONS ####################
+
+# This function will parse a shard given as 'i/n'
+def parse_shard(text):
+    """
+    Parses '<index>/<count>', e.g. '0/4' is the first of 4 shards. Can be used as an argparse type.
+
+    :return: A tuple (index, count).
+    """
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', text)
+    if not match:
+        raise ValueError(f"'{text}' is not a shard like 0/4")
+    index, count = int(match.group(1)), int(match.group(2))
+    if count < 1 or index >= count:
+        raise ValueError(f"Shard index {index} is not in 0..{count - 1}")
+    return index, count
+
+# This function will return the name of a shard
+def get_shard_name(shard):
+    return f"shard-{shard[0]}-of-{shard[1]}"
+
+# This function will return the path of an output of a shard
+def get_shard_path(path, shard):
+    """
+    Adds the shard name before the extension: nii_ref_df.csv becomes nii_ref_df.shard-0-of-4.csv
+    and a folder gets it as a suffix. The path is unchanged without a shard.
+    """
+    if shard is None:
+        return path
+    trailing_separator = path.endswith(os.sep)
+    root, extension = os.path.splitext(path.rstrip(os.sep))
+    return f"{root}.{get_shard_name(shard)}{extension}" + (os.sep if trailing_separator else '')
+
+# This function will find the outputs of every shard of a path
+def find_shard_paths(path):
+    """
+    :return: The sorted paths written by get_shard_path for any shard of `path`.
+    """
+    root, extension = os.path.splitext(path.rstrip(os.sep))
+    candidates = glob.glob(f"{glob.escape(root)}.shard-*-of-*{extension}")
+    return sorted(candidate for candidate in candidates if shard_name_pattern.fullmatch(candidate[len(root) + 1:len(candidate) - len(extension)]))
+
+# This function will give every OASISID a shard
+def get_oasisid_shard(oasisid, shard_count):
+    """
+    A stable hash of the OASISID (not Python's hash, which changes between runs), so every
+    machine puts a subject, and all its sessions and modalities, in the same shard.
+    """
+    return int(hashlib.md5(oasisid.encode('utf-8')).hexdigest()[:16], 16) % shard_count
+
+# This function will keep the manifest rows of a shard
+def filter_manifest_to_shard(manifest, shard):
+    """
+    Keeps the files of the subjects of the shard. Files without an OASISID (the clinical csv
+    files, ...) are kept in every shard.
+
+    :param manifest: A scan manifest (see scan_manifest.py).
+    :param shard: A tuple (index, count), or None for the whole manifest.
+    """
+    if shard is None:
+        return manifest
+    index, count = shard
+
+    # OASIS 2 raw files (mpr-1.nifti.img) only have their subject in the folder names
+    oasisids = [get_oasisid_from_filename(name) or get_oasisid_from_filename(path) for name, path in zip(manifest['name'], manifest['path'])]
+    shard_oasisids = {oasisid: get_oasisid_shard(oasisid, count) for oasisid in set(oasisids) if oasisid is not None}
+    keep = [oasisid is None or shard_oasisids[oasisid] == index for oasisid in oasisids]
+
+    shard_manifest = manifest[keep].reset_index(drop=True)
+    num_subjects = sum(1 for subject_shard in shard_oasisids.values() if subject_shard == index)
+    print(f"Shard {index}/{count}: {num_subjects} of {len(shard_oasisids)} subjects, {len(shard_manifest)} files")
+    return shard_manifest
+
+# This function will combine the reference dataframes of the shards
+def merge_ref_df_shards(ref_df_path):
+    """
+    Concatenates <name>.shard-*-of-*.csv into ref_df_path.
+
+    :return: The merged dataframe, or None if there are no shards.
+    """
+    shard_paths = find_shard_paths(ref_df_path)
+    if not shard_paths:
+        return None
+    ref_df = pd.concat([pd.read_csv(shard_path) for shard_path in shard_paths], ignore_index=True).drop_duplicates(ignore_index=True)
+
+    tmp_path = ref_df_path + '.tmp'
+    ref_df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, ref_df_path)
+    print(f"Merged {len(shard_paths)} reference dataframes into {ref_df_path}: {len(ref_df)} rows")
+    return ref_df
+
+# This function will combine the completion ledgers of the shards
+def merge_ledger_shards(ledger_path):
+    shard_paths = find_shard_paths(ledger_path)
+    if not shard_paths:
+        return 0
+    with CompletionLedger(ledger_path) as ledger:
+        for shard_path in shard_paths:
+            ledger.merge_from(shard_path)
+        print(f"Merged {len(shard_paths)} completion ledgers into {ledger_path}: {len(ledger.done)} scans done")
+    return len(shard_paths)
+
+# This function will combine the .npy shard indexes of the shards
+def merge_slice_shard_indexes(shard_directory):
+    """
+    Writes an index in shard_directory listing the slices of every <shard_directory>.shard-*-of-* folder.
+    The .npy files stay where they are; the index refers to them by their relative path.
+
+    The rows already in the index (e.g. shards written in shard_directory by an unsharded run) are
+    kept, except the rows of the shards listed again, which are replaced, so merging twice does
+    not list a shard twice.
+    """
+    shard_directories = [path for path in find_shard_paths(shard_directory) if os.path.isdir(path)]
+    if not shard_directories:
+        return 0
+
+    indexes = []
+    for directory in shard_directories:
+        index = read_slice_shard_index(directory)
+        relative_directory = os.path.relpath(directory, shard_directory)
+        index['shard'] = [os.path.join(relative_directory, shard) for shard in index['shard']]
+        indexes.append(index)
+    shard_index = pd.concat(indexes, ignore_index=True)
+
+    existing_index = read_slice_shard_index(shard_directory)
+    existing_index = existing_index[~existing_index['shard'].isin(set(shard_index['shard']))]
+    merged_index = pd.concat([existing_index, shard_index], ignore_index=True)
+
+    os.makedirs(shard_directory, exist_ok=True)
+    index_path = os.path.join(shard_directory, slice_shard_index_name)
+    tmp_path = index_path + '.tmp'
+    merged_index.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, index_path)
+    print(f"Merged {len(shard_directories)} shard indexes into {index_path}: {len(shard_index)} slices from the shards, {len(existing_index)} kept from the index")
+    return len(shard_directories)
+
+# This function will copy the scans of the slice stores of the shards into one store
+def merge_slice_store_shards(store_path):
+    shard_paths = find_shard_paths(store_path)
+    if not shard_paths:
+        return 0
+    check_h5py()
+
+    num_scans = 0
+    with h5py.File(store_path, 'a') as store:
+        for shard_path in shard_paths:
+            with h5py.File(shard_path, 'r') as shard_store:
+                scan_paths = []
+                shard_store.visititems(lambda name, item: scan_paths.append(name) if isinstance(item, h5py.Group) and 'file_name' in item.attrs else None)
+                for scan_path in scan_paths:
+                    if scan_path in store:
+                        del store[scan_path]
+                    parent_path, _, scan_name = scan_path.rpartition('/')
+                    parent = store.require_group(parent_path) if parent_path else store
+                    shard_store.copy(shard_store[scan_path], parent, name=scan_name)
+                num_scans += len(scan_paths)
+    print(f"Merged {len(shard_paths)} slice stores into {store_path}: {num_scans} scans")
+    return len(shard_paths)
+
+# This function will combine every output written by the shards of a conversion job
+def merge_shard_outputs(output_path):
+    """
+    Merges the outputs of the shards in output_path (the Preprocessed or Processed folder):
+    nii_ref_df.csv, completion_ledger.sqlite, the shards folder and slices.h5. The outputs of
+    the shards are kept, so the merge can be run again after more shards finish.
+
+    :return: The merged reference dataframe, or None if no shard wrote one.
+    """
+    ref_df = merge_ref_df_shards(os.path.join(output_path, 'nii_ref_df.csv'))
+    merge_ledger_shards(os.path.join(output_path, 'completion_ledger.sqlite'))
+    merge_slice_shard_indexes(os.path.join(output_path, 'shards'))
+    merge_slice_store_shards(os.path.join(output_path, 'slices.h5'))
+    return ref_df
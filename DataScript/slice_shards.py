@@ -0,0 +1,212 @@
+#################### IMPORTS ####################
+# ALL
+import os
+import re
+import glob
+
+# AS
+import numpy as np
+import pandas as pd
+
+# FROM
+from PIL import Image
+
+#################### SETTINGS ####################
+
+# Columns of the shard index, one row per slice
+slice_shard_index_columns = ['shard', 'position', 'label', 'oasisid', 'file_name', 'orientation', 'slice_index']
+
+# Name of the shard index saved next to the shards
+slice_shard_index_name = 'slices_index.csv'
+
+#################### FUNCTIONS ####################
+
+# This function will scale a slice to the 0-255 range
+def normalise_slice_to_uint8(slice_img):
+    """
+    Min-max scales a slice to uint8, like imshow does with its default vmin and vmax.
+    A constant slice becomes all zeros and NaNs become 0 before scaling.
+    """
+    slice_img = np.nan_to_num(np.asarray(slice_img, dtype=np.float32))
+    min_value, max_value = float(slice_img.min()), float(slice_img.max())
+    if max_value <= min_value:
+        return np.zeros(slice_img.shape, dtype=np.uint8)
+    return ((slice_img - min_value) * (255.0 / (max_value - min_value))).astype(np.uint8)
+
+# This function will turn a volume slice into a fixed-shape uint8 image
+def slice_to_uint8_image(slice_img, slice_shape=(128, 128)):
+    """
+    Turns a volume slice into a uint8 image of `slice_shape` (rows, columns).
+
+    The slice is shown the way save_slice_as_image shows it (transposed, origin at the bottom).
+    """
+    image = np.flipud(normalise_slice_to_uint8(slice_img).T)
+    if image.shape != tuple(slice_shape):
+        image = np.asarray(Image.fromarray(image).resize((slice_shape[1], slice_shape[0]), Image.BILINEAR))
+    return np.ascontiguousarray(image)
+
+# This function will turn a slab of volume slices into fixed-shape uint8 images in one pass
+def slab_to_uint8_images(slab, slice_shape=(128, 128)):
+    """
+    Same as slice_to_uint8_image for every slice of a slab (slice, x, y): the slab is min-max
+    scaled per slice and oriented with whole-slab array operations, then each slice is resized.
+    Trailing axes of size 1, e.g. of a slab of a (176, 208, 176, 1) OASIS-1 volume, are dropped.
+
+    :return: A uint8 array of shape (slice, rows, columns).
+    """
+    slab = np.nan_to_num(np.asarray(slab, dtype=np.float32))
+    while slab.ndim > 3 and slab.shape[-1] == 1:
+        slab = slab[..., 0]
+    if slab.shape[0] == 0:
+        return np.zeros((0,) + tuple(slice_shape), dtype=np.uint8)
+
+    min_values = slab.min(axis=(1, 2), keepdims=True).astype(np.float64)
+    ranges = slab.max(axis=(1, 2), keepdims=True).astype(np.float64) - min_values
+    # A constant slice becomes all zeros
+    scales = np.divide(255.0, ranges, out=np.zeros_like(ranges), where=ranges > 0).astype(np.float32)
+    images = ((slab - min_values.astype(np.float32)) * scales).astype(np.uint8)
+    images = np.ascontiguousarray(images.transpose(0, 2, 1)[:, ::-1, :])
+    if images.shape[1:] == tuple(slice_shape):
+        return images
+
+    resized = np.empty((len(images),) + tuple(slice_shape), dtype=np.uint8)
+    for position, image in enumerate(images):
+        resized[position] = np.asarray(Image.fromarray(image).resize((slice_shape[1], slice_shape[0]), Image.BILINEAR))
+    return resized
+
+# This function will find the OASISID in a scan file name
+def get_oasisid_from_filename(file_name):
+    """
+    Returns 'OAS1_0001' style ids for OASIS 1 and 2 and 'OAS30001' style ids for OASIS 3 and 4.
+    """
+    match = re.search(r'OAS[12]_\d{4}|OAS\d{5}', file_name)
+    return match.group(0) if match else None
+
+# This function will find the session in a scan file name
+def get_session_from_filename(file_name):
+    """
+    Returns 'MR1' style sessions for OASIS 1 and 2 and 'd0129' style session days for OASIS 3 and 4.
+    """
+    match = re.search(r'_(MR\d+)|ses-(d\d+)', file_name)
+    if not match:
+        return None
+    return match.group(1) or match.group(2)
+
+# This function will read the shard index
+def read_slice_shard_index(shard_directory):
+    index_path = os.path.join(shard_directory, slice_shard_index_name)
+    if not os.path.exists(index_path):
+        return pd.DataFrame(columns=slice_shard_index_columns)
+    return pd.read_csv(index_path, dtype={'shard': str, 'label': str, 'oasisid': str, 'file_name': str, 'orientation': str})
+
+# This class will write slices into large sequential .npy shards
+class SliceShardWriter:
+    """
+    Writes fixed-shape uint8 slices into .npy shards of about `shard_size` slices and keeps a
+    csv index with the label, OASISID, file name, orientation and slice index of every slice.
+
+    Shards end on scan boundaries and are saved with their index rows once they hold at least
+    `shard_size` slices (or on close), so an interrupted run never leaves half a scan in the
+    index. Reopening the directory appends new shards.
+
+    Usage:
+        with SliceShardWriter(preprocessed_data_path + 'shards') as writer:
+            writer.write_scan(file_name, label, slices)
+    """
+
+    def __init__(self, shard_directory, shard_size=4096, slice_shape=(128, 128), prefix='slices'):
+        self.shard_directory = shard_directory
+        self.shard_size = shard_size
+        self.slice_shape = tuple(slice_shape)
+        self.prefix = prefix
+
+        os.makedirs(shard_directory, exist_ok=True)
+        self.index_path = os.path.join(shard_directory, slice_shard_index_name)
+        existing_shards = glob.glob(os.path.join(shard_directory, f"{prefix}-*.npy"))
+        self.shard_number = len(existing_shards)
+        self.written_files = set(read_slice_shard_index(shard_directory)['file_name'])
+
+        self.buffer = []
+        self.buffer_rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # This function will add one slice to the current shard
+    def add_slice(self, slice_img, label, file_name, orientation, slice_index, oasisid=None):
+        """
+        Adds one slice. Slices that are not uint8 images of `slice_shape` are converted with slice_to_uint8_image.
+        """
+        if slice_img.dtype != np.uint8 or slice_img.shape != self.slice_shape:
+            slice_img = slice_to_uint8_image(slice_img, self.slice_shape)
+
+        self.buffer.append(slice_img)
+        self.buffer_rows.append([self.get_shard_name(), len(self.buffer_rows), label, oasisid or get_oasisid_from_filename(file_name), file_name, orientation, slice_index])
+
+    # This function will add every slice of a scan
+    def write_scan(self, file_name, label, slices):
+        """
+        Adds the slices of a scan.
+
+        Parameters:
+        - file_name: Scan file name without the format.
+        - label: Label of the scan.
+        - slices: Dictionary of {slice_index: slice} for each orientation.
+        """
+        oasisid = get_oasisid_from_filename(file_name)
+        for orientation, slice_list in slices.items():
+            for slice_index, slice_img in slice_list.items():
+                self.add_slice(slice_img, label, file_name, orientation, slice_index, oasisid)
+        self.written_files.add(file_name)
+
+        if len(self.buffer_rows) >= self.shard_size:
+            self.flush()
+
+    # This function will return the file name of the current shard
+    def get_shard_name(self):
+        return f"{self.prefix}-{self.shard_number:05d}.npy"
+
+    # This function will save the current shard and its index rows
+    def flush(self):
+        if not self.buffer_rows:
+            return
+
+        shard_path = os.path.join(self.shard_directory, self.get_shard_name())
+        tmp_path = shard_path + '.tmp'
+        with open(tmp_path, 'wb') as shard_file:
+            np.save(shard_file, np.stack(self.buffer))
+        os.replace(tmp_path, shard_path)
+
+        # The index only lists shards that are completely on disk
+        index_rows = pd.DataFrame(self.buffer_rows, columns=slice_shard_index_columns)
+        index_rows.to_csv(self.index_path, mode='a', header=not os.path.exists(self.index_path), index=False)
+
+        self.shard_number += 1
+        self.buffer = []
+        self.buffer_rows = []
+
+    # This function will save the last (partly filled) shard
+    def close(self):
+        self.flush()
+
+# This function will stream the shards one after the other
+def iter_slice_shards(shard_directory, columns=None):
+    """
+    Yields the shards in order, each as (slices, index_rows).
+
+    The shards are memory-mapped, so reading them is sequential and only touches the pages used.
+
+    :param shard_directory: Folder holding the shards and their index.
+    :param columns: Index columns to return (all by default).
+    :return: Generator of (uint8 array of shape (n, rows, columns), DataFrame of the n index rows).
+    """
+    index = read_slice_shard_index(shard_directory)
+    if columns is not None:
+        index = index[['shard', 'position'] + [column for column in columns if column not in ['shard', 'position']]]
+
+    for shard_name, index_rows in index.groupby('shard', sort=True):
+        slices = np.load(os.path.join(shard_directory, shard_name), mmap_mode='r')
+        yield slices, index_rows.sort_values('position').reset_index(drop=True)
@@ -0,0 +1,281 @@
+#################### IMPORTS ####################
+# ALL
+import os
+import re
+
+# AS
+import numpy as np
+
+# FROM FILE
+from DataScript.slice_shards import *
+
+# OPTIONAL
+try:
+    import h5py  # Chunked, compressed slice store
+except ImportError:
+    h5py = None
+
+#################### FUNCTIONS ####################
+
+# This function will stop with a clear message when h5py is missing
+def check_h5py():
+    if h5py is None:
+        raise ImportError("The slice store needs h5py: pip install h5py")
+
+# This class will write the slices of each scan into an HDF5 file grouped by modality, OASISID and session
+class SliceStoreWriter:
+    """
+    Writes slices into an HDF5 store laid out as
+
+        /<modality>/<OASISID>/<session>/<file name>/<orientation>   uint8 (n, rows, columns[, 3])
+
+    Every dataset is chunked one slice per chunk and compressed, so a single slice is read
+    without inflating its neighbours. The scan group holds the label, file name, OASISID and
+    session as attributes and each orientation dataset holds its slice indices.
+
+    The store has one writer: pool workers read the volumes and the main process writes.
+
+    Usage:
+        with SliceStoreWriter(preprocessed_data_path + 'slices.h5', 'MRI') as writer:
+            writer.write_scan(file_name, label, slices)
+    """
+
+    def __init__(self, store_path, modality, compression='gzip', compression_opts=4):
+        check_h5py()
+        os.makedirs(os.path.dirname(os.path.abspath(store_path)), exist_ok=True)
+        self.store_path = store_path
+        self.modality = modality
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.store = h5py.File(store_path, 'a')
+        self.written_files = set(get_store_file_names(self.store, modality))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # This function will add the slices of a scan
+    def write_scan(self, file_name, label, slices, attributes=None):
+        """
+        Adds the slices of a scan. A scan that is already in the store is replaced.
+
+        Parameters:
+        - file_name: Scan file name without the format.
+        - label: Label of the scan (None if not known).
+        - slices: Dictionary of {slice_index: slice} for each orientation. The slices are saved as they are,
+          so convert them first (e.g. with slice_to_uint8_image).
+        - attributes: Extra attributes of the scan group.
+        """
+        oasisid = get_oasisid_from_filename(file_name) or 'unknown'
+        session = get_session_from_filename(file_name) or 'unknown'
+        scan_path = f'{self.modality}/{oasisid}/{session}/{file_name}'
+
+        if scan_path in self.store:
+            del self.store[scan_path]
+        scan_group = self.store.create_group(scan_path)
+        for orientation, slice_list in slices.items():
+            if not slice_list:
+                continue
+            slice_indices = sorted(slice_list)
+            slab = np.stack([slice_list[slice_index] for slice_index in slice_indices])
+            dataset = scan_group.create_dataset(orientation, data=slab, chunks=(1,) + slab.shape[1:], compression=self.compression, compression_opts=self.compression_opts, shuffle=True)
+            dataset.attrs['slice_indices'] = np.asarray(slice_indices, dtype=np.int32)
+
+        # The file name is written last: a scan group without it was not finished and is written again
+        scan_group.attrs['oasisid'] = oasisid
+        scan_group.attrs['session'] = session
+        if label is not None:
+            scan_group.attrs['label'] = label
+        for key, value in (attributes or {}).items():
+            scan_group.attrs[key] = value
+        scan_group.attrs['file_name'] = file_name
+
+        self.written_files.add(file_name)
+
+    # This function will close the store
+    def close(self):
+        self.store.close()
+
+# This function will list the scans of a modality in an open store
+def get_store_file_names(store, modality):
+    if modality not in store:
+        return []
+    file_names = []
+    store[modality].visititems(lambda name, item: file_names.append(item.attrs['file_name']) if 'file_name' in item.attrs else None)
+    return file_names
+
+# This class will read the slice store, one file handle per process
+class SliceStoreReader:
+    """
+    Random access to a store written by SliceStoreWriter.
+
+    The HDF5 file is opened on first use in each process, so the reader can be handed to
+    DataLoader workers (h5py handles must not be shared across a fork).
+
+    Usage:
+        reader = SliceStoreReader(preprocessed_data_path + 'slices.h5')
+        for session in reader.get_sessions('MRI', 'OAS30001'):
+            scans = reader.get_session_scans('MRI', 'OAS30001', session)
+    """
+
+    def __init__(self, store_path):
+        check_h5py()
+        self.store_path = store_path
+        self.store = None
+        self.store_pid = None
+
+    # This function will return the store opened by this process
+    def get_store(self):
+        if self.store is None or self.store_pid != os.getpid():
+            self.store = h5py.File(self.store_path, 'r')
+            self.store_pid = os.getpid()
+        return self.store
+
+    def __getstate__(self):
+        # Workers reopen the file themselves
+        return {'store_path': self.store_path, 'store': None, 'store_pid': None}
+
+    # This function will list the modalities
+    def get_modalities(self):
+        return sorted(self.get_store().keys())
+
+    # This function will list the patients of a modality
+    def get_patients(self, modality):
+        store = self.get_store()
+        return sorted(store[modality].keys()) if modality in store else []
+
+    # This function will list the sessions of a patient
+    def get_sessions(self, modality, oasisid):
+        store = self.get_store()
+        path = f'{modality}/{oasisid}'
+        return sorted(store[path].keys()) if path in store else []
+
+    # This function will return the scans of a session with their attributes
+    def get_session_scans(self, modality, oasisid, session):
+        """
+        :return: A dictionary of {file name: scan attributes}.
+        """
+        store = self.get_store()
+        path = f'{modality}/{oasisid}/{session}'
+        if path not in store:
+            return {}
+        return {file_name: dict(scan_group.attrs) for file_name, scan_group in store[path].items()}
+
+    # This function will read the slices of a scan
+    def get_slices(self, modality, oasisid, session, file_name, orientation, positions=None):
+        """
+        Reads the slices of one orientation of a scan.
+
+        :param positions: Positions (not slice indices) to read, in any order and possibly repeated.
+                          All slices are read if None.
+        :return: A tuple (slices, slice_indices), in the order of `positions`.
+        """
+        dataset = self.get_store()[f'{modality}/{oasisid}/{session}/{file_name}/{orientation}']
+        slice_indices = dataset.attrs['slice_indices']
+        if positions is None:
+            return dataset[()], slice_indices
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1)
+        if len(positions) == 0:
+            return dataset[0:0], slice_indices[positions]
+        # h5py only reads increasing positions, so each slice is read once and put back in the caller's order
+        unique_positions, inverse = np.unique(positions, return_inverse=True)
+        return dataset[unique_positions][inverse], slice_indices[positions]
+
+    # This function will find the dataset of an orientation in a scan group
+    @staticmethod
+    def find_orientation_key(scan_group, orientation):
+        """
+        Returns `orientation` if the scan has it, else the first key starting with it, e.g.
+        'Axial_time_point3' for the dynamic PET scans, or None.
+        """
+        if orientation in scan_group:
+            return orientation
+        return next((key for key in sorted(scan_group.keys()) if key.startswith(orientation)), None)
+
+    # This function will return the patients that have every given modality
+    def get_multimodal_patients(self, modalities=('MRI', 'CT', 'PET')):
+        patients = None
+        for modality in modalities:
+            modality_patients = set(self.get_patients(modality))
+            patients = modality_patients if patients is None else patients & modality_patients
+        return sorted(patients or [])
+
+    # This function will return the number of days between two sessions, None if they can't be matched
+    @staticmethod
+    def get_session_distance(session, other_session):
+        """
+        Sessions with the same name are 0 days apart. 'd0129' style sessions (OASIS 3 and 4) are
+        compared on their day; other sessions (e.g. 'MR1') only match by name.
+        """
+        if session == other_session:
+            return 0
+        if re.fullmatch(r'd\d+', session) and re.fullmatch(r'd\d+', other_session):
+            return abs(int(session[1:]) - int(other_session[1:]))
+        return None
+
+    # This function will list the first scan of each session of a patient that has an orientation
+    def get_orientation_scans(self, modality, oasisid, orientation):
+        """
+        :return: A list of (session, file name, scan attributes, orientation key) in session order.
+        """
+        orientation_scans = []
+        for session in self.get_sessions(modality, oasisid):
+            scans = self.get_session_scans(modality, oasisid, session)
+            for file_name, attrs in sorted(scans.items()):
+                orientation_key = self.find_orientation_key(self.get_store()[f'{modality}/{oasisid}/{session}/{file_name}'], orientation)
+                if orientation_key is not None:
+                    orientation_scans.append((session, file_name, attrs, orientation_key))
+                    break
+        return orientation_scans
+
+    # This function will return one scan of each modality of a patient, all from the same visit
+    def get_patient_triplet(self, oasisid, orientation='Axial', modalities=('MRI', 'CT', 'PET'), max_day_difference=None):
+        """
+        Reads the slices of one scan of each modality of a patient, with the sessions matched to
+        each other: by name, or for 'd0129' style sessions by the closest day (see
+        get_session_distance). Each session of the first modality is tried with the closest
+        session of the others, and the visit matching the most modalities with the fewest days
+        between them is used. The first scan of a session is read, and a PET scan stored per
+        time point (Axial_time_point3, ...) uses its first time point.
+
+        :param max_day_difference: Most days between the session of the first modality and the others (None for no limit).
+        :return: A dictionary of {modality: (slices, scan attributes)}, without the modalities that have no
+                 scan in the matched visit. The attributes hold the dataset read under 'orientation'.
+        """
+        candidates = {modality: self.get_orientation_scans(modality, oasisid, orientation) for modality in modalities}
+        candidates = {modality: scans for modality, scans in candidates.items() if scans}
+        if not candidates:
+            return {}
+
+        first_modality = next(iter(candidates))
+        best_cost, best_scans = None, None
+        for first_scan in candidates[first_modality]:
+            chosen, distances = {first_modality: first_scan}, [0]
+            for modality, scans in candidates.items():
+                if modality == first_modality:
+                    continue
+                matches = [(self.get_session_distance(first_scan[0], scan[0]), position) for position, scan in enumerate(scans)]
+                matches = [(distance, position) for distance, position in matches if distance is not None and (max_day_difference is None or distance <= max_day_difference)]
+                if matches:
+                    distance, position = min(matches)
+                    chosen[modality] = scans[position]
+                    distances.append(distance)
+            cost = (-len(chosen), max(distances))
+            if best_cost is None or cost < best_cost:
+                best_cost, best_scans = cost, chosen
+
+        triplet = {}
+        for modality in modalities:
+            if modality in best_scans:
+                session, file_name, attrs, orientation_key = best_scans[modality]
+                slices, _ = self.get_slices(modality, oasisid, session, file_name, orientation_key)
+                triplet[modality] = (slices, dict(attrs, orientation=orientation_key))
+        return triplet
+
+    # This function will close the store
+    def close(self):
+        if self.store is not None and self.store_pid == os.getpid():
+            self.store.close()
+        self.store = None
@@ -0,0 +1,185 @@
+#################### IMPORTS ####################
+# ALL
+import math
+import random
+
+# FROM FILE
+from DataScript.preload_arrays import *
+
+# OPTIONAL
+try:
+    import torch
+    import torch.distributed as dist
+    from torch.utils.data import IterableDataset, get_worker_info
+except ImportError:
+    torch = None
+    IterableDataset = object
+
+#################### FUNCTIONS ####################
+
+# This class will stream (MRI, CT, PET) batches from preload shards
+class MultimodalStreamingDataset(IterableDataset):
+    """
+    Streams batches of aligned (MRI, CT, PET) samples from preloads (see preload_arrays.py)
+    without loading them in memory.
+
+    The preloads are cut into shards of `shard_size` consecutive samples. Each epoch the shards
+    are shuffled and dealt out to the ranks and then to the DataLoader workers, samples are
+    shuffled within a buffer of `shuffle_buffer` samples, and every batch is decoded into one
+    contiguous float32 tensor (pinned if asked).
+
+    It yields whole batches, so use it with batch_size=None. The batches are the same as the
+    notebooks' TensorDataset batches, so train_model and validate_model take it as it is:
+
+        dataset = MultimodalStreamingDataset([preload_folder + '/train_5000'], batch_size=batch_size, num_workers=4)
+        dataloader = DataLoader(dataset, batch_size=None, num_workers=4)
+        train_model(model, dataloader, num_epochs=num_epochs, lr=learning_rate, device=device)
+
+    The epoch is counted by the dataset: every iterator (one per DataLoader worker, or one in the
+    main process with num_workers=0) takes the next epoch from a per-worker counter held in shared
+    memory, so each epoch is shuffled differently without calling anything between epochs. The
+    counter lives in shared memory because DataLoader starts new workers with a copy of the
+    dataset every epoch (unless persistent_workers=True). set_epoch fixes the epoch instead.
+
+    The `num_workers` given here must be the DataLoader's: each worker makes its own last
+    incomplete batch, so __len__ depends on it. Iterating with a different number of workers
+    raises a ValueError.
+    """
+
+    def __init__(self, path_prefixes, batch_size=32, shard_size=1024, shuffle=True, shuffle_buffer=4096, seed=42, num_workers=0, rank=None, world_size=None, pin_memory=False, drop_last=False):
+        """
+        Parameters:
+        - path_prefixes: Preload path prefixes (a single prefix is accepted too).
+        - batch_size: Samples per batch.
+        - shard_size: Consecutive samples per shard, the unit dealt out to ranks and workers.
+        - shuffle: Shuffle the shards and the samples every epoch.
+        - shuffle_buffer: Samples held for shuffling. Larger is more random and uses more memory.
+        - seed: Base random seed; the epoch is added to it.
+        - num_workers: DataLoader workers (0 for the main process). Must match the DataLoader's.
+        - rank, world_size: Distributed rank and size. Read from torch.distributed if it is initialised.
+        - pin_memory: Pin the batch tensors for faster copies to the GPU.
+        - drop_last: Drop each worker's last incomplete batch.
+        """
+        if torch is None:
+            raise ImportError("MultimodalStreamingDataset needs PyTorch: pip install torch")
+
+        self.path_prefixes = [path_prefixes] if isinstance(path_prefixes, str) else list(path_prefixes)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_buffer = max(shuffle_buffer, 1)
+        self.seed = seed
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.drop_last = drop_last
+        self.epoch = None
+
+        # Iterators started by each worker so far, shared with the worker processes
+        self.worker_iterations = torch.zeros(max(num_workers, 1), dtype=torch.int64).share_memory_()
+
+        if rank is None or world_size is None:
+            distributed = dist.is_available() and dist.is_initialized()
+            rank = dist.get_rank() if distributed else 0
+            world_size = dist.get_world_size() if distributed else 1
+        self.rank = rank
+        self.world_size = world_size
+
+        # Only the headers are read here; the arrays are opened again in each worker
+        self.shards = []
+        self.sample_shape = None
+        for path_prefix in self.path_prefixes:
+            data, _, header = load_preload_arrays(path_prefix)
+            self.sample_shape = self.sample_shape or tuple(header['shape'][1:])
+            for start in range(0, len(data), shard_size):
+                self.shards.append((path_prefix, start, min(start + shard_size, len(data))))
+
+    # This function will fix the epoch used for shuffling (None goes back to counting the epochs)
+    def set_epoch(self, epoch):
+        """
+        With persistent_workers=True, call it before the workers are started: they keep their copy.
+        """
+        self.epoch = epoch
+
+    # This function will return the epoch of the next iterator of a worker
+    def get_epoch(self, worker_id=0):
+        return self.epoch if self.epoch is not None else int(self.worker_iterations[worker_id])
+
+    # This function will return the shards of a rank (all workers) in an epoch
+    def get_rank_shards(self, epoch):
+        shards = list(self.shards)
+        if self.shuffle:
+            random.Random(self.seed + epoch).shuffle(shards)
+        return shards[self.rank::self.world_size]
+
+    # This function will return the number of batches of a list of shards
+    def count_batches(self, shards):
+        num_samples = sum(stop - start for _, start, stop in shards)
+        return num_samples // self.batch_size if self.drop_last else math.ceil(num_samples / self.batch_size)
+
+    def __len__(self):
+        # Each worker makes its own last batch, so the count is per worker
+        rank_shards = self.get_rank_shards(self.get_epoch())
+        num_workers = len(self.worker_iterations)
+        return sum(self.count_batches(rank_shards[worker_id::num_workers]) for worker_id in range(num_workers))
+
+    # This function will yield the (sample, label) pairs of the shards, shuffled within the buffer
+    def iter_samples(self, shards, rng):
+        opened = {}
+        buffer = []
+        for path_prefix, start, stop in shards:
+            if path_prefix not in opened:
+                data, labels, _ = load_preload_arrays(path_prefix)
+                opened[path_prefix] = (data, labels)
+            data, labels = opened[path_prefix]
+
+            positions = list(range(start, stop))
+            if self.shuffle:
+                rng.shuffle(positions)
+            for position in positions:
+                if not self.shuffle:
+                    yield data[position], labels[position]
+                    continue
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append((data, labels, position))
+                    continue
+                # Swap a random buffered sample out for the new one
+                index = rng.randrange(len(buffer))
+                buffered_data, buffered_labels, buffered_position = buffer[index]
+                buffer[index] = (data, labels, position)
+                yield buffered_data[buffered_position], buffered_labels[buffered_position]
+
+        rng.shuffle(buffer)
+        for buffered_data, buffered_labels, buffered_position in buffer:
+            yield buffered_data[buffered_position], buffered_labels[buffered_position]
+
+    # This function will turn a list of samples into one contiguous batch
+    def make_batch(self, samples):
+        inputs = torch.empty((len(samples),) + self.sample_shape, dtype=torch.float32, pin_memory=self.pin_memory)
+        labels = torch.empty((len(samples),), dtype=torch.float32, pin_memory=self.pin_memory)
+        inputs_array = inputs.numpy()
+        for i, (sample, label) in enumerate(samples):
+            inputs_array[i] = sample
+            labels[i] = float(label)
+        return inputs, labels
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        if num_workers != len(self.worker_iterations):
+            raise ValueError(f"MultimodalStreamingDataset was made for num_workers={self.num_workers} but is read by {num_workers if worker_info is not None else 0} DataLoader workers")
+
+        # Each worker only counts its own iterators, so the workers don't race on the counter
+        epoch = self.get_epoch(worker_id)
+        self.worker_iterations[worker_id] += 1
+
+        shards = self.get_rank_shards(epoch)[worker_id::num_workers]
+        rng = random.Random((self.seed + epoch) * 1000003 + self.rank * 1009 + worker_id)
+
+        samples = []
+        for sample, label in self.iter_samples(shards, rng):
+            samples.append((sample, label))
+            if len(samples) == self.batch_size:
+                yield self.make_batch(samples)
+                samples = []
+        if samples and not self.drop_last:
+            yield self.make_batch(samples)
@@ -0,0 +1,217 @@
+#################### IMPORTS ####################
+# ALL
+import os
+import random
+import hashlib
+
+# AS
+import numpy as np
+
+# FROM
+from sklearn.model_selection import train_test_split
+
+# FROM FILE
+from DataScript.scan_manifest import *
+from DataScript.slice_shards import *
+
+# OPTIONAL
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+#################### SETTINGS ####################
+
+# Category folders and labels of the baseline notebook
+tf_category_labels = {
+    'non-demented': 0,
+    'very-mild-dementia': 1,
+    'mild-dementia': 2,
+    'moderate-dementia': 3,
+}
+
+# Order the notebook samples the train splits in (random_choices_sample calls of its "target_samples = 10000" cell)
+tf_train_sample_order = ['moderate-dementia', 'mild-dementia', 'very-mild-dementia', 'non-demented']
+
+# Order the notebook samples the test splits in; its moderate-dementia test split is kept as it is
+tf_test_sample_order = ['mild-dementia', 'very-mild-dementia', 'non-demented']
+
+#################### FUNCTIONS ####################
+
+# This function will stop with a clear message when TensorFlow is missing
+def check_tensorflow():
+    if tf is None:
+        raise ImportError("The tf.data input pipeline needs TensorFlow: pip install tensorflow")
+
+# This function will list the images of each category folder
+def collect_category_files(main_root_directory, manifest=None):
+    """
+    Lists the files in the category folders under main_root_directory (like the notebook's
+    collect_files_from_directories) with one scan of the tree.
+
+    :return: A dictionary of {category: sorted list of file paths}.
+    """
+    if manifest is None:
+        manifest = build_scan_manifest(main_root_directory)
+    categories = manifest['directory'].map(os.path.basename)
+
+    files_by_category = {}
+    for category in tf_category_labels:
+        files_by_category[category] = sorted(manifest[categories == category]['path'])
+    return files_by_category
+
+# This function will list the slices of each category in a shard index
+def collect_category_shard_slices(shard_directory):
+    """
+    :return: A dictionary of {category: list of (shard path, position)} from the index of slice_shards.py.
+    """
+    index = read_slice_shard_index(shard_directory)
+    files_by_category = {}
+    for category in tf_category_labels:
+        rows = index[index['label'] == category]
+        files_by_category[category] = [(os.path.join(shard_directory, shard), int(position)) for shard, position in zip(rows['shard'], rows['position'])]
+    return files_by_category
+
+# This function will sample a category like the notebook's random_choices_sample
+def random_choices_sample(dataset, target_samples, rng=random):
+    if len(dataset) == 0:
+        return []
+    if len(dataset) < target_samples:
+        # Oversample small classes
+        return rng.choices(list(dataset), k=target_samples)
+    # Undersample large classes
+    return rng.sample(list(dataset), k=target_samples)
+
+# This function will split, sample and label the files of each category the way the baseline notebook does
+def get_sampled_splits(files_by_category, target_samples=10000, test_target_samples=5000, val_size=0.2, seed=42):
+    """
+    Splits 20% of each category off for testing, samples the train split of every category to
+    `target_samples` and the test splits in tf_test_sample_order to `test_target_samples` (the
+    moderate-dementia test split is kept as it is), and splits `val_size` of the train samples
+    off for validation.
+
+    The train and test splits are sampled with their own generators. The test generator starts
+    where the train draws stop, so with the same seed the samples are the ones the notebook
+    draws after its random.seed(42).
+
+    :return: A dictionary of {'train', 'val', 'test': list of (item, label)}.
+    """
+    train_splits, test_splits = {}, {}
+    for category in tf_category_labels:
+        items = files_by_category.get(category, [])
+        if len(items) < 2:
+            train_splits[category], test_splits[category] = [], []
+            continue
+        train_splits[category], test_splits[category] = train_test_split(items, test_size=0.2, random_state=seed)
+
+    train_rng = random.Random(seed)
+    for category in tf_train_sample_order:
+        train_splits[category] = random_choices_sample(train_splits[category], target_samples, train_rng)
+
+    test_rng = random.Random()
+    test_rng.setstate(train_rng.getstate())
+    for category in tf_test_sample_order:
+        test_splits[category] = random_choices_sample(test_splits[category], test_target_samples, test_rng)
+
+    # The items are listed by label, like the notebook's data and data_test arrays
+    train_items = [(item, label) for category, label in tf_category_labels.items() for item in train_splits[category]]
+    test_items = [(item, label) for category, label in tf_category_labels.items() for item in test_splits[category]]
+
+    train_items, val_items = train_test_split(train_items, test_size=val_size, shuffle=True, random_state=seed)
+    return {'train': train_items, 'val': val_items, 'test': test_items}
+
+# This function will decode an image file like the notebook (RGB, resized)
+def decode_image_file(path, image_size=(128, 128)):
+    image = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+    image = tf.image.resize(image, image_size, method='bicubic', antialias=True)
+    return tf.clip_by_value(image, 0.0, 255.0)
+
+# Shards opened by read_shard_slice, kept open for the next slices
+opened_shards = {}
+
+# This function will read a slice from a shard as an RGB image
+def read_shard_slice(shard_path, position, image_size=(128, 128)):
+    shard_path = shard_path.decode('utf-8') if isinstance(shard_path, bytes) else shard_path
+    if shard_path not in opened_shards:
+        opened_shards[shard_path] = np.load(shard_path, mmap_mode='r')
+    slices = opened_shards[shard_path]
+    image = np.repeat(np.asarray(slices[int(position)], dtype=np.float32)[:, :, None], 3, axis=2)
+    if image.shape[:2] != tuple(image_size):
+        image = tf.image.resize(image, image_size, method='bicubic', antialias=True).numpy()
+    return image
+
+# This function will build a batched, cached and prefetched tf.data dataset
+def build_tf_dataset(items, batch_size=32, image_size=(128, 128), cache_path=None, shuffle=True, seed=42, one_hot=False, num_classes=4):
+    """
+    Builds a tf.data dataset of (image, label) batches.
+
+    The files are decoded and resized by parallel map calls. With `cache_path` the decoded
+    dataset is saved to a local cache file during the first epoch and read from it afterwards.
+    The cache file name includes a hash of the items, so a different sample never reuses it.
+    Unreadable images are skipped, like the notebook does.
+
+    :param items: List of (image path, label) or ((shard path, position), label).
+    :param batch_size: Images per batch.
+    :param image_size: (height, width) of the images.
+    :param cache_path: Path prefix of the cache file. None keeps no cache.
+    :param shuffle: Shuffle the items every epoch.
+    :param one_hot: One-hot labels instead of the integer labels used with sparse categorical loss.
+    :return: A tf.data.Dataset of (float32 images of shape (batch, height, width, 3), labels).
+    """
+    check_tensorflow()
+    autotune = tf.data.AUTOTUNE
+    labels = [label for _, label in items]
+    from_shards = len(items) > 0 and isinstance(items[0][0], tuple)
+
+    if from_shards:
+        shard_paths = [item[0] for item, _ in items]
+        positions = [item[1] for item, _ in items]
+        dataset = tf.data.Dataset.from_tensor_slices((shard_paths, positions, labels))
+        def decode(shard_path, position, label):
+            image = tf.numpy_function(lambda path, index: read_shard_slice(path, index, image_size), [shard_path, position], tf.float32)
+            image.set_shape(tuple(image_size) + (3,))
+            return image, label
+        dataset = dataset.map(decode, num_parallel_calls=autotune)
+    else:
+        paths = [path for path, _ in items]
+        dataset = tf.data.Dataset.from_tensor_slices((paths, labels))
+        dataset = dataset.map(lambda path, label: (decode_image_file(path, image_size), label), num_parallel_calls=autotune)
+    dataset = dataset.ignore_errors()
+
+    if cache_path is not None:
+        digest = hashlib.sha1(repr((items, tuple(image_size))).encode('utf-8')).hexdigest()[:16]
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        dataset = dataset.cache(f"{cache_path}_{digest}")
+
+    if shuffle:
+        dataset = dataset.shuffle(min(len(items), 10000) or 1, seed=seed, reshuffle_each_iteration=True)
+    if one_hot:
+        dataset = dataset.map(lambda image, label: (image, tf.one_hot(label, num_classes)), num_parallel_calls=autotune)
+
+    return dataset.batch(batch_size).prefetch(autotune)
+
+# This function will build the train, validation and test datasets of the baseline notebook
+def build_baseline_datasets(main_root_directory=None, shard_directory=None, target_samples=10000, test_target_samples=5000, batch_size=32, image_size=(128, 128), cache_directory=None, seed=42):
+    """
+    Builds the baseline notebook's datasets from the category folders or from a shard index,
+    keeping its test split, class sampling (oversampling small classes) and validation split.
+
+    Usage:
+        datasets = build_baseline_datasets(main_root_directory, cache_directory='/kaggle/working/tf_cache')
+        model_pretrained.fit(datasets['train'], epochs=10, validation_data=datasets['val'])
+
+    :return: A dictionary of {'train', 'val', 'test': tf.data.Dataset}. Only train is shuffled.
+    """
+    check_tensorflow()
+    if shard_directory is not None:
+        files_by_category = collect_category_shard_slices(shard_directory)
+    else:
+        files_by_category = collect_category_files(main_root_directory)
+
+    splits = get_sampled_splits(files_by_category, target_samples, test_target_samples, seed=seed)
+    datasets = {}
+    for split, items in splits.items():
+        cache_path = os.path.join(cache_directory, split) if cache_directory is not None else None
+        datasets[split] = build_tf_dataset(items, batch_size, image_size, cache_path, shuffle=(split == 'train'), seed=seed)
+        print(f"{split}: {len(items)} samples")
+    return datasets
@@ -0,0 +1,168 @@
+#################### IMPORTS ####################
+# ALL
+import os
+import hashlib
+
+# AS
+import nibabel as nib
+
+# FROM
+from contextlib import contextmanager
+
+# OPTIONAL
+try:
+    import fcntl  # File locking between pool workers (POSIX only)
+except ImportError:
+    fcntl = None
+
+#################### SETTINGS ####################
+
+# Budget of the cache once it is turned on with a directory but no byte budget
+volume_cache_default_bytes = 50 * 1024 ** 3
+
+# Where the decoded volumes are kept and how many bytes they may use in total.
+# Both can be set from the environment so that pool workers pick them up too.
+# The cache is off (a budget of 0 bytes) unless OASIS_VOLUME_CACHE_BYTES or OASIS_VOLUME_CACHE_DIR is set.
+volume_cache_settings = {
+    'cache_dir': os.environ.get('OASIS_VOLUME_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'oasis_volume_cache')),
+    'max_bytes': int(os.environ.get('OASIS_VOLUME_CACHE_BYTES', volume_cache_default_bytes if 'OASIS_VOLUME_CACHE_DIR' in os.environ else 0)),
+}
+
+#################### FUNCTIONS ####################
+
+# This function will change the cache settings for this process and the workers it starts
+def configure_volume_cache(cache_dir=None, max_bytes=None):
+    """
+    Changes where decoded volumes are cached and the byte budget of the cache.
+
+    :param cache_dir: Directory holding the cached volumes. Setting it turns the cache on with
+                      volume_cache_default_bytes if it is off and no max_bytes is given.
+    :param max_bytes: Byte budget of the cache. 0 turns the cache off.
+    """
+    if cache_dir is not None:
+        volume_cache_settings['cache_dir'] = cache_dir
+        os.environ['OASIS_VOLUME_CACHE_DIR'] = cache_dir
+        if max_bytes is None and not volume_cache_enabled():
+            max_bytes = volume_cache_default_bytes
+    if max_bytes is not None:
+        volume_cache_settings['max_bytes'] = int(max_bytes)
+        os.environ['OASIS_VOLUME_CACHE_BYTES'] = str(int(max_bytes))
+
+# This function will check if the cache is turned on
+def volume_cache_enabled():
+    return volume_cache_settings['max_bytes'] > 0
+
+# This function will create the cache key of a file from its path, size and modification time
+def get_volume_cache_key(file_path):
+    """
+    Returns the cache key of a file. A changed file (new size or mtime) gets a new key.
+    """
+    stat = os.stat(file_path)
+    key = f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+# This function will hold an exclusive lock on the given lock file
+@contextmanager
+def locked_file(lock_path):
+    """
+    Holds an exclusive lock on `lock_path` so that only one pool worker decodes a volume.
+    Without fcntl (Windows) no lock is taken.
+    """
+    with open(lock_path, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+# This function will remove the least recently used volumes until the cache fits its budget
+def evict_volume_cache(cache_dir=None, max_bytes=None, keep=None):
+    """
+    Removes the least recently used cached volumes until the cache fits in `max_bytes`.
+    The empty .lock files are never removed.
+
+    :param cache_dir: Directory holding the cached volumes.
+    :param max_bytes: Byte budget of the cache.
+    :param keep: Path of a cached volume that must not be removed (the one just added).
+    :return: Number of bytes removed.
+    """
+    cache_dir = cache_dir or volume_cache_settings['cache_dir']
+    max_bytes = volume_cache_settings['max_bytes'] if max_bytes is None else max_bytes
+
+    if not os.path.isdir(cache_dir):
+        return 0
+
+    with locked_file(os.path.join(cache_dir, '.evict.lock')):
+        entries = []
+        with os.scandir(cache_dir) as scan:
+            for entry in scan:
+                if entry.is_file() and entry.name.endswith('.nii') and '.tmp' not in entry.name:
+                    stat = entry.stat()
+                    # Hits touch the mtime, so the oldest mtime is the least recently used
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        removed_bytes = 0
+        for _, size, path in sorted(entries):
+            if total_bytes <= max_bytes:
+                break
+            if keep is not None and os.path.abspath(path) == os.path.abspath(keep):
+                continue
+            try:
+                # The lock files are kept: a worker may be waiting on one, and a new file would let a second worker in
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            removed_bytes += size
+
+    return removed_bytes
+
+# This function will load a neuroimaging file through the decoded-volume cache
+def load_cached_nii(file_path):
+    """
+    Loads a neuroimaging file, decoding each .nii.gz file only once across runs.
+
+    The first load inflates the file and saves it as an uncompressed .nii in the cache.
+    Later loads memory-map that copy. Files that are not gzipped are loaded directly.
+
+    :param file_path: Path to the neuroimaging file.
+    :return: A nibabel image.
+    """
+    if not file_path.endswith('.nii.gz') or not volume_cache_enabled():
+        return nib.load(file_path)
+
+    cache_dir = volume_cache_settings['cache_dir']
+    os.makedirs(cache_dir, exist_ok=True)
+
+    key = get_volume_cache_key(file_path)
+    cache_path = os.path.join(cache_dir, key + '.nii')
+
+    if not os.path.exists(cache_path):
+        with locked_file(os.path.join(cache_dir, key + '.lock')):
+            # Another worker may have written it while we waited for the lock
+            if not os.path.exists(cache_path):
+                tmp_path = os.path.join(cache_dir, f"{key}.{os.getpid()}.tmp.nii")
+                try:
+                    nib.save(nib.load(file_path), tmp_path)
+                    os.replace(tmp_path, cache_path)
+                except OSError as e:
+                    print(f"Unable to cache {file_path}: {e}")
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    return nib.load(file_path)
+                evict_volume_cache(cache_dir, keep=cache_path)
+
+    try:
+        # Mark as recently used
+        os.utime(cache_path)
+        return nib.load(cache_path, mmap='r')
+    except FileNotFoundError:
+        # Evicted by another worker in the meantime
+        return nib.load(file_path)
+
+# This function will remove every cached volume
+def clear_volume_cache(cache_dir=None):
+    return evict_volume_cache(cache_dir, max_bytes=0)
@@ -0,0 +1,2 @@
+# The tests import the scripts as DataScript.<module>, like the scripts import each other, so the
+# root of the repository is put on the path by pytest through this file.
@@ -0,0 +1,72 @@
+#################### IMPORTS ####################
+# ALL
+import os
+
+# AS
+import pandas as pd
+
+# FROM FILE
+from DataScript.cdr_label_service import *
+
+#################### FUNCTIONS ####################
+
+files = [
+    'Slice_100_OAS1_0001_MR1_axial_img_1_anon.png',
+    'Slice_100_OAS1_0002_MR1_axial_img_1_anon.png',
+    'Slice_11_sub-OAS30036_sess-d1199_T2star_Sagittal_img.png',
+    'Slice_11_sub-OAS30037_sess-d0000_T1w_Axial_img.png',
+    'Slice_x_100_OAS42027_MR_d3034_img9.png',
+]
+
+# This function will write the CDR tables of OASIS 1, 3 and 4 under a root directory
+def write_cdr_files(root_directory):
+    clinical_directory = os.path.join(root_directory, 'Original', 'Clinical')
+    os.makedirs(clinical_directory)
+    # OAS1_0002_MR1 has no CDR in the table, like the young OASIS 1 subjects
+    pd.DataFrame({'ID': ['OAS1_0001_MR1', 'OAS1_0002_MR1'], 'CDR': [0.5, None]}).to_csv(os.path.join(clinical_directory, 'oasis1_cross-sectional.csv'), index=False)
+    # The first row of a subject is used
+    pd.DataFrame({'OASISID': ['OAS30036', 'OAS30036', 'OAS30037'], 'OASIS_session_label': ['OAS30036_UDSb4_d1100', 'OAS30036_UDSb4_d1300', 'OAS30037_UDSb4_d0000'], 'CDRTOT': [1.0, 2.0, 0.0]}).to_csv(os.path.join(clinical_directory, 'OASIS3_UDSb4_cdr.csv'), index=False)
+    pd.DataFrame({'oasis_id': ['OAS42027'], 'cdr_id': ['OAS42027_CDR_d3034'], 'visit_days': [3034], 'cdr': [2.0]}).to_csv(os.path.join(clinical_directory, 'OASIS4_data_CDR.csv'), index=False)
+    return clinical_directory
+
+# This function will label a file like the per-file lookups CDRLabelService replaced
+def label_like_old_loop(file, clinical_directory):
+    oasis1_dcr_df = pd.read_csv(os.path.join(clinical_directory, 'oasis1_cross-sectional.csv'))
+    oasis3_dcr_df = pd.read_csv(os.path.join(clinical_directory, 'OASIS3_UDSb4_cdr.csv'))
+    oasis4_dcr_df = pd.read_csv(os.path.join(clinical_directory, 'OASIS4_data_CDR.csv'))
+    if "OAS1" in file:
+        label_id = oasis1_dcr_df[oasis1_dcr_df['ID'] == f"OAS1_{file.split('_')[3]}_{file.split('_')[4]}"]['CDR'].values[0]
+    elif "OAS3" in file:
+        label_id = oasis3_dcr_df[oasis3_dcr_df['OASISID'] == file.split('_')[2][4:]]['CDRTOT'].values[0]
+    elif "OAS4" in file:
+        label_id = oasis4_dcr_df[oasis4_dcr_df['oasis_id'] == file.split('_')[3]]['cdr'].values[0]
+    return get_cdr_label(float(label_id))
+
+def test_labels_match_the_old_lookups(tmp_path):
+    clinical_directory = write_cdr_files(str(tmp_path))
+    labels = CDRLabelService(str(tmp_path))
+
+    labelled_files = [file for file in files if 'OAS1_0002' not in file]
+    assert [labels.get_file_label(file) for file in labelled_files] == [label_like_old_loop(file, clinical_directory) for file in labelled_files]
+    assert [labels.get_file_label(file) for file in files] == ['very-mild-dementia', 'unknown', 'mild-dementia', 'non-demented', 'moderate-dementia']
+    # The old lookups gave 'Unknown' without a CDR, a folder create_categories_folders does not make
+    assert label_like_old_loop(files[1], clinical_directory) == 'Unknown'
+
+def test_lookups_by_patient_and_session():
+    cdr_dfs = {'OAS3': pd.DataFrame({'OASISID': ['OAS30001', 'OAS30001'], 'CLINICALDATAID': ['OAS30001_UDSb4_d0000', 'OAS30001_UDSb4_d0500'], 'CDR': [0.0, 0.5]})}
+    labels = CDRLabelService(None, cdr_dfs=cdr_dfs)
+
+    assert labels.get_patient_cdr('OAS3', 'OAS30001') == 0.0
+    assert labels.get_session_cdr('OAS3', 'OAS30001_UDSb4_d0500') == 0.5
+    assert labels.get_patient_cdr('OAS3', 'OAS30002') is None
+    assert labels.get_patient_cdr('OAS4', 'OAS42027') is None
+
+def test_files_without_a_usable_cdr_are_unknown():
+    cdr_dfs = {'OAS3': pd.DataFrame({'OASISID': ['OAS30001', 'OAS30002', 'OAS30003'], 'CDR': ['', 3.0, float('nan')]})}
+    labels = CDRLabelService(None, cdr_dfs=cdr_dfs)
+
+    # Not a number, a CDR without a label, NaN, and a subject not in the table
+    for oasisid in ['OAS30001', 'OAS30002', 'OAS30003', 'OAS30009']:
+        assert labels.get_file_label(f'Slice_1_sub-{oasisid}_sess-d0000_T1w_Axial_img.png') == 'unknown'
+    assert labels.get_file_label('Slice_1_sub-OAS30009_sess-d0000_T1w_Axial_img.png', default=None) is None
+    assert labels.get_file_label('notes.png') == 'unknown'
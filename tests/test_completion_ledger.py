@@ -0,0 +1,82 @@
+#################### IMPORTS ####################
+# ALL
+import os
+
+# FROM FILE
+from DataScript.completion_ledger import *
+
+#################### FUNCTIONS ####################
+
+# This function will save empty slice images of a scan like save_single_slice
+def write_slices(output_directory, file_name, num_slices, orientation='axial'):
+    os.makedirs(output_directory, exist_ok=True)
+    for index in range(num_slices):
+        open(os.path.join(output_directory, f"Slice_{index}_{file_name}_{orientation}_img.png"), 'wb').close()
+
+def test_seeded_scans_are_done_only_when_complete(tmp_path):
+    output_directory = str(tmp_path / 'Preprocessed')
+    write_slices(os.path.join(output_directory, 'MRI'), 'OAS1_0001_MR1', 4)
+    write_slices(os.path.join(output_directory, 'MRI'), 'OAS1_0002_MR1', 2)
+    write_slices(os.path.join(output_directory, 'MRI'), 'OAS1_0003_MR1', 4)
+    expected_counts = {'OAS1_0001_MR1': 4, 'OAS1_0002_MR1': 4}
+
+    with CompletionLedger(str(tmp_path / 'completion_ledger.sqlite')) as ledger:
+        assert ledger.seed_from_directory(output_directory, expected_counts.get) == 1
+        assert ledger.is_done('OAS1_0001_MR1')
+        # Fewer images than expected, or an unknown count, is an interrupted scan
+        assert ledger.get_partial() == ['OAS1_0002_MR1', 'OAS1_0003_MR1']
+
+        # The folder is only walked the first time
+        write_slices(os.path.join(output_directory, 'MRI'), 'OAS1_0002_MR1', 4)
+        assert ledger.seed_from_directory(output_directory, expected_counts.get) == 0
+        assert not ledger.is_done('OAS1_0002_MR1')
+
+def test_seeding_keeps_the_rows_of_a_conversion(tmp_path):
+    output_directory = str(tmp_path / 'Preprocessed')
+    write_slices(output_directory, 'OAS1_0001_MR1', 4)
+
+    with CompletionLedger(str(tmp_path / 'completion_ledger.sqlite')) as ledger:
+        ledger.mark_started(['OAS1_0001_MR1'])
+        ledger.seed_from_directory(output_directory, lambda file_name: 4)
+        assert not ledger.is_done('OAS1_0001_MR1')
+        ledger.mark_done('OAS1_0001_MR1', 4)
+
+    # The status is read back from the file
+    with CompletionLedger(str(tmp_path / 'completion_ledger.sqlite')) as ledger:
+        assert ledger.is_done('OAS1_0001_MR1') and ledger.get_partial() == []
+
+# This function will write a ledger with seeded and converted rows
+def write_ledger(ledger_path, seeded=(), started=(), done=()):
+    with CompletionLedger(ledger_path) as ledger:
+        with ledger.connection:
+            ledger.connection.executemany("INSERT INTO scans (file_name, status, num_slices, updated_at, seeded) VALUES (?, ?, 4, 0, 1)", list(seeded))
+        ledger.mark_started(started)
+        for file_name in done:
+            ledger.mark_done(file_name, 4)
+
+def test_merge_prefers_converted_rows_then_done(tmp_path):
+    ledger_path, shard_path = str(tmp_path / 'completion_ledger.sqlite'), str(tmp_path / 'completion_ledger.shard-0-of-2.sqlite')
+    write_ledger(ledger_path, seeded=[('seeded-done', 'done'), ('seeded-started', 'started')], started=['started', 'started-in-shard'], done=['done', 'converted'])
+    write_ledger(shard_path, seeded=[('converted', 'started'), ('started', 'done')], started=['seeded-done', 'done'], done=['seeded-started', 'started-in-shard', 'new'])
+
+    with CompletionLedger(ledger_path) as ledger:
+        assert ledger.merge_from(shard_path) == 7
+        statuses = dict(ledger.connection.execute('SELECT file_name, status FROM scans'))
+
+    # The shard's own started row beats a seeded done row, and a seeded row never replaces a converted one
+    assert statuses['seeded-done'] == 'started'
+    assert statuses['seeded-started'] == 'done'
+    assert statuses['converted'] == 'done'
+    assert statuses['started'] == 'started'
+    # Between two converted rows the scan is done if either ledger finished it
+    assert statuses['done'] == 'done'
+    assert statuses['started-in-shard'] == 'done'
+    assert statuses['new'] == 'done'
+
+def test_merge_copies_only_the_listed_scans(tmp_path):
+    ledger_path, other_path = str(tmp_path / 'completion_ledger.sqlite'), str(tmp_path / 'other.sqlite')
+    write_ledger(other_path, done=['OAS1_0001_MR1', 'OAS1_0002_MR1'])
+
+    with CompletionLedger(ledger_path) as ledger:
+        assert ledger.merge_from(other_path, file_names={'OAS1_0002_MR1'}) == 1
+        assert ledger.done == {'OAS1_0002_MR1'}
@@ -0,0 +1,44 @@
+#################### IMPORTS ####################
+# ALL
+import os
+import signal
+
+# AS
+import pytest
+
+# FROM
+from concurrent.futures.process import BrokenProcessPool
+
+# FROM FILE
+from DataScript.conversion_executor import *
+import DataScript.neuroimaging_slices as neuroimaging_slices
+
+#################### FUNCTIONS ####################
+
+# This function will square a number, or fail the way a worker over its memory limit does
+def square_or_fail(number):
+    if number == -1:
+        raise MemoryError()
+    if number == -2:
+        os.kill(os.getpid(), signal.SIGKILL)
+    return number * number
+
+def test_map_unordered_returns_every_result():
+    executor = ConversionExecutor(num_workers=2, chunk_size=3, progress_interval=60)
+    assert sorted(executor.map_unordered(square_or_fail, range(10), get_task_size=None)) == [number * number for number in range(10)]
+
+def test_map_unordered_leaves_out_the_tasks_over_the_memory_limit():
+    executor = ConversionExecutor(num_workers=2, chunk_size=2, progress_interval=60)
+    assert sorted(executor.map_unordered(square_or_fail, [1, -1, 2, 3, -1], get_task_size=None)) == [1, 4, 9]
+
+def test_map_unordered_stops_when_a_worker_is_killed():
+    executor = ConversionExecutor(num_workers=2, progress_interval=60)
+    with pytest.raises(BrokenProcessPool):
+        list(executor.map_unordered(square_or_fail, [1, -2, 2, 3], get_task_size=None))
+
+def test_process_file_passes_memory_errors_on(monkeypatch, tmp_path):
+    def load_over_the_limit(file_paths):
+        raise MemoryError()
+    monkeypatch.setattr(neuroimaging_slices, 'load_nii_file', load_over_the_limit)
+    with pytest.raises(MemoryError):
+        neuroimaging_slices.process_file(('scan', ['scan.nii']), str(tmp_path), {'scan': 'unknown'})
@@ -0,0 +1,75 @@
+#################### IMPORTS ####################
+# AS
+import numpy as np
+import pandas as pd
+
+# FROM FILE
+from DataScript.interval_join import *
+
+#################### FUNCTIONS ####################
+
+# This function will match the scans like the loop window_join replaced (one mask over every scan per assessment row)
+def match_like_old_loop(scan_session_day, clinical_assesment_day, lower_bound, upper_bound):
+    for index, row in clinical_assesment_day.iterrows():
+        mask = (scan_session_day['OASISID'] == row['OASISID']) & ((scan_session_day['days_to_visit'] < row['days_to_visit'] + upper_bound) & (scan_session_day['days_to_visit'] > row['days_to_visit'] - lower_bound))
+        for name in row.index:
+            scan_session_day.loc[mask, name + '_clinical_assesment_day'] = row[name]
+    return scan_session_day
+
+# This function will build scans and assessments with at most one assessment in the window of each scan
+def get_tables():
+    rng = np.random.default_rng(0)
+    scans, assessments = [], []
+    for subject in range(40):
+        oasisid = f"OAS3{subject:04d}"
+        # Assessments 500 days apart, so a window of 100 days holds at most one
+        for visit in range(rng.integers(0, 4)):
+            assessments.append({'OASISID': oasisid, 'days_to_visit': visit * 500 + int(rng.integers(0, 50)), 'CDR': float(rng.choice([0, 0.5, 1, 2])), 'MMSE': float(rng.integers(15, 31))})
+        for _ in range(rng.integers(1, 5)):
+            scans.append({'OASISID': oasisid, 'days_to_visit': int(rng.integers(-150, 1700)), 'scan': f"{oasisid}_d{len(scans)}"})
+    # Scans of a subject with no assessments at all
+    scans.append({'OASISID': 'OAS39999', 'days_to_visit': 10, 'scan': 'unmatched'})
+    # The assessments are shuffled, the old loop did not need them sorted
+    assessments = pd.DataFrame(assessments).sample(frac=1, random_state=0).reset_index(drop=True)
+    return pd.DataFrame(scans), assessments
+
+# This function will list a column with None for the missing values
+def get_values(column):
+    # The old loop left the string 'nan' in the unmatched rows of the text columns it created with .loc
+    return [None if pd.isna(value) or value == 'nan' else value for value in column]
+
+def test_window_join_matches_the_old_loop():
+    scans, assessments = get_tables()
+    for lower_bound, upper_bound in [(100, 100), (30, 90), (60, 5)]:
+        expected = match_like_old_loop(scans.copy(), assessments, lower_bound, upper_bound)
+        joined = window_join(scans.copy(), assessments, lower_bound, upper_bound)
+
+        columns = [name + '_clinical_assesment_day' for name in assessments.columns]
+        for name in columns:
+            if name not in expected:
+                expected[name] = np.nan
+        # Some scans are matched and some are not, so the comparison checks both
+        assert expected[columns[1]].notna().any() and expected[columns[1]].isna().any()
+        for name in columns:
+            assert get_values(joined[name]) == get_values(expected[name])
+
+def test_window_join_uses_the_closest_assessment():
+    scans = pd.DataFrame({'OASISID': ['OAS30001'] * 4, 'days_to_visit': [100, 130, 150, 400]})
+    assessments = pd.DataFrame({'OASISID': ['OAS30001'] * 3, 'days_to_visit': [160, 90, 140], 'CDR': [1.0, 0.0, 0.5]})
+
+    joined = window_join(scans, assessments, 100, 100)
+
+    # 100 -> 90, 130 -> 140, 150 is as close to 140 as to 160 so the later one, 400 has none in the window
+    assert joined['days_to_visit_clinical_assesment_day'].tolist()[:3] == [90, 140, 160]
+    assert joined['CDR_clinical_assesment_day'].tolist()[:3] == [0.0, 0.5, 1.0]
+    assert np.isnan(joined['CDR_clinical_assesment_day'].iloc[3])
+
+def test_window_join_keeps_the_strict_window():
+    scans = pd.DataFrame({'OASISID': ['OAS30001', 'OAS30001', 'OAS30001'], 'days_to_visit': [0, 50, 51]})
+    assessments = pd.DataFrame({'OASISID': ['OAS30001'], 'days_to_visit': [100], 'CDR': [0.5]})
+
+    # The assessment must be less than lower_bound days after the scan, like the old loop
+    joined = window_join(scans, assessments, 50, 10)
+    expected = match_like_old_loop(scans.copy(), assessments, 50, 10)
+    assert joined['CDR_clinical_assesment_day'].isna().tolist() == [True, True, False]
+    assert expected['CDR_clinical_assesment_day'].isna().tolist() == [True, True, False]
@@ -0,0 +1,106 @@
+#################### IMPORTS ####################
+# ALL
+import os
+
+# AS
+import numpy as np
+import pandas as pd
+
+# FROM FILE
+from DataScript.move_folders_from_one_path_to_another import *
+
+#################### FUNCTIONS ####################
+
+categorised_directory = '/data/Categorised'
+
+# This function will label the files like the per-file loop of create_df that resolve_file_labels replaced
+def label_like_old_loop(ids_df, files_directory_df, cdr_dfs, categorised_preprocessed_image_dir):
+    save_rows = []
+    for _, row in ids_df.iterrows():
+        file, OASISID, dataset_marker, clinical_data_id = row['file'], row['OASISID'], row['dataset_marker'], row['clinical_data_id']
+        label_id = None
+
+        if dataset_marker in cdr_dfs:
+            if "OAS3" in dataset_marker:
+                clinical_data_id = files_directory_df[files_directory_df['file'] == file]['CLINICALDATAID_clinical_assessment'].values[0] if files_directory_df[files_directory_df['file'] == file]['CLINICALDATAID_clinical_assessment'].values.any() else None
+                if clinical_data_id is None:
+                    continue
+                if OASISID in cdr_dfs['OAS3Unchanged']['OASISID'].values:
+                    label_id = cdr_dfs['OAS3Unchanged'][cdr_dfs['OAS3Unchanged']['OASISID'] == OASISID]['CDR'].values[0]
+                elif clinical_data_id in cdr_dfs[dataset_marker]['CLINICALDATAID'].values:
+                    label_id = cdr_dfs[dataset_marker][cdr_dfs[dataset_marker]['CLINICALDATAID'] == clinical_data_id]['CDR'].values[0]
+            elif clinical_data_id in cdr_dfs[dataset_marker]['CLINICALDATAID'].values:
+                label_id = cdr_dfs[dataset_marker][cdr_dfs[dataset_marker]['CLINICALDATAID'] == clinical_data_id]['CDR'].values[0]
+
+        if label_id is not None and label_id != "":
+            dest_item = os.path.join(categorised_preprocessed_image_dir, get_cdr_label(float(label_id)), file)
+        else:
+            dest_item = os.path.join(categorised_preprocessed_image_dir, "unknown", file)
+        label = get_cdr_label(float(label_id)) if label_id is not None else None
+        save_rows.append({'file': file, 'clinical_data_id': clinical_data_id, 'label_id': label_id, 'label': label, 'dest_item': dest_item})
+    return pd.DataFrame(save_rows)
+
+# This function will build the CDR tables, the parsed ids of the files and their matched assessments
+def get_tables():
+    cdr_dfs = {
+        # OAS1_0001_MR1 is listed twice: the first row is used
+        'OAS1': pd.DataFrame({'OASISID': ['OAS1_0001_MR1', 'OAS1_0002_MR1', 'OAS1_0001_MR1', 'OAS1_0004_MR1'], 'CLINICALDATAID': ['OAS1_0001_MR1', 'OAS1_0002_MR1', 'OAS1_0001_MR1', 'OAS1_0004_MR1'], 'CDR': [0.0, 0.5, 1.0, np.nan]}),
+        'OAS3': pd.DataFrame({'OASISID': ['OAS30001', 'OAS30002', 'OAS30003'], 'CLINICALDATAID': ['OAS30001_UDSb4_d0000', 'OAS30002_UDSb4_d0100', 'OAS30003_UDSb4_d0200'], 'CDR': [0.5, 1.0, 2.0]}),
+        'OAS3Unchanged': pd.DataFrame({'OASISID': ['OAS30003'], 'CDR': [0.0]}),
+    }
+    rows = [
+        ('Slice_1_OAS1_0001_MR1_img.png', 'OAS1_0001_MR1', 'OAS1', 'OAS1_0001_MR1'),
+        ('Slice_2_OAS1_0002_MR1_img.png', 'OAS1_0002_MR1', 'OAS1', 'OAS1_0002_MR1'),
+        ('Slice_3_OAS1_0003_MR1_img.png', 'OAS1_0003_MR1', 'OAS1', 'OAS1_0003_MR1'),
+        ('Slice_4_OAS1_0004_MR1_img.png', 'OAS1_0004_MR1', 'OAS1', 'OAS1_0004_MR1'),
+        ('Slice_1_sub-OAS30001_ses-d0010_T1w.png', 'OAS30001', 'OAS3', ''),
+        ('Slice_1_sub-OAS30002_ses-d0090_T1w.png', 'OAS30002', 'OAS3', ''),
+        ('Slice_1_sub-OAS30003_ses-d0210_T1w.png', 'OAS30003', 'OAS3', ''),
+        ('Slice_1_sub-OAS30004_ses-d0000_T1w.png', 'OAS30004', 'OAS3', ''),
+        ('Slice_1_sub-OAS30005_ses-d0000_T1w.png', 'OAS30005', 'OAS3', ''),
+        ('Slice_1_OAS4_0001_img.png', 'OAS40001', 'OAS4', 'OAS40001_CDR'),
+    ]
+    ids_df = pd.DataFrame(rows, columns=['file', 'OASISID', 'dataset_marker', 'clinical_data_id'])
+    for name in ['patient_id', 'mr_id', 'slice_id', 'slice_type', 'mr_type', 'img_id', 'day', 'run_id']:
+        ids_df[name] = None
+    ids_df['file_full_path'] = '/data/Preprocessed/' + ids_df['file']
+
+    # OAS30004 has an assessment outside the CDR table, OAS30005 was not matched
+    files_directory_df = pd.DataFrame({
+        'file': ids_df['file'][4:8].tolist(),
+        'CLINICALDATAID_clinical_assessment': ['OAS30001_UDSb4_d0000', 'OAS30002_UDSb4_d0100', 'OAS30003_UDSb4_d0200', 'OAS30004_UDSb4_d0000'],
+    })
+    return ids_df, files_directory_df, cdr_dfs
+
+# This function will list a column with None for the missing values
+def get_values(column):
+    return [None if pd.isna(value) else value for value in column]
+
+def test_resolve_file_labels_matches_the_old_loop():
+    ids_df, files_directory_df, cdr_dfs = get_tables()
+
+    expected = label_like_old_loop(ids_df, files_directory_df, cdr_dfs, categorised_directory)
+    resolved = resolve_file_labels(ids_df, files_directory_df, cdr_dfs, categorised_directory)
+
+    # The unmatched OASIS 3 file is dropped by both
+    assert resolved['file'].tolist() == expected['file'].tolist()
+    assert 'Slice_1_sub-OAS30005_ses-d0000_T1w.png' not in resolved['file'].tolist()
+    for name in ['clinical_data_id', 'label_id', 'label', 'dest_item']:
+        assert get_values(resolved[name]) == get_values(expected[name]), name
+
+def test_resolve_file_labels_uses_the_expected_labels():
+    ids_df, files_directory_df, cdr_dfs = get_tables()
+
+    resolved = resolve_file_labels(ids_df, files_directory_df, cdr_dfs, categorised_directory).set_index('file')
+
+    labels = resolved['label'].to_dict()
+    assert labels['Slice_1_OAS1_0001_MR1_img.png'] == 'non-demented'
+    assert labels['Slice_2_OAS1_0002_MR1_img.png'] == 'very-mild-dementia'
+    assert labels['Slice_4_OAS1_0004_MR1_img.png'] == 'unknown'
+    assert labels['Slice_1_sub-OAS30002_ses-d0090_T1w.png'] == 'mild-dementia'
+    # The unchanged CDR of the subject comes before its clinical assessment
+    assert labels['Slice_1_sub-OAS30003_ses-d0210_T1w.png'] == 'non-demented'
+    # Not in the CDR table, or a dataset without a CDR table
+    assert labels['Slice_3_OAS1_0003_MR1_img.png'] is None
+    assert labels['Slice_1_OAS4_0001_img.png'] is None
+    assert resolved.loc['Slice_1_OAS4_0001_img.png', 'dest_item'] == os.path.join(categorised_directory, 'unknown', 'Slice_1_OAS4_0001_img.png')
@@ -0,0 +1,37 @@
+#################### IMPORTS ####################
+# AS
+import nibabel as nib
+import numpy as np
+
+# FROM FILE
+from DataScript.neuroimaging_slices import *
+from DataScript.slice_shards import *
+
+#################### FUNCTIONS ####################
+
+# This function will save a volume as a NIfTI file
+def save_volume(path, volume):
+    nib.save(nib.Nifti1Image(volume, np.eye(4)), str(path))
+    return str(path)
+
+def test_slab_with_a_trailing_axis_gives_the_same_images():
+    slab = np.random.default_rng(0).random((5, 40, 30), dtype=np.float32) * 1000
+    assert np.array_equal(slab_to_uint8_images(slab[..., None]), slab_to_uint8_images(slab))
+
+def test_4d_volume_gives_the_slices_of_the_3d_volume(tmp_path):
+    volume = np.random.default_rng(0).random((40, 110, 120), dtype=np.float32) * 1000
+    path_3d = save_volume(tmp_path / 'scan_3d.nii', volume)
+    # OASIS-1 volumes have a trailing axis of size 1
+    path_4d = save_volume(tmp_path / 'scan_4d.nii', volume[..., None])
+
+    images_3d = read_uint8_slices(nib.load(path_3d))
+    images_4d = read_uint8_slices(nib.load(path_4d))
+
+    assert sorted(images_4d) == ['Axial', 'Coronal', 'Sagittal']
+    for orientation, slice_list in images_3d.items():
+        assert sorted(images_4d[orientation]) == sorted(slice_list)
+        assert all(np.array_equal(images_4d[orientation][index], image) for index, image in slice_list.items())
+        assert all(image.shape == (128, 128) and image.dtype == np.uint8 for image in images_4d[orientation].values())
+
+    num_slices = sum(len(slice_list) for slice_list in images_4d.values())
+    assert num_slices == get_expected_slice_count([path_4d]) == get_expected_slice_count([path_3d]) == 20 + 10 + 20
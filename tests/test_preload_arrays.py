@@ -0,0 +1,95 @@
+#################### IMPORTS ####################
+# AS
+import numpy as np
+import pytest
+
+# FROM FILE
+from DataScript.preload_arrays import *
+
+#################### FUNCTIONS ####################
+
+# This function will make (MRI, CT, PET) samples with different pixels
+def make_samples(num_samples, seed=0):
+    return np.random.default_rng(seed).integers(0, 256, size=(num_samples,) + preload_sample_shape, dtype=np.uint8)
+
+def test_save_and_load_round_trip(tmp_path):
+    path_prefix = str(tmp_path / 'preload' / 'train_5000')
+    data, labels = make_samples(5), np.array([0, 1, 2, 3, 1])
+
+    save_preload_arrays(path_prefix, data, labels, sampling={'target_samples': 5000, 'seed': 42})
+    loaded_data, loaded_labels, header = load_preload_arrays(path_prefix)
+
+    assert isinstance(loaded_data, np.memmap) and loaded_data.dtype == np.uint8
+    assert loaded_data.shape == data.shape
+    np.testing.assert_array_equal(loaded_data, data)
+    np.testing.assert_array_equal(loaded_labels, labels)
+    assert header['label_mapping'] == preload_label_mapping
+    assert header['sampling'] == {'target_samples': 5000, 'seed': 42}
+    # Opened read-only, the pages can be shared but not changed
+    with pytest.raises(ValueError):
+        loaded_data[0, 0, 0, 0, 0] = 0
+
+def test_float_samples_are_rounded_to_uint8(tmp_path):
+    path_prefix = str(tmp_path / 'train')
+    sample = np.full(preload_sample_shape, 10.6)
+    sample[0] = -3.0
+    sample[1] = 300.0
+
+    save_preload_arrays(path_prefix, [sample], [2])
+    loaded_data, loaded_labels, _ = load_preload_arrays(path_prefix)
+
+    assert (loaded_data[0, 0] == 0).all() and (loaded_data[0, 1] == 255).all() and (loaded_data[0, 2] == 11).all()
+    assert loaded_labels.tolist() == [2]
+
+def test_writer_keeps_only_the_written_samples(tmp_path):
+    path_prefix = str(tmp_path / 'train')
+    data = make_samples(2)
+
+    # One of the three samples was skipped (e.g. an unreadable image)
+    with PreloadArrayWriter(path_prefix, 3) as writer:
+        writer.append(data[0], 0)
+        writer.append(data[1], 3)
+        with pytest.raises(ValueError):
+            writer.append(np.zeros((128, 128, 3)), 0)
+
+    loaded_data, loaded_labels, header = load_preload_arrays(path_prefix)
+    assert header['shape'] == [2] + list(preload_sample_shape)
+    assert os.path.getsize(get_preload_paths(path_prefix)['data']) == data.nbytes
+    np.testing.assert_array_equal(loaded_data, data)
+    assert loaded_labels.tolist() == [0, 3]
+
+def test_unfinished_preload_can_not_be_opened(tmp_path):
+    path_prefix = str(tmp_path / 'train')
+    save_preload_arrays(path_prefix, make_samples(1), [0])
+
+    # Writing it again fails half way: the old header is gone and no new one is written
+    with pytest.raises(RuntimeError):
+        with PreloadArrayWriter(path_prefix, 2) as writer:
+            writer.append(make_samples(1)[0], 1)
+            raise RuntimeError('interrupted')
+
+    with pytest.raises(FileNotFoundError):
+        load_preload_arrays(path_prefix)
+
+def test_empty_preload(tmp_path):
+    path_prefix = str(tmp_path / 'empty')
+    save_preload_arrays(path_prefix, [], [])
+
+    loaded_data, loaded_labels, _ = load_preload_arrays(path_prefix)
+    assert loaded_data.shape == (0,) + preload_sample_shape and loaded_labels.shape == (0,)
+
+def test_legacy_preload_conversion(tmp_path):
+    samples = make_samples(3).astype(np.float64)
+    # The notebooks saved object arrays of [MRI, CT, PET] lists
+    data = np.empty(3, dtype=object)
+    for index, sample in enumerate(samples):
+        data[index] = [sample[0], sample[1], sample[2]]
+    np.save(str(tmp_path / 'data_3.h5.npy'), data, allow_pickle=True)
+    np.save(str(tmp_path / 'results_3.h5.npy'), np.array([3, 0, 1]), allow_pickle=True)
+
+    convert_legacy_preload(str(tmp_path / 'data_3.h5.npy'), str(tmp_path / 'results_3.h5.npy'), str(tmp_path / 'train_3'), sampling={'seed': 42})
+    loaded_data, loaded_labels, header = load_preload_arrays(str(tmp_path / 'train_3'))
+
+    np.testing.assert_array_equal(loaded_data, samples.astype(np.uint8))
+    assert loaded_labels.tolist() == [3, 0, 1]
+    assert header['sampling'] == {'seed': 42}
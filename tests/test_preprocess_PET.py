@@ -0,0 +1,28 @@
+#################### IMPORTS ####################
+# AS
+import nibabel as nib
+import numpy as np
+
+# FROM FILE
+from DataScript.preprocess_PET import *
+
+#################### FUNCTIONS ####################
+
+# This function will make a dynamic PET scan whose frames have different spreads
+def make_dynamic_scan():
+    rng = np.random.default_rng(0)
+    spreads = np.array([4, 2, 9, 1, 3, 8, 6, 5, 7], dtype=np.float32)
+    return (rng.random((10, 11, 12, 9), dtype=np.float32) * spreads).astype(np.float32)
+
+def test_frame_by_frame_variance_selects_the_same_frames():
+    img_data = make_dynamic_scan()
+    assert find_highest_variance_time_points(img_data, 3) == find_highest_variance_time_points(img_data, 3, max_bytes=0) == [2, 5, 8]
+
+def test_streamed_variances_match_the_array_variances(tmp_path):
+    img_data = make_dynamic_scan()
+    path = str(tmp_path / 'pet.nii.gz')
+    nib.save(nib.Nifti1Image(img_data, np.eye(4)), path)
+
+    expected = np.var(img_data.astype(np.float64), axis=(0, 1, 2))
+    assert np.allclose(compute_frame_variances(nib.load(path)), expected)
+    assert np.allclose(compute_frame_variances(nib.load(path), max_bytes=0), expected)
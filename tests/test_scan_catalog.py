@@ -0,0 +1,40 @@
+#################### IMPORTS ####################
+# AS
+import pandas as pd
+
+# FROM FILE
+from DataScript.scan_catalog import *
+
+#################### FUNCTIONS ####################
+
+scan_path = '/data/Original/OAS30001_MR_d0129/anat1/sub-OAS30001_ses-d0129_run-01_T1w.nii.gz'
+
+# This function will make a scan manifest of one file
+def make_manifest(size, mtime_ns):
+    return pd.DataFrame({'path': [scan_path], 'name': [os.path.basename(scan_path)], 'size': [size], 'mtime_ns': [mtime_ns]})
+
+def test_label_lookup_returns_the_ref_df_labels(tmp_path):
+    with ScanCatalog(str(tmp_path / 'scan_catalog.sqlite')) as catalog:
+        catalog.update_from_manifest(make_manifest(100, 1))
+        catalog.update_labels_from_ref_df(pd.DataFrame({'path': [scan_path], 'label_id': [0.5], 'label': ['very-mild-dementia']}))
+
+        assert catalog.label_lookup() == {'sub-OAS30001_ses-d0129_run-01_T1w': 'very-mild-dementia'}
+        scan = catalog.get_scans(oasisid='OAS30001').iloc[0]
+        assert (scan['session_day'], scan['modality']) == (129, 'T1w')
+
+def test_changed_file_is_parsed_again(tmp_path):
+    with ScanCatalog(str(tmp_path / 'scan_catalog.sqlite')) as catalog:
+        catalog.update_from_manifest(make_manifest(100, 1))
+        catalog.update_labels_from_ref_df(pd.DataFrame({'path': [scan_path], 'label_id': [0.5], 'label': ['very-mild-dementia']}))
+        with catalog.connection:
+            catalog.connection.execute("UPDATE scans SET oasisid = 'stale', session_day = -1")
+
+        # An unchanged file is not parsed again
+        assert catalog.update_from_manifest(make_manifest(100, 1)) == (0, 0)
+        assert catalog.update_from_manifest(make_manifest(200, 2)) == (1, 0)
+
+        scan = catalog.get_scans().iloc[0]
+        assert (scan['oasisid'], scan['session_day'], scan['size']) == ('OAS30001', 129, 200)
+        # The label is given again by update_labels_from_ref_df
+        assert pd.isna(scan['label']) and catalog.label_lookup() == {}
+        assert catalog.get_sessions()['oasisid'].tolist() == ['OAS30001']
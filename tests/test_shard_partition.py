@@ -0,0 +1,44 @@
+#################### IMPORTS ####################
+# ALL
+import os
+
+# AS
+import numpy as np
+
+# FROM FILE
+from DataScript.shard_partition import *
+
+#################### FUNCTIONS ####################
+
+# This function will write one scan of four slices into a shard folder
+def write_scan(shard_directory, file_name):
+    slices = {'axial': {index: np.full((128, 128), index, dtype=np.uint8) for index in range(4)}}
+    with SliceShardWriter(shard_directory) as writer:
+        writer.write_scan(file_name, 'non-demented', slices)
+
+def test_merged_index_keeps_the_unsharded_shards(tmp_path):
+    shard_directory = str(tmp_path / 'shards')
+    write_scan(shard_directory, 'OAS1_0001_MR1_mpr_n4_anon_111_t88_masked_gfc')
+    write_scan(get_shard_path(shard_directory, (0, 2)), 'OAS1_0002_MR1_mpr_n4_anon_111_t88_masked_gfc')
+    write_scan(get_shard_path(shard_directory, (1, 2)), 'OAS1_0003_MR1_mpr_n4_anon_111_t88_masked_gfc')
+
+    assert merge_slice_shard_indexes(shard_directory) == 2
+    # Merging again replaces the rows of the shards instead of adding them twice
+    assert merge_slice_shard_indexes(shard_directory) == 2
+
+    index = read_slice_shard_index(shard_directory)
+    assert sorted(index['file_name'].str[:9]) == ['OAS1_0001'] * 4 + ['OAS1_0002'] * 4 + ['OAS1_0003'] * 4
+    assert all(os.path.exists(os.path.join(shard_directory, shard)) for shard in index['shard'])
+    assert index[index['file_name'].str.startswith('OAS1_0001')]['shard'].tolist() == ['slices-00000.npy'] * 4
+
+def test_merged_ledger_has_the_scans_of_every_shard(tmp_path):
+    ledger_path = str(tmp_path / 'completion_ledger.sqlite')
+    for shard, file_name in [((0, 2), 'OAS1_0001_MR1'), ((1, 2), 'OAS1_0002_MR1')]:
+        with CompletionLedger(get_shard_path(ledger_path, shard)) as ledger:
+            ledger.mark_done(file_name, 4)
+            ledger.mark_started([file_name + '_partial'])
+
+    assert merge_ledger_shards(ledger_path) == 2
+    with CompletionLedger(ledger_path) as ledger:
+        assert ledger.done == {'OAS1_0001_MR1', 'OAS1_0002_MR1'}
+        assert ledger.get_partial() == ['OAS1_0001_MR1_partial', 'OAS1_0002_MR1_partial']
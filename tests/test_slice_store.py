@@ -0,0 +1,49 @@
+#################### IMPORTS ####################
+# AS
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip('h5py')
+
+# FROM FILE
+from DataScript.slice_store import *
+
+#################### FUNCTIONS ####################
+
+# This function will make the slices of a scan, each filled with its own value
+def make_slices(orientation, value, num_slices=4):
+    return {orientation: {index: np.full((8, 8), value + index, dtype=np.uint8) for index in range(num_slices)}}
+
+# This function will write the scans of one patient in three modalities
+def write_patient_store(store_path):
+    with SliceStoreWriter(store_path, 'MRI') as writer:
+        writer.write_scan('sub-OAS30001_ses-d0100_run-01_T1w', 'non-demented', make_slices('Axial', 10))
+        writer.write_scan('sub-OAS30001_ses-d0500_run-01_T1w', 'non-demented', make_slices('Axial', 50))
+    with SliceStoreWriter(store_path, 'CT') as writer:
+        writer.write_scan('sub-OAS30001_ses-d0510_CT', 'non-demented', make_slices('Axial', 110))
+    with SliceStoreWriter(store_path, 'PET') as writer:
+        writer.write_scan('sub-OAS30001_ses-d0490_acq-PIB_pet', 'non-demented', make_slices('Axial_time_point2', 190))
+
+def test_triplet_comes_from_one_visit(tmp_path):
+    store_path = str(tmp_path / 'slices.h5')
+    write_patient_store(store_path)
+
+    reader = SliceStoreReader(store_path)
+    triplet = reader.get_patient_triplet('OAS30001')
+    # The second MRI session is 10 days from the CT and PET sessions, the first one is 400 days away
+    assert {modality: attrs['session'] for modality, (_, attrs) in triplet.items()} == {'MRI': 'd0500', 'CT': 'd0510', 'PET': 'd0490'}
+    assert triplet['MRI'][0][0, 0, 0] == 50
+    assert triplet['PET'][1]['orientation'] == 'Axial_time_point2'
+
+    assert set(reader.get_patient_triplet('OAS30001', max_day_difference=5)) == {'MRI'}
+    reader.close()
+
+def test_get_slices_keeps_the_order_of_the_positions(tmp_path):
+    store_path = str(tmp_path / 'slices.h5')
+    write_patient_store(store_path)
+
+    reader = SliceStoreReader(store_path)
+    slices, slice_indices = reader.get_slices('MRI', 'OAS30001', 'd0100', 'sub-OAS30001_ses-d0100_run-01_T1w', 'Axial', [3, 1, 1, 0])
+    assert slices[:, 0, 0].tolist() == [13, 11, 11, 10]
+    assert slice_indices.tolist() == [3, 1, 1, 0]
+    reader.close()
@@ -0,0 +1,53 @@
+#################### IMPORTS ####################
+# AS
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+
+# FROM FILE
+from DataScript.preload_arrays import *
+from DataScript.streaming_dataset import *
+
+#################### FUNCTIONS ####################
+
+# This function will save a small preload whose samples hold their own index
+def make_preload(tmp_path, num_samples=50):
+    data = np.zeros((num_samples, 3, 4, 4, 3), dtype=np.uint8)
+    data[:, 0, 0, 0, 0] = np.arange(num_samples)
+    path_prefix = str(tmp_path / 'train')
+    save_preload_arrays(path_prefix, data, np.arange(num_samples) % 4)
+    return path_prefix
+
+# This function will list the sample indexes of an epoch in the order they are read
+def read_epoch(batches):
+    return [int(value) for inputs, _ in batches for value in inputs[:, 0, 0, 0, 0]]
+
+def test_every_epoch_is_shuffled_differently(tmp_path):
+    dataset = MultimodalStreamingDataset(make_preload(tmp_path), batch_size=8, shard_size=10, shuffle_buffer=16)
+    first_epoch, second_epoch = read_epoch(dataset), read_epoch(dataset)
+
+    assert sorted(first_epoch) == sorted(second_epoch) == list(range(50))
+    assert first_epoch != second_epoch
+
+def test_set_epoch_fixes_the_order(tmp_path):
+    dataset = MultimodalStreamingDataset(make_preload(tmp_path), batch_size=8, shard_size=10, shuffle_buffer=16)
+    second_epoch = [read_epoch(dataset), read_epoch(dataset)][1]
+
+    dataset.set_epoch(1)
+    assert read_epoch(dataset) == read_epoch(dataset) == second_epoch
+
+def test_len_counts_the_batches_of_each_worker(tmp_path):
+    dataset = MultimodalStreamingDataset(make_preload(tmp_path), batch_size=8, shard_size=10, num_workers=2)
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=2)
+    first_epoch = list(dataloader)
+
+    # 3 shards of 10 samples make 4 batches of 8 in one worker, 2 shards make 3 in the other
+    assert len(first_epoch) == len(dataset) == 7
+    assert sorted(read_epoch(first_epoch)) == list(range(50))
+    assert read_epoch(list(dataloader)) != read_epoch(first_epoch)
+
+def test_other_number_of_workers_raises(tmp_path):
+    dataset = MultimodalStreamingDataset(make_preload(tmp_path), batch_size=8, num_workers=2)
+    with pytest.raises(ValueError):
+        list(dataset)
@@ -0,0 +1,63 @@
+#################### IMPORTS ####################
+# ALL
+import random
+
+# FROM
+from sklearn.model_selection import train_test_split
+
+# FROM FILE
+from DataScript.tf_input_pipeline import *
+
+#################### FUNCTIONS ####################
+
+# This function will make category file lists of different sizes
+def make_files_by_category(sizes):
+    return {category: [f"{category}/Slice_{index}.png" for index in range(size)] for category, size in sizes.items()}
+
+# This function will sample the splits with the cells of baseline-cnn-model-training.ipynb
+def sample_like_notebook(files_by_category, target_samples, test_target_samples):
+    def notebook_sample(dataset, target):
+        if len(dataset) == 0:
+            return []
+        if len(dataset) < target:
+            return random.choices(list(dataset), k=target)
+        return random.sample(list(dataset), k=target)
+
+    random.seed(42)
+    splits = {category: train_test_split(files, test_size=0.2, random_state=42) for category, files in files_by_category.items()}
+    train = {category: notebook_sample(splits[category][0], target_samples) for category in ['moderate-dementia', 'mild-dementia', 'very-mild-dementia', 'non-demented']}
+    test = {category: list(split[1]) for category, split in splits.items()}
+    for category in ['mild-dementia', 'very-mild-dementia', 'non-demented']:
+        test[category] = notebook_sample(test[category], test_target_samples)
+    return train, test
+
+def test_sampled_splits_match_notebook_class_counts():
+    files_by_category = make_files_by_category({'non-demented': 900, 'very-mild-dementia': 400, 'mild-dementia': 120, 'moderate-dementia': 15})
+    splits = get_sampled_splits(files_by_category, target_samples=200, test_target_samples=100)
+
+    train_val = splits['train'] + splits['val']
+    for category, label in tf_category_labels.items():
+        assert sum(1 for _, item_label in train_val if item_label == label) == 200
+    assert len(splits['val']) == 160
+
+    test_counts = {label: sum(1 for _, item_label in splits['test'] if item_label == label) for label in tf_category_labels.values()}
+    # The moderate test split (20% of 15 files) is not resampled, the others are
+    assert test_counts == {0: 100, 1: 100, 2: 100, 3: 3}
+    moderate_test = [item for item, label in splits['test'] if label == 3]
+    assert len(set(moderate_test)) == len(moderate_test)
+
+def test_sampled_splits_draw_the_notebook_samples():
+    files_by_category = make_files_by_category({'non-demented': 900, 'very-mild-dementia': 400, 'mild-dementia': 120, 'moderate-dementia': 15})
+    splits = get_sampled_splits(files_by_category, target_samples=200, test_target_samples=100)
+    train, test = sample_like_notebook(files_by_category, 200, 100)
+
+    for category, label in tf_category_labels.items():
+        assert sorted(item for item, item_label in splits['train'] + splits['val'] if item_label == label) == sorted(train[category])
+        assert [item for item, item_label in splits['test'] if item_label == label] == test[category]
+
+def test_sampled_splits_skip_empty_categories():
+    files_by_category = make_files_by_category({'non-demented': 50, 'very-mild-dementia': 0, 'mild-dementia': 30, 'moderate-dementia': 1})
+    splits = get_sampled_splits(files_by_category, target_samples=20, test_target_samples=10)
+
+    labels = {label for _, label in splits['train'] + splits['val'] + splits['test']}
+    assert labels == {0, 2}
@@ -0,0 +1,19 @@
+#################### IMPORTS ####################
+# ALL
+import os
+
+# FROM FILE
+from DataScript.volume_cache import *
+
+#################### FUNCTIONS ####################
+
+def test_eviction_keeps_the_lock_files(tmp_path):
+    cache_dir = str(tmp_path)
+    for number, key in enumerate(['old', 'new']):
+        with open(os.path.join(cache_dir, key + '.nii'), 'wb') as volume_file:
+            volume_file.write(b'0' * 100)
+        open(os.path.join(cache_dir, key + '.lock'), 'a').close()
+        os.utime(os.path.join(cache_dir, key + '.nii'), (number, number))
+
+    assert evict_volume_cache(cache_dir, max_bytes=150) == 100
+    assert sorted(os.listdir(cache_dir)) == ['.evict.lock', 'new.lock', 'new.nii', 'old.lock']